@@ -1,4 +1,4 @@
-from reco.datasetPU import TracksterGraphPU
+from reco.datasetPU import TracksterGraph
 
 data_root = "/mnt/ceph/users/ecuba/processed"
 ds_name = "CloseByGamma200PUFull"
@@ -10,11 +10,12 @@ threshold = 0.2
 sizes = [10, 50, 100, 250, None]
 
 for s in sizes:
-    ds = TracksterGraphPU(
+    ds = TracksterGraph(
         ds_name,
         data_root,
         raw_dir,
         N_FILES=s,
         radius=10,
+        pileup=True,
     )
     del ds
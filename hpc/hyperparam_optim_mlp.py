@@ -1,7 +1,7 @@
 import torch
 import os
+import sys
 from ray import tune
-from functools import partial
 
 from ray.tune import CLIReporter
 from ray.tune.schedulers import ASHAScheduler
@@ -11,8 +11,11 @@ from torch.optim.lr_scheduler import CosineAnnealingLR
 from torch.utils.data import random_split, DataLoader
 from reco.loss import FocalLoss
 
-from reco.datasetPU import TracksterPairsPU
+from reco.datasetPU import TracksterPairs, SharedPairs, event_pairs_feature_keys
 from reco.training import roc_auc, train_mlp
+from reco.performance import PerformanceMode
+from reco.quantization import quantize_model, quantization_check
+from reco.export import export_model
 
 
 def get_model(ds, config):
@@ -31,7 +34,6 @@ def get_model(ds, config):
         raise RuntimeError("Activation function %s not recognized", config["activation"])
 
     model = nn.Sequential(
-        nn.BatchNorm1d(ds.x.shape[1], affine=False),
         nn.Linear(ds.x.shape[1], hdim1),
         act(),
         nn.Linear(hdim1, hdim2),
@@ -48,31 +50,29 @@ def get_model(ds, config):
 
 
 
-def train_model(config, ds_name=None, data_root=None, raw_dir=None, checkpoint_dir=None):
+def train_model(config, data=None, checkpoint_dir=None, perf=None, normalisation=None):
 
-    print(ds_name, data_root, raw_dir)
-
-    ds = TracksterPairsPU(
-        ds_name,
-        data_root,
-        raw_dir,
-        N_FILES=464,
-        radius=10
-    )
+    # the arrays come from the ray object store, shared by all the trials
+    ds = SharedPairs(data["x"], data["y"])
     ds_size = len(ds)
 
     epochs = 50
-    model = get_model(ds, config)
     device = torch.device('cuda' if torch.cuda.is_available() else "cpu")
+    model = get_model(ds, config).to(device)
     loss_obj = FocalLoss(alpha=config["focal_alpha"], gamma=2)
 
     if config["optimizer"] == "adam":
-        optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
+        optimizer_cls = torch.optim.Adam
     elif config["optimizer"] == "sgd":
-        optimizer = torch.optim.SGD(model.parameters(), lr=config["lr"])
+        optimizer_cls = torch.optim.SGD
     else:
         raise RuntimeError("Optimizer %s not recognized", config["optimizer"])
 
+    if perf:
+        optimizer = perf.make_optimizer(optimizer_cls, model.parameters(), lr=config["lr"])
+    else:
+        optimizer = optimizer_cls(model.parameters(), lr=config["lr"])
+
     scheduler = CosineAnnealingLR(optimizer, epochs, eta_min=1e-3)
 
     test_set_size = ds_size // 10
@@ -81,16 +81,24 @@ def train_model(config, ds_name=None, data_root=None, raw_dir=None, checkpoint_d
     train_dl = DataLoader(train_set, batch_size=config["batch_size"], shuffle=True)
     val_dl = DataLoader(test_set, batch_size=config["batch_size"], shuffle=True)
 
+    run_model = perf.prepare_model(model) if perf else model
+
+    speedup = {}
+    if perf:
+        timings = perf.measure_speedup(model, next(iter(train_dl)), device, prepared=run_model)
+        speedup["speedup"] = timings["speedup"]
+
     for epoch in range(epochs):
-        loss = train_mlp(model, device, optimizer, train_dl, loss_obj)
-        val_auc = roc_auc(model, device, val_dl)
+        loss = train_mlp(run_model, device, optimizer, train_dl, loss_obj, perf=perf)
+        val_auc = roc_auc(run_model, device, val_dl, perf=perf)
         scheduler.step()
 
-        tune.report(loss=loss, auc=val_auc)
+        tune.report(loss=loss, auc=val_auc, **speedup)
 
         with tune.checkpoint_dir(epoch) as checkpoint_dir:
             path = os.path.join(checkpoint_dir, "checkpoint")
-            torch.save((model.state_dict(), optimizer.state_dict()), path)
+            # the model is trained on scaled features, keep the scaler with the weights
+            torch.save((model.state_dict(), optimizer.state_dict(), normalisation), path)
 
 
 config = {
@@ -113,7 +121,7 @@ ray_scheduler = ASHAScheduler(
 )
 
 reporter = CLIReporter(
-    metric_columns=["loss", "auc", "training_iteration"]
+    metric_columns=["loss", "auc", "training_iteration"] + (["speedup"] if "--perf" in sys.argv else [])
 )
 
 
@@ -121,8 +129,45 @@ data_root = "/Users/ecuba/devel/pattern-reco/data"
 ds_name = "CloseByGamma200PUFull"
 raw_dir = f"/Users/ecuba/data/{ds_name}"
 
+# opt-in performance mode: bfloat16 autocast, torch.compile and fused optimizer
+perf = PerformanceMode() if "--perf" in sys.argv else None
+# opt-in int8 check of the best model on pairs kept away from the trials
+quantize = "--quantize" in sys.argv
+
+# load the dataset once and publish it read-only to all the trials
+radius = 10
+ds = TracksterPairs(
+    ds_name,
+    data_root,
+    raw_dir,
+    N_FILES=464,
+    radius=radius,
+    pileup=True,
+)
+# features normalised once with the statistics collected while building the dataset,
+# so the models need no normalisation layer
+scaler = ds.feature_scaler()
+shared = SharedPairs(scaler.transform(ds.x).numpy(), ds.y.numpy())
+print(ds, file=sys.stderr)
+del ds
+
+if quantize:
+    held_out_size = len(shared) // 10
+    train_idx, held_out_idx = random_split(
+        range(len(shared)),
+        [len(shared) - held_out_size, held_out_size],
+        generator=torch.Generator().manual_seed(0),
+    )
+    held_out = SharedPairs(shared.x[held_out_idx.indices], shared.y[held_out_idx.indices])
+    shared = SharedPairs(shared.x[train_idx.indices], shared.y[train_idx.indices])
+
 result = tune.run(
-    partial(train_model, ds_name=ds_name, data_root=data_root, raw_dir=raw_dir),
+    tune.with_parameters(
+        train_model,
+        data={"x": shared.x, "y": shared.y},
+        perf=perf,
+        normalisation=scaler.normalisation,
+    ),
     config=config,
     num_samples=10,
     scheduler=ray_scheduler,
@@ -131,4 +176,29 @@ result = tune.run(
 
 best_trial = result.get_best_trial("auc", "max", "last")
 print("Best trial config: {}".format(best_trial.config))
-print("Best trial final validation auc: {}".format(best_trial.last_result["auc"]))
\ No newline at end of file
+print("Best trial final validation auc: {}".format(best_trial.last_result["auc"]))
+
+if quantize:
+    model = get_model(held_out, best_trial.config)
+    model_state, _, _ = torch.load(os.path.join(best_trial.checkpoint.value, "checkpoint"), map_location="cpu")
+    model.load_state_dict(model_state)
+
+    # dynamic int8 Linear layers (BatchNorm folded in) for the CPU reconstruction jobs
+    quantized = quantize_model(model)
+    held_out_dl = DataLoader(held_out, batch_size=4096)
+    check = quantization_check(model, held_out_dl, quantized=quantized)
+    print("Quantized model check: {}".format(check))
+
+    # frozen artefact with the feature scaler in its schema, see reco.runtime.LinkingModel
+    export_path = os.path.join(data_root, "model_mlp_pairwise.int8.ts")
+    export_model(
+        quantized,
+        export_path,
+        (torch.as_tensor(held_out.x[:1]),),
+        input_type="pairs",
+        feature_keys=event_pairs_feature_keys(),
+        normalisation=scaler.normalisation,
+        output="logit",
+        radius=radius,
+    )
+    print(export_path)
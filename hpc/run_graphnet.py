@@ -10,15 +10,14 @@ from torch.optim.lr_scheduler import CosineAnnealingLR
 
 from torch.utils.data import random_split
 from torch_geometric.loader import DataLoader
-import torch_geometric.transforms as T
 
 from reco.model import EdgeConvBlock
 
-import sklearn.metrics as metrics
-
-from reco.training import train_edge_pred, test_edge_pred, roc_auc
+from reco.training import fit_edge_pred, roc_auc
+from reco.performance import PerformanceMode
+from reco.export import export_model
 from reco.loss import FocalLoss
-from reco.datasetPU import TracksterGraphPU
+from reco.datasetPU import TracksterGraph, event_graph_feature_keys
 
 
 ds_name = "CloseByGamma200PUFull"
@@ -31,52 +30,59 @@ raw_dir = f"/mnt/ceph/users/ecuba/{ds_name}"
 device = torch.device('cuda' if torch.cuda.is_available() else "cpu")
 print(f"Using device: {device}")
 
-# %%
-def create_mask(data):
-    # extract the focus feature
-    data.mask = (1 - data.x[:,0]).type(torch.bool)
-    return data
+# opt-in performance mode: bfloat16 autocast, torch.compile and fused optimizer
+perf = PerformanceMode() if "--perf" in sys.argv else None
 
+# %%
+# the mask of the non-focus nodes is stored with the dataset
 def knn_transform(data):
     # pos coordinates are on position 3:6
     data.edge_index = knn_graph(data.x[:,3:6], k=8, loop=False)
     return data
 
-transforms = T.Compose([knn_transform, create_mask])
-
 # %%
 
-ds = TracksterGraphPU(
+ds = TracksterGraph(
     ds_name,
     data_root,
     raw_dir,
-    transform=transforms,
+    transform=knn_transform,
     N_FILES=464,
     radius=10,
+    pileup=True,
 )
 
+# features normalised with the statistics collected while building the dataset,
+# the k-NN graph is built on the raw positions
+scaler = ds.feature_scaler()
+
+def transform(data):
+    return scaler(knn_transform(data))
+
+ds.transform = transform
+
 # %%
 ds_size = len(ds)
 test_set_size = ds_size // 10
 train_set_size = ds_size - test_set_size
-train_set, test_set = random_split(ds, [train_set_size, test_set_size])
+# fixed split, so that a resumed job keeps training on the same graphs
+train_set, test_set = random_split(
+    ds,
+    [train_set_size, test_set_size],
+    generator=torch.Generator().manual_seed(42),
+)
 print(f"Train graphs: {len(train_set)}, Test graphs: {len(test_set)}")
 
 train_dl = DataLoader(train_set, batch_size=32, shuffle=True)
 test_dl = DataLoader(test_set, batch_size=32, shuffle=True)
 
 # %%
-to_predict = []
-for data in ds:
-    to_predict += data.y[data.mask].tolist()
-query_labels = np.array(to_predict)
-
-print("Labels (one per trackster minus the main trackster):", len(query_labels))
-print("Positive:", int((query_labels > 0.8).astype(int).sum()))
-print("Negative:", int((query_labels < 0.8).astype(int).sum()))
-
-# %%
-balance = float(sum(query_labels > 0.8) / len(query_labels))
+# label statistics computed when the dataset was built
+stats = ds.stats
+print("Labels (one per trackster minus the main trackster):", stats["labels"])
+balance = stats["positive_fraction"][0.8]
+print("Positive:", round(balance * stats["labels"]))
+print("Negative:", stats["labels"] - round(balance * stats["labels"]))
 print(f"dataset balance: {balance * 100:.2f}%")
 
 # %%
@@ -117,34 +123,52 @@ model_path = f"models/TracksterGraphNet.KNN.mask.skip.64.128.128.ns.{epochs}e-{d
 loss_func = FocalLoss(alpha=balance, gamma=2)
 
 model = model.to(device)
-optimizer = SGD(model.parameters(), lr=0.001, momentum=0.9, weight_decay=1e-4)
+
+if perf:
+    optimizer = perf.make_optimizer(SGD, model.parameters(), lr=0.001, momentum=0.9, weight_decay=1e-4)
+    run_model = perf.prepare_model(model)
+    perf.measure_speedup(model, next(iter(train_dl)), device, prepared=run_model)
+    model = run_model
+else:
+    optimizer = SGD(model.parameters(), lr=0.001, momentum=0.9, weight_decay=1e-4)
 scheduler = CosineAnnealingLR(optimizer, epochs, eta_min=1e-3)
 
-for epoch in range(epochs):
-
-    train_loss, train_true, train_pred = train_edge_pred(
-        model,
-        device,
-        optimizer,
-        loss_func,
-        train_dl
-    )
-
-    train_auc = metrics.roc_auc_score((train_true > 0.8).astype(int), train_pred)
-    scheduler.step()
-
-    if epoch % 10 == 0:
-        test_loss, test_true, test_pred = test_edge_pred(model, device, loss_func, test_dl)
-        test_auc = metrics.roc_auc_score((test_true > 0.8).astype(int), test_pred)
-        print(
-            f"Epoch {epoch}",
-            f"\ttrain loss:{train_loss:.3f}\ttrain auc: {train_auc:.3f}",
-            f"\t test loss:{test_loss:.3f} \t test auc: {test_auc:.3f}",
-            file=sys.stderr
-        )
+# checkpoints every 10 epochs, a rerun of the job resumes from the newest one
+history = fit_edge_pred(
+    model,
+    device,
+    optimizer,
+    loss_func,
+    train_dl,
+    test_dl,
+    epochs,
+    scheduler=scheduler,
+    checkpoint_dir=model_path.replace(".pt", ".checkpoints"),
+    checkpoint_every=10,
+    eval_every=10,
+    patience=5,
+    truth_threshold=0.8,
+    perf=perf,
+)
 
 torch.save(model.state_dict(), model_path)
 print(model_path)
 
+# %%
+# frozen artefact for the reconstruction job, see reco.runtime.LinkingModel
+sample = ds[0]
+export_path = model_path.replace(".pt", ".ts")
+export_model(
+    model,
+    export_path,
+    (sample.x, sample.edge_index),
+    feature_keys=event_graph_feature_keys(link_prediction=ds.link_prediction),
+    graph_features=True,
+    knn={"k": 8, "pos_slice": [3, 6], "loop": False},
+    normalisation=scaler.normalisation,
+    radius=ds.RADIUS,
+)
+print(export_path)
+
 # %%
 print(roc_auc(model, device, test_dl))
\ No newline at end of file
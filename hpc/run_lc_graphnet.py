@@ -10,13 +10,11 @@ from torch.optim.lr_scheduler import CosineAnnealingLR
 
 from torch.utils.data import random_split
 from torch_geometric.loader import DataLoader
-import torch_geometric.transforms as T
 
 from reco.model import EdgeConvBlock
 
-import sklearn.metrics as metrics
-
-from reco.training import train_edge_pred, test_edge_pred, roc_auc
+from reco.training import fit_edge_pred, roc_auc
+from reco.sampler import NodeBudgetBatchSampler, graph_sizes
 from reco.loss import FocalLoss
 from reco.datasetLCPU import LCGraphPU
 
@@ -35,44 +33,52 @@ def knn_transform(data):
     data.edge_index = knn_graph(data.x[:,1:4], k=8, loop=False)
     return data
 
-def create_mask(data):
-    # extract the focus feature
-    data.mask = (1 - data.x[:,0]).type(torch.bool)
-    return data
-
-transforms = T.Compose([knn_transform, create_mask])
-
 ds = LCGraphPU(
     ds_name + ".2",
     data_root,
     raw_dir,
-    transform=transforms,
+    transform=knn_transform,
     N_FILES=464,
     radius=10,
 )
 
+# features normalised with the statistics collected while building the dataset,
+# the k-NN graph is built on the raw positions
+scaler = ds.feature_scaler()
+
+def transform(data):
+    return scaler(knn_transform(data))
+
+ds.transform = transform
+
 # %%
 ds_size = len(ds)
 test_set_size = ds_size // 10
 train_set_size = ds_size - test_set_size
-train_set, test_set = random_split(ds, [train_set_size, test_set_size])
+# fixed split, so that a resumed job keeps training on the same graphs
+train_set, test_set = random_split(
+    ds,
+    [train_set_size, test_set_size],
+    generator=torch.Generator().manual_seed(42),
+)
 print(f"Train graphs: {len(train_set)}, Test graphs: {len(test_set)}")
 
-# this is very nice - handles the dimensions automatically
-train_dl = DataLoader(train_set, batch_size=32, shuffle=True)
-test_dl = DataLoader(test_set, batch_size=32, shuffle=True)
+# the graph sizes vary by orders of magnitude: fill the batches up to a node budget
+# (32 average graphs) instead of a fixed number of graphs
+train_sizes = graph_sizes(train_set)
+max_nodes = int(32 * train_sizes.mean())
+print(f"Nodes per graph: mean {train_sizes.mean():.0f}, max {train_sizes.max()}, batch budget {max_nodes}")
+
+train_dl = DataLoader(train_set, batch_sampler=NodeBudgetBatchSampler(train_sizes, max_nodes))
+test_dl = DataLoader(test_set, batch_sampler=NodeBudgetBatchSampler(graph_sizes(test_set), max_nodes, shuffle=False))
 
 # %%
 print("Labels (one per layer-cluster):", len(ds.data.y))
 
 # %%
-to_predict = []
-for data in ds:
-    to_predict += data.y[data.mask].tolist()
-
-query_labels = np.array(to_predict)
-
-balance = float(sum(query_labels > 0.8) / len(query_labels))
+# label statistics computed when the dataset was built,
+# the stored mask excludes the main trackster LCs
+balance = ds.stats["positive_fraction"][0.8]
 print(f"dataset balance: {balance * 100:.2f}% (positive labels minus main trackster LCs)")
 
 # %%
@@ -118,28 +124,22 @@ model = model.to(device)
 optimizer = SGD(model.parameters(), lr=0.001, momentum=0.9, weight_decay=1e-4)
 scheduler = CosineAnnealingLR(optimizer, epochs, eta_min=1e-3)
 
-for epoch in range(epochs):
-
-    train_loss, train_true, train_pred = train_edge_pred(
-        model,
-        device,
-        optimizer,
-        loss_func,
-        train_dl
-    )
-
-    train_auc = metrics.roc_auc_score((train_true > 0.8).astype(int), train_pred)
-    scheduler.step()
-
-    if epoch % 5 == 0:
-        test_loss, test_true, test_pred = test_edge_pred(model, device, loss_func, test_dl)
-        test_auc = metrics.roc_auc_score((test_true > 0.8).astype(int), test_pred)
-        print(
-            f"Epoch {epoch}:",
-            f"\ttrain loss:{train_loss:.2f}\ttrain auc: {train_auc:.3f}",
-            f"\t test loss:{test_loss:.2f} \t test auc: {test_auc:.3f}",
-            file=sys.stderr
-        )
+# checkpoints every 10 epochs, a rerun of the job resumes from the newest one
+history = fit_edge_pred(
+    model,
+    device,
+    optimizer,
+    loss_func,
+    train_dl,
+    test_dl,
+    epochs,
+    scheduler=scheduler,
+    checkpoint_dir=model_path.replace(".pt", ".checkpoints"),
+    checkpoint_every=10,
+    eval_every=5,
+    patience=5,
+    truth_threshold=0.8,
+)
 
 torch.save(model.state_dict(), model_path)
 
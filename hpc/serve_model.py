@@ -0,0 +1,32 @@
+import os
+
+from reco.runtime import LinkingModel
+from reco.service import InferenceService
+
+# %%
+# one warm copy of the linking model per node, shared by the evaluation jobs of the same user:
+#   from reco.service import ServiceClient
+#   model = ServiceClient(socket_path)  # reads the key from socket_path + ".key"
+#   model_evaluation(..., model, graph=True, link_prediction=True)
+model_path = "/mnt/ceph/users/ecuba/models/EdgeConvBlock.ts"
+# the per-user runtime directory is private, the socket and its key are 0600 anyway
+runtime_dir = os.environ.get("XDG_RUNTIME_DIR", "/tmp")
+socket_path = os.path.join(runtime_dir, f"reco-linking-{os.environ.get('USER', 'reco')}.sock")
+
+if os.path.exists(socket_path):
+    os.remove(socket_path)
+
+model = LinkingModel(model_path, num_threads=8)
+print(model)
+
+service = InferenceService(
+    model,
+    address=socket_path,
+    max_batch_rows=65536,
+    max_latency=0.005,
+    graph_output="edges",
+)
+
+# %%
+service.serve_forever()
+print(service.stats.as_dict())
@@ -0,0 +1,11 @@
+from reco.skim import skim_directory
+
+ds_name = "CloseByGamma200PUFull"
+raw_dir = f"/mnt/ceph/users/ecuba/{ds_name}"
+
+# the datasets read the skimmed files transparently:
+# pass the skim directory as raw_data_path
+skim_dir = f"/mnt/ceph/users/ecuba/skim/{ds_name}"
+
+skimmed = skim_directory(raw_dir, skim_dir, step_size=100)
+print(f"{len(skimmed)} files in {skim_dir}")
@@ -0,0 +1,170 @@
+import sys
+import hashlib
+from os import path
+
+import numpy as np
+import awkward as ak
+import pandas as pd
+import uproot
+
+from .data import get_event_data, is_skim, read_skim, read_tree
+from .matching import match_category
+from .datasetPU import select_bigTs
+
+
+BIGT_THRESHOLDS = (10, 20, 30, 40, 50)
+
+
+def catalog_branches(collection="SC", pileup=False):
+    """
+    The few branches needed to summarise the events
+    (with pileup, the shared energies of the bigT selection)
+    """
+    p = "" if pileup else f"sts{collection}_"
+    associations = [
+        f"tsCLUE3D_recoToSim_{collection}_score",
+        f"tsCLUE3D_simToReco_{collection}_score",
+    ]
+    if pileup:
+        associations.append(f"tsCLUE3D_recoToSim_{collection}_sharedE")
+    return {
+        "tracksters": ["raw_energy"],
+        "clusters": ["energy"],
+        f"simtracksters{collection}": [f"{p}raw_energy"],
+        "associations": associations,
+    }
+
+
+def _read_branches(source, branches):
+    if is_skim(source):
+        return read_skim(source, branches)
+    return {
+        tree: read_tree(uproot.open({source: f"ticlNtuplizer/{tree}"}), tree_branches)
+        for tree, tree_branches in branches.items()
+    }
+
+
+def _num(array):
+    return ak.to_numpy(ak.num(array, axis=1))
+
+
+def file_stem(source):
+    return path.splitext(path.basename(source))[0]
+
+
+def file_summary(source, collection="SC", pileup=False, bigT_thresholds=BIGT_THRESHOLDS, match_threshold=0.2):
+    """
+    One row per event of the file
+    """
+    p = "" if pileup else f"sts{collection}_"
+    arrays = _read_branches(source, catalog_branches(collection=collection, pileup=pileup))
+
+    raw_e = arrays["tracksters"]["raw_energy"]
+    sim_e = arrays[f"simtracksters{collection}"][f"{p}raw_energy"]
+    r2s = arrays["associations"][f"tsCLUE3D_recoToSim_{collection}_score"]
+    s2r = arrays["associations"][f"tsCLUE3D_simToReco_{collection}_score"]
+
+    n_tracksters = _num(raw_e)
+    n_simtracksters = _num(sim_e)
+
+    columns = {
+        "file": path.basename(source),
+        "entry": np.arange(len(raw_e)),
+        "n_tracksters": n_tracksters,
+        "n_simtracksters": n_simtracksters,
+        "n_lc": _num(arrays["clusters"]["energy"]),
+        "max_raw_energy": ak.to_numpy(ak.fill_none(ak.max(raw_e, axis=1), 0)),
+        "total_raw_energy": ak.to_numpy(ak.sum(raw_e, axis=1)),
+        "total_sim_energy": ak.to_numpy(ak.sum(sim_e, axis=1)),
+    }
+    # bigTs as selected by the datasets (get_file_bigTs): with pileup also the
+    # shared energy rule, a trackster counts once per simtrackster it is listed for
+    shared_e = arrays["associations"][f"tsCLUE3D_recoToSim_{collection}_sharedE"] if pileup else None
+    for th in bigT_thresholds:
+        columns[f"n_bigT_e{th}"] = _num(select_bigTs(raw_e, shared_e, energy_th=th))
+
+    columns["match"] = [
+        match_category(n_t, n_st, np.asarray(r), np.asarray(s), match_threshold=match_threshold)
+        for n_t, n_st, r, s in zip(n_tracksters, n_simtracksters, ak.to_list(r2s), ak.to_list(s2r))
+    ]
+    return pd.DataFrame(columns)
+
+
+class EventCatalog:
+    """
+    Per-event summary of a production: one row per (file, entry)
+
+    Build it once, store it next to the data and select events with a predicate,
+    the readers then only load the row ranges of the selected events:
+
+        catalog = EventCatalog.build(files).save("catalog.parquet")
+        selection = catalog.select(lambda t: (t.n_bigT_e40 > 0) & (t.match == "perfect"))
+        data = selection.read(source)
+    """
+
+    def __init__(self, table, name=None):
+        self.table = table.reset_index(drop=True)
+        self.name = name
+
+    @classmethod
+    def build(cls, files, collection="SC", pileup=False, **kwargs):
+        tables = []
+        for source in files:
+            print(f"Cataloguing: {source}", file=sys.stderr)
+            tables.append(file_summary(source, collection=collection, pileup=pileup, **kwargs))
+        return cls(pd.concat(tables, ignore_index=True))
+
+    def save(self, target_path):
+        self.table.to_parquet(target_path)
+        return self
+
+    @classmethod
+    def load(cls, source_path):
+        return cls(pd.read_parquet(source_path))
+
+    def select(self, predicate, name=None):
+        """
+        Events matching the predicate: a callable returning a row mask for the table
+        or a pandas query string, e.g. "n_bigT_e40 > 0 and n_simtracksters == 2"
+        """
+        if callable(predicate):
+            mask = predicate(self.table)
+        else:
+            mask = self.table.eval(predicate)
+        return EventCatalog(self.table[np.asarray(mask, dtype=bool)], name=name)
+
+    @property
+    def selection_name(self):
+        """
+        Name of the selection, a hash of the selected events if not given
+        """
+        if self.name:
+            return self.name
+        keys = self.table["file"].astype(str) + ":" + self.table["entry"].astype(str)
+        return hashlib.md5("\n".join(keys).encode()).hexdigest()[:8]
+
+    @property
+    def files(self):
+        return self.table["file"].unique().tolist()
+
+    def entries(self, source):
+        """
+        Sorted selected entries of the file
+        Matched by file name without the extension: the catalog of the ntuples
+        also selects the events of their skims.
+        """
+        stems = self.table["file"].astype(str).map(file_stem)
+        entries = self.table.loc[stems == file_stem(source), "entry"]
+        return np.sort(entries.to_numpy())
+
+    def read(self, source, collection="SC", pileup=False):
+        """
+        get_event_data for the selected events of the file only
+        """
+        return get_event_data(source, collection=collection, pileup=pileup, entries=self.entries(source))
+
+    def __len__(self):
+        return len(self.table)
+
+    def __repr__(self):
+        return f"<EventCatalog events={len(self)} files={len(self.files)}{f' name={self.name}' if self.name else ''}>"
@@ -1,6 +1,11 @@
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import uproot
 import numpy as np
 import awkward as ak
+import pyarrow.parquet as pq
 
 
 ARRAYS = [
@@ -33,6 +38,20 @@ FEATURE_KEYS = [
 ]
 
 
+CLUSTER_KEYS = [
+    "position_x",
+    "position_y",
+    "position_z",
+    "energy",
+    "cluster_number_of_hits",
+]
+
+
+# skimmed events: one Parquet file per ntuple, see reco.skim
+SKIM_EXTENSION = ".parquet"
+SKIM_METADATA_KEY = b"reco.skim"
+
+
 def clusters_by_indices(cluster_data, indices, eid):
     clusters_x = cluster_data["position_x"][eid]
     clusters_y = cluster_data["position_y"][eid]
@@ -47,32 +66,129 @@ def clusters_by_indices(cluster_data, indices, eid):
     return t_x, t_y, t_z, t_e
 
 
-def get_data_arrays(clusters, tracksters, simtracksters, associations, collection="SC", pileup=False):
-    trackster_data = tracksters.arrays(ARRAYS + FEATURE_KEYS + ['id_probabilities'])
-    cluster_data = clusters.arrays([
-        "position_x",
-        "position_y",
-        "position_z",
-        "energy",
-        "cluster_number_of_hits",
-    ])
-
+def event_branches(collection="SC", pileup=False):
+    """
+    Branches read by get_event_data, per ticlNtuplizer tree
+    """
     p = "" if pileup else f"sts{collection}_"
-    simtrackster_data = simtracksters.arrays([
-        f"{p}raw_energy",
-        f"{p}vertices_indexes",
-        f"{p}vertices_energy",
-        f"{p}vertices_multiplicity",
-        f"{p}barycenter_z"
-    ])
-    assoc_data = associations.arrays([
-        f"tsCLUE3D_recoToSim_{collection}",
-        f"tsCLUE3D_recoToSim_{collection}_sharedE",
-        f"tsCLUE3D_recoToSim_{collection}_score",
-    ])
+    return {
+        "clusters": CLUSTER_KEYS,
+        "tracksters": ARRAYS + FEATURE_KEYS + ['id_probabilities'],
+        f"simtracksters{collection}": [
+            f"{p}raw_energy",
+            f"{p}vertices_indexes",
+            f"{p}vertices_energy",
+            f"{p}vertices_multiplicity",
+            f"{p}barycenter_z"
+        ],
+        "associations": [
+            f"tsCLUE3D_recoToSim_{collection}",
+            f"tsCLUE3D_recoToSim_{collection}_sharedE",
+            f"tsCLUE3D_recoToSim_{collection}_score",
+        ],
+    }
+
+
+def entry_runs(entries):
+    """
+    Split sorted entries into contiguous (start, stop) ranges
+    """
+    entries = np.asarray(entries, dtype=np.int64)
+    if len(entries) == 0:
+        return []
+    breaks = np.where(np.diff(entries) != 1)[0] + 1
+    starts = entries[np.concatenate(([0], breaks))]
+    stops = entries[np.concatenate((breaks - 1, [len(entries) - 1]))] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def read_tree(tree, branches, entries=None, **options):
+    """
+    Read the branches of a TTree, only the given (sorted) entries when set
+    options: passed to uproot, e.g. decompression_executor
+    """
+    if entries is None:
+        return tree.arrays(branches, **options)
+    runs = entry_runs(entries)
+    if not runs:
+        return tree.arrays(branches, entry_start=0, entry_stop=0, **options)
+    parts = [tree.arrays(branches, entry_start=start, entry_stop=stop, **options) for start, stop in runs]
+    return parts[0] if len(parts) == 1 else ak.concatenate(parts)
+
+
+def get_data_arrays(
+        clusters,
+        tracksters,
+        simtracksters,
+        associations,
+        collection="SC",
+        pileup=False,
+        entries=None,
+        executor=None
+    ):
+    branches = event_branches(collection=collection, pileup=pileup)
+    options = {} if executor is None else {"decompression_executor": executor}
+    trackster_data = read_tree(tracksters, branches["tracksters"], entries=entries, **options)
+    cluster_data = read_tree(clusters, branches["clusters"], entries=entries, **options)
+    simtrackster_data = read_tree(simtracksters, branches[f"simtracksters{collection}"], entries=entries, **options)
+    assoc_data = read_tree(associations, branches["associations"], entries=entries, **options)
     return cluster_data, trackster_data, simtrackster_data, assoc_data
 
 
+def is_skim(source):
+    return source.endswith(SKIM_EXTENSION)
+
+
+def is_data_file(source):
+    """
+    An ntuple or a skim, not a leftover (e.g. a .tmp of a killed skim job)
+    """
+    return source.endswith(".root") or is_skim(source)
+
+
+def skim_column(tree, branch):
+    return f"{tree}/{branch}"
+
+
+def skim_metadata(source):
+    """
+    Branches and event index stored in a skimmed file
+    """
+    return json.loads(pq.read_schema(source).metadata[SKIM_METADATA_KEY])
+
+
+def read_skim(source, branches, row_groups=None, entries=None):
+    """
+    Read {tree: [branches]} from a skimmed file, only the requested columns are decoded
+    Returns {tree: array of records} like the uproot `arrays` call
+
+    row_groups: read only these row groups (see skim_metadata for the event ranges)
+    entries: read only these events, decoding just the row groups containing them
+    """
+    columns = [skim_column(tree, b) for tree, tree_branches in branches.items() for b in tree_branches]
+    parquet_file = pq.ParquetFile(source)
+
+    if entries is not None:
+        entries = np.unique(np.asarray(entries, dtype=np.int64))
+        starts = np.array(skim_metadata(source)["row_group_starts"], dtype=np.int64)
+        row_groups = np.unique(np.searchsorted(starts, entries, side="right") - 1).tolist()
+        columns = ["entry"] + columns
+
+    if row_groups is None:
+        table = parquet_file.read(columns=columns)
+    else:
+        table = parquet_file.read_row_groups(row_groups, columns=columns)
+
+    arrays = ak.from_arrow(table)
+    if entries is not None:
+        arrays = arrays[np.isin(ak.to_numpy(arrays["entry"]), entries)]
+
+    return {
+        tree: ak.zip({b: arrays[skim_column(tree, b)] for b in tree_branches}, depth_limit=1)
+        for tree, tree_branches in branches.items()
+    }
+
+
 def get_bary_data(trackster_data, _eid):
     return np.array([
         trackster_data["barycenter_x"][_eid],
@@ -81,7 +197,25 @@ def get_bary_data(trackster_data, _eid):
     ]).T
 
 
-def get_event_data(source, collection="SC", pileup=False):
+def get_event_data(source, collection="SC", pileup=False, entries=None, executor=None):
+    """
+    Read the event arrays of an ntuple or a skimmed file
+
+    entries: sorted event numbers to read (e.g. from an EventCatalog selection),
+        only their row ranges are read; the returned arrays are indexed
+        by position in `entries`
+    executor: uproot executor decompressing the baskets of the ntuples
+        (skims are decoded on the pyarrow thread pool)
+    """
+    if is_skim(source):
+        data = read_skim(source, event_branches(collection=collection, pileup=pileup), entries=entries)
+        return (
+            data["clusters"],
+            data["tracksters"],
+            data[f"simtracksters{collection}"],
+            data["associations"],
+        )
+
     tracksters = uproot.open({source: "ticlNtuplizer/tracksters"})
     simtracksters = uproot.open({source: f"ticlNtuplizer/simtracksters{collection}"})
     associations = uproot.open({source: "ticlNtuplizer/associations"})
@@ -92,10 +226,98 @@ def get_event_data(source, collection="SC", pileup=False):
         simtracksters,
         associations,
         collection=collection,
-        pileup=pileup
+        pileup=pileup,
+        entries=entries,
+        executor=executor,
     )
 
 
+def _nbytes(result):
+    if isinstance(result, (tuple, list)):
+        return sum(_nbytes(r) for r in result)
+    if isinstance(result, dict):
+        return sum(_nbytes(r) for r in result.values())
+    return getattr(result, "nbytes", 0)
+
+
+def prefetch(sources, read, depth=2, max_bytes=None):
+    """
+    Yield (source, read(source)) in order, reading the next files in the background
+
+    Up to `depth` files are read on a thread pool while the current one is
+    processed, so at most depth + 1 files are in memory. With max_bytes set,
+    no new read starts while the files already read ahead exceed it.
+    Reading a file is mostly decompression, which runs outside the GIL.
+    """
+    sources = list(sources)
+    if depth < 1:
+        for source in sources:
+            yield source, read(source)
+        return
+
+    pool = ThreadPoolExecutor(max_workers=depth)
+    queue = deque()
+    upcoming = iter(sources)
+
+    def fill():
+        while len(queue) < depth:
+            if max_bytes is not None and queue:
+                ready = sum(_nbytes(f.result()) for _, f in queue if f.done() and f.exception() is None)
+                if ready >= max_bytes:
+                    return
+            source = next(upcoming, None)
+            if source is None:
+                return
+            queue.append((source, pool.submit(read, source)))
+
+    try:
+        fill()
+        while queue:
+            source, future = queue.popleft()
+            result = future.result()
+            fill()
+            yield source, result
+    finally:
+        # stopped early: drop the reads not started yet
+        for _, future in queue:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def prefetch_event_data(
+        files,
+        collection="SC",
+        pileup=False,
+        entries=None,
+        depth=2,
+        max_bytes=None,
+        decompression_workers=2
+    ):
+    """
+    get_event_data over the files, the next `depth` files read in the background
+    Yields (source, (cluster_data, trackster_data, simtrackster_data, assoc_data))
+
+    entries: {source: entries} to read only selected events (see get_event_data)
+    decompression_workers: threads decompressing the baskets of each ntuple
+    """
+    executor = uproot.ThreadPoolExecutor(decompression_workers) if decompression_workers else None
+
+    def read(source):
+        return get_event_data(
+            source,
+            collection=collection,
+            pileup=pileup,
+            entries=None if entries is None else entries[source],
+            executor=executor,
+        )
+
+    try:
+        yield from prefetch(files, read, depth=depth, max_bytes=max_bytes)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
 def get_lc_data(cluster_data, trackster_data, _eid):
     # this is not an entirely fair comparison:
     # the LC level methods should use sim LCs not only the CLUE3D ones
@@ -1,4 +1,5 @@
 import sys
+import pickle
 import torch
 import uproot
 import random
@@ -13,6 +14,7 @@ from .data import FEATURE_KEYS
 from .event import get_bary, get_candidate_pairs_direct, remap_tracksters, get_candidate_pairs_little_big_planear
 from .matching import match_best_simtrackster_direct, find_good_pairs_direct
 from .distance import euclidian_distance, apply_map
+from .layers import LayerMap
 
 from .graphs import create_graph
 from .features import get_graph_level_features
@@ -68,18 +70,80 @@ def match_trackster_pairs_direct(
 
     return pairs
 
-def match_trackster_pairs(
-    tracksters,
-    simtracksters,
-    associations,
-    eid,
+def pair_distance_table(raw_e, raw_st, dst_func, s2ri, s2r_SE):
+    """
+    Threshold independent part of match_trackster_pairs_direct
+
+    Returns the best simtrackster match of each trackster and the distances
+    between all tracksters matched to the same simtrackster,
+    as (little, big) pairs sorted by little then big index.
+    """
+    reco_fr, reco_st = match_best_simtrackster_direct(raw_e, s2ri, s2r_SE)
+    reco_st = np.array(reco_st, dtype=int)
+    same_particle_tracksters = [np.where(reco_st == st)[0] for st in range(len(raw_st))]
+
+    little, big, dist = [], [], []
+    known = {}
+    for tt_id in range(len(raw_e) if len(raw_st) else 0):
+        # an unmatched trackster (-1) takes the last simtrackster, as in match_trackster_pairs_direct
+        others = same_particle_tracksters[reco_st[tt_id]]
+        others = others[others != tt_id]
+        if not len(others):
+            continue
+
+        # distances are symmetric, only compute the missing ones
+        missing = [o for o in others if (o, tt_id) not in known]
+        for o, d in zip(missing, dst_func(tt_id, missing) if missing else []):
+            known[(tt_id, o)] = d
+
+        for o in others:
+            little.append(tt_id)
+            big.append(o)
+            dist.append(known[(tt_id, o)] if (tt_id, o) in known else known[(o, tt_id)])
+
+    return {
+        "raw_e": np.array(raw_e),
+        "reco_fr": np.array(reco_fr, dtype=float),
+        "reco_st": reco_st,
+        "little": np.array(little, dtype=int),
+        "big": np.array(big, dtype=int),
+        "dist": np.array(dist, dtype=float),
+    }
+
+
+def filter_trackster_pairs(
+    truth,
     energy_threshold=10,
-    distance_type="pairwise",
-    distance_threshold=10,
     confidence_threshold=0.5,
-    best_only=True,
-    z_map=None
+    distance_threshold=10,
+    best_only=True
 ):
+    """
+    Select the pairs of match_trackster_pairs_direct from a pair_distance_table
+    """
+    raw_e = truth["raw_e"]
+    little, big, dist = truth["little"], truth["big"], truth["dist"]
+
+    sel = (
+        (raw_e[little] <= energy_threshold)
+        & (raw_e[big] > energy_threshold)
+        & (truth["reco_fr"][little] >= confidence_threshold)
+    )
+    little, big, dist = little[sel], big[sel], dist[sel]
+
+    if best_only:
+        # closest big trackster per little one, the lowest index on ties
+        order = np.lexsort((big, dist, little))
+        little, big, dist = little[order], big[order], dist[order]
+        first = np.ones(len(little), dtype=bool)
+        first[1:] = little[1:] != little[:-1]
+        little, big, dist = little[first], big[first], dist[first]
+
+    keep = dist < distance_threshold
+    return [[l, b, d] for l, b, d in zip(little[keep].tolist(), big[keep].tolist(), dist[keep].tolist())]
+
+
+def _event_matching_inputs(tracksters, simtracksters, associations, eid, distance_type, z_map):
     raw_e = tracksters["raw_energy"].array()[eid]
     raw_st = simtracksters["stsSC_raw_energy"].array()[eid]
 
@@ -90,12 +154,13 @@ def match_trackster_pairs(
     if distance_type == "pairwise":
         vx = tracksters["vertices_x"].array()[eid]
         vy = tracksters["vertices_y"].array()[eid]
-        vz = tracksters["vertices_z"].array()[eid]
+        # map the whole event to layers at once
+        vz = apply_map(tracksters["vertices_z"].array()[eid], z_map, factor=2)
         clouds = [
             np.array([
                 vx[tid],
                 vy[tid],
-                apply_map(vz[tid], z_map, factor=2)
+                vz[tid],
             ]).T for tid in range(len(raw_e))
         ]
         dst_func = _pairwise_func(clouds)
@@ -105,6 +170,129 @@ def match_trackster_pairs(
     else:
         raise RuntimeError("Distance type '%s' not supported", distance_type)
 
+    return raw_e, raw_st, dst_func, s2ri, s2r_SE
+
+
+class GroundTruthCache:
+    """
+    Per-event matching and distance tables, keyed by (file, event id, distance type)
+
+    The expensive part of the ground truth (reading the event, matching
+    tracksters to simtracksters, point cloud distances) is computed once,
+    threshold variations only rerun filter_trackster_pairs.
+    The z_map of the first event is kept, a different one raises ValueError.
+
+    The model evaluation samples (model_evaluation, model_threshold_scan cache=)
+    are kept in memory only, keyed by the caller.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.samples = {}
+        self.z_map = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _source(tree):
+        try:
+            return tree.file.file_path
+        except AttributeError:
+            return id(tree)
+
+    def _check_z_map(self, z_map):
+        if not self.events:
+            self.z_map = z_map
+            return
+        if z_map is self.z_map:
+            return
+        if (
+            isinstance(z_map, LayerMap) and isinstance(self.z_map, LayerMap)
+            and z_map.truncate == self.z_map.truncate
+            and np.array_equal(z_map.z, self.z_map.z)
+            and np.array_equal(z_map.layers, self.z_map.layers)
+        ):
+            return
+        raise ValueError("GroundTruthCache was filled with a different z_map")
+
+    def event(self, tracksters, simtracksters, associations, eid, distance_type="pairwise", z_map=None):
+        self._check_z_map(z_map)
+        key = (self._source(tracksters), eid, distance_type)
+        if key in self.events:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.events[key] = pair_distance_table(
+                *_event_matching_inputs(tracksters, simtracksters, associations, eid, distance_type, z_map)
+            )
+        return self.events[key]
+
+    def event_samples(self, key, build):
+        """
+        Samples of an event, build() is called on the first request of the key
+        """
+        if key in self.samples:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.samples[key] = build()
+        return self.samples[key]
+
+    def save(self, target_path):
+        with open(target_path, "wb") as f:
+            pickle.dump({"events": self.events, "z_map": self.z_map}, f)
+
+    @classmethod
+    def load(cls, source_path):
+        cache = cls()
+        with open(source_path, "rb") as f:
+            state = pickle.load(f)
+        cache.events = state["events"]
+        cache.z_map = state["z_map"]
+        return cache
+
+    def __len__(self):
+        return len(self.events)
+
+    def __repr__(self):
+        return f"<GroundTruthCache events={len(self)} hits={self.hits} misses={self.misses}>"
+
+
+def match_trackster_pairs(
+    tracksters,
+    simtracksters,
+    associations,
+    eid,
+    energy_threshold=10,
+    distance_type="pairwise",
+    distance_threshold=10,
+    confidence_threshold=0.5,
+    best_only=True,
+    z_map=None,
+    cache=None,
+):
+    """
+    cache: GroundTruthCache to reuse the matching and distances of the event
+    """
+    if cache is not None:
+        truth = cache.event(tracksters, simtracksters, associations, eid, distance_type=distance_type, z_map=z_map)
+        return filter_trackster_pairs(
+            truth,
+            energy_threshold=energy_threshold,
+            confidence_threshold=confidence_threshold,
+            distance_threshold=distance_threshold,
+            best_only=best_only,
+        )
+
+    raw_e, raw_st, dst_func, s2ri, s2r_SE = _event_matching_inputs(
+        tracksters,
+        simtracksters,
+        associations,
+        eid,
+        distance_type,
+        z_map,
+    )
+
     return match_trackster_pairs_direct(
         raw_e,
         raw_st,
@@ -127,7 +315,8 @@ def get_ground_truth(
         distance_type="pairwise",
         distance_threshold=10,
         confidence_threshold=0.5,
-        z_map=None
+        z_map=None,
+        cache=None,
     ):
 
     e_pairs = match_trackster_pairs(
@@ -140,6 +329,7 @@ def get_ground_truth(
         distance_threshold=distance_threshold,
         confidence_threshold=confidence_threshold,
         z_map=z_map,
+        cache=cache,
     )
 
     merge_map = {little: big for little, big, _ in e_pairs}
@@ -216,8 +406,9 @@ class D_TracksterGraph(InMemoryDataset):
                 ve = tracksters["vertices_energy"].array()[eid]
                 vi = tracksters["vertices_indexes"].array()[eid]
 
+                vz_layers = apply_map(vz, self.z_map, factor=2)
                 clouds = [
-                    np.array([vx[tid], vy[tid], apply_map(vz[tid], self.z_map, factor=2)]).T
+                    np.array([vx[tid], vy[tid], vz_layers[tid]]).T
                     for tid in range(len(vx))
                 ]
 
@@ -524,9 +715,9 @@ class PointCloudSet(InMemoryDataset):
             sim2reco_shared_energy_e = associations["tsCLUE3D_simToReco_SC_sharedE"].array()
 
 
-            z_set = set(ak.flatten(vz_e, axis=None))
-            z_list = list(sorted(z_set))
-            z_map = {z: i for i, z in enumerate(z_list)}
+            # layer of every LC in the file, mapped at once
+            z_map = LayerMap.from_z(vz_e)
+            lz_e = z_map(vz_e)
 
             overlap = 1
 
@@ -536,19 +727,16 @@ class PointCloudSet(InMemoryDataset):
                 raw_energy, inners = re_e[eid], li_e[eid]
                 sim2reco_indices, sim2reco_shared_energy  = sim2reco_indices_e[eid], sim2reco_shared_energy_e[eid]
 
-                # compute coordinate clouds and layer ranges
-                xy_clouds = [np.array((x, x)).T for x, y in zip(vx, vy)]
-                layers = [apply_map(list(set(z.tolist())), z_map) for z in vz]
-                ranges = [(min(x) - overlap, max(x) + overlap) for x in layers]
-
-                # find edge candidates
-                candidate_pairs = get_candidate_pairs_little_big_planear(
-                    xy_clouds,
-                    ranges,
+                # find edge candidates: xy distance on the (almost) common layers
+                candidate_pairs, _, _ = get_candidate_pairs_little_big_planear(
+                    vx,
+                    vy,
+                    lz_e[eid],
                     inners,
                     raw_energy,
                     max_distance=self.MAX_DISTANCE,
                     energy_threshold=self.ENERGY_THRESHOLD,
+                    overlap=overlap,
                 )
 
                 if len(candidate_pairs) == 0:
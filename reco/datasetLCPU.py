@@ -8,10 +8,55 @@ import awkward as ak
 import numpy as np
 from torch_geometric.data import Data, InMemoryDataset
 
+from .data import prefetch, is_data_file, is_skim, read_skim
 from .datasetPU import get_major_PU_tracksters, get_trackster_representative_points, get_tracksters_in_cone
-
-
-class LCGraphPU(InMemoryDataset):
+from .stats import GraphStatsMixin, RunningStats, add_focus_mask, graph_dataset_stats
+
+
+LC_BRANCHES = {
+    "associations": [
+        "tsCLUE3D_recoToSim_SC",
+        "tsCLUE3D_recoToSim_SC_sharedE",
+        "tsCLUE3D_recoToSim_SC_score",
+    ],
+    "tracksters": [
+        "barycenter_x",
+        "barycenter_y",
+        "barycenter_z",
+        "vertices_indexes",
+    ],
+    "clusters": [
+        "position_x",
+        "position_y",
+        "position_z",
+        "energy",
+        "position_eta",
+        "position_phi",
+        "cluster_local_density",
+        "cluster_layer_id",
+        "cluster_radius",
+    ],
+    "simtrackstersSC": [
+        "stsSC_raw_energy"
+    ],
+}
+
+
+def read_lc_data(source):
+    """
+    Arrays read by LCGraphPU from one ntuple or skimmed file
+    """
+    if is_skim(source):
+        data = read_skim(source, LC_BRANCHES)
+    else:
+        data = {
+            tree: uproot.open({source: f"ticlNtuplizer/{tree}"}).arrays(branches)
+            for tree, branches in LC_BRANCHES.items()
+        }
+    return data["clusters"], data["tracksters"], data["simtrackstersSC"], data["associations"]
+
+
+class LCGraphPU(GraphStatsMixin, InMemoryDataset):
     # about 200kb per file
 
     def __init__(
@@ -25,6 +70,7 @@ class LCGraphPU(InMemoryDataset):
             N_FILES=None,
             radius=10,
             score_threshold=0.2,
+            prefetch=2,
         ):
         self.name = name
         self.N_FILES = N_FILES
@@ -32,14 +78,18 @@ class LCGraphPU(InMemoryDataset):
         self.root_dir = root_dir
         self.RADIUS = radius
         self.SCORE_THRESHOLD = score_threshold
+        self.prefetch = prefetch
         super(LCGraphPU, self).__init__(root_dir, transform, pre_transform, pre_filter)
         self.data, self.slices = torch.load(self.processed_paths[0])
+        if "mask" not in self.slices:
+            # datasets processed without the stored mask
+            add_focus_mask(self.data, self.slices)
 
     @property
     def raw_file_names(self):
         files = []
         for (_, _, filenames) in walk(self.raw_data_path):
-            files.extend(filenames)
+            files.extend(f for f in filenames if is_data_file(f))
             break
         full_paths = list([path.join(self.raw_data_path, f) for f in files])
         if self.N_FILES:
@@ -62,44 +112,12 @@ class LCGraphPU(InMemoryDataset):
 
     def process(self):
         data_list = []
+        feature_stats = RunningStats()
 
-        for source in self.raw_file_names:
+        event_data = prefetch(self.raw_file_names, read_lc_data, depth=self.prefetch)
+        for source, (cluster_data, trackster_data, simtrackster_data, assoc_data) in event_data:
             print(source, file=sys.stderr)
 
-            tracksters = uproot.open({source: "ticlNtuplizer/tracksters"})
-            associations = uproot.open({source: "ticlNtuplizer/associations"})
-            simtracksters = uproot.open({source: "ticlNtuplizer/simtrackstersSC"})
-            clusters = uproot.open({source: "ticlNtuplizer/clusters"})
-
-            assoc_data = associations.arrays([
-                "tsCLUE3D_recoToSim_SC",
-                "tsCLUE3D_recoToSim_SC_sharedE",
-                "tsCLUE3D_recoToSim_SC_score",
-            ])
-
-            trackster_data = tracksters.arrays([
-                "barycenter_x",
-                "barycenter_y",
-                "barycenter_z",
-                "vertices_indexes",
-            ])
-
-            cluster_data = clusters.arrays([
-                "position_x",
-                "position_y",
-                "position_z",
-                "energy",
-                "position_eta",
-                "position_phi",
-                "cluster_local_density",
-                "cluster_layer_id",
-                "cluster_radius",
-            ])
-
-            simtrackster_data = simtracksters.arrays([
-                "stsSC_raw_energy"
-            ])
-
             for eid in range(len(trackster_data["barycenter_x"])):
 
                 # get LC info
@@ -183,14 +201,18 @@ class LCGraphPU(InMemoryDataset):
                 # index is unique per event
                 tr_indexes = ak.flatten(list([i] * len(vertices_z[idx]) for i, idx in enumerate(indexes)))
 
+                x = torch.tensor([ak.flatten(f) for f in features]).T
+                feature_stats.update(x)
                 data_list.append(Data(
-                    x=torch.tensor([ak.flatten(f) for f in features]).T,
+                    x=x,
                     y=torch.tensor(lc_labels),
                     trackster_index=torch.tensor(tr_indexes, dtype=torch.int64),
                 ))
 
         data, slices = self.collate(data_list)
+        add_focus_mask(data, slices)
         torch.save((data, slices), self.processed_paths[0])
+        self.save_stats(graph_dataset_stats(data, slices, features=feature_stats))
 
     def __repr__(self):
         infos = [
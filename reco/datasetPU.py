@@ -8,9 +8,41 @@ import numpy as np
 from torch.utils.data import Dataset
 from torch_geometric.data import Data, InMemoryDataset
 
-from .features import get_graph_level_features, get_min_max_z_points
+from .features import get_graph_level_features, get_min_max_z_points, GRAPH_FEATURE_KEYS
 from .graphs import create_graph
-from .data import get_event_data, FEATURE_KEYS, get_bary_data
+from .data import prefetch_event_data, FEATURE_KEYS, get_bary_data, is_data_file
+from .stats import (
+    DatasetStatsMixin,
+    GraphStatsMixin,
+    RunningStats,
+    add_focus_mask,
+    graph_dataset_stats,
+    pair_dataset_stats,
+    stats_file,
+)
+
+
+# particle types of the TICL id_probabilities, in order
+ID_PROBABILITY_KEYS = [
+    "photon",
+    "electron",
+    "muon",
+    "neutral_pion",
+    "charged_hadron",
+    "neutral_hadron",
+    "ambiguous",
+    "unknown",
+]
+
+
+def _id_probability_keys(prefix, n_id_probabilities):
+    if n_id_probabilities == len(ID_PROBABILITY_KEYS):
+        return [f"{prefix}id_{k}" for k in ID_PROBABILITY_KEYS]
+    return [f"{prefix}id_probabilities_{i}" for i in range(n_id_probabilities)]
+
+
+def _point_keys(name):
+    return [f"{name}_{c}" for c in "xyz"]
 
 
 def build_pair_tensor(edge, features):
@@ -34,7 +66,13 @@ def get_trackster_representative_points(bx, by, bz, min_z, max_z):
     return x1, x2
 
 
-def get_tracksters_in_cone(x1, x2, barycentres, radius=10):
+def get_tracksters_in_cone(x1, x2, barycentres, radius=10, with_cone=False):
+    """
+    Tracksters with the barycentre in the cylinder of the given radius around the axis x1-x2
+    Returns [(index, distance from the axis)],
+        with_cone: [(index, distance, cone distance)]
+    The cone distance is the smallest radius the trackster is selected with (see cone_distance).
+    """
     in_cone = []
     for i, x0 in enumerate(barycentres):
         # barycenter between the first and last layer
@@ -42,10 +80,18 @@ def get_tracksters_in_cone(x1, x2, barycentres, radius=10):
             # distance from the particle axis less than X cm
             d = np.linalg.norm(np.cross(x0 - x1, x0 - x2)) / np.linalg.norm(x2 - x1)
             if d < radius:
-                in_cone.append((i, d))
+                in_cone.append((i, d, cone_distance(x0, x1, x2, d)) if with_cone else (i, d))
     return in_cone
 
 
+def cone_distance(x0, x1, x2, d):
+    """
+    The trackster is in the cone of radius r iff cone_distance < r:
+        the axis distance and how far the barycentre is before x1 or after x2 in z
+    """
+    return max(d, x1[2] - x0[2], x0[2] - x2[2])
+
+
 def get_major_PU_tracksters(
     reco2sim_sharedE,
     raw_energy,
@@ -70,27 +116,51 @@ def get_major_PU_tracksters(
     return big
 
 
-def get_bigTs(trackster_data, assoc_data, eid, pileup=False, energy_th=50, collection="SC"):
-    if pileup:
-        # get associations data
-        # reco2sim_index = assoc_data[f"tsCLUE3D_recoToSim_{collection}"][eid]
-        # p = "" if pileup else f"sts{collection}_"
-        # sim_bary_z = simtrackster_data[f"{p}barycenter_z"][eid]
-        reco2sim_sharedE = assoc_data[f"tsCLUE3D_recoToSim_{collection}_sharedE"][eid]
-        raw_energy = trackster_data["raw_energy"][eid]
-
-        # select only tracksters for which simdata is available
-        bigTs = get_major_PU_tracksters(
-            reco2sim_sharedE,
-            raw_energy,
-        )
-        return np.array(bigTs)[raw_energy[bigTs] > energy_th].tolist()
+def select_bigTs(raw_energy, reco2sim_sharedE=None, energy_th=50, fraction_threshold=0.5):
+    """
+    Indices of the big tracksters, of one event or of all events of a file at once (jagged)
+        raw_energy > energy_th
+        pileup (with reco2sim_sharedE): sharing more than fraction_threshold
+            of the energy with a simtrackster (see get_major_PU_tracksters)
+
+    Computed with awkward broadcasting over the whole array.
+    """
+    raw_energy = raw_energy if isinstance(raw_energy, ak.Array) else ak.Array(raw_energy)
+    index = ak.local_index(raw_energy, axis=-1)
+    selected = raw_energy > energy_th
+    if reco2sim_sharedE is None:
+        return index[selected]
+
+    # in double precision, as the fractions of get_major_PU_tracksters
+    fraction = (
+        ak.values_astype(reco2sim_sharedE, np.float64)
+        / ak.values_astype(raw_energy, np.float64)[..., np.newaxis]
+    )
+    # a trackster is listed once per simtrackster it is the major part of
+    counts = ak.where(selected, ak.sum(fraction > fraction_threshold, axis=-1), 0)
+    big = np.repeat(
+        ak.to_numpy(ak.flatten(index, axis=None)),
+        ak.to_numpy(ak.flatten(counts, axis=None)),
+    )
+    if raw_energy.ndim == 1:
+        return ak.Array(big)
+    return ak.unflatten(big, ak.to_numpy(ak.sum(counts, axis=-1)))
+
 
-    # select tracksters above 50GeV
-    return np.nonzero(trackster_data["raw_energy"][eid] > energy_th)[0].tolist()
+def get_file_bigTs(trackster_data, assoc_data, pileup=False, energy_th=50, collection="SC"):
+    """
+    Big trackster indices of all events of a file (events x bigTs)
+    """
+    shared_e = assoc_data[f"tsCLUE3D_recoToSim_{collection}_sharedE"] if pileup else None
+    return select_bigTs(trackster_data["raw_energy"], shared_e, energy_th=energy_th)
 
 
-def get_neighborhood(trackster_data, vertices_z, eid, radius, bigT):
+def get_bigTs(trackster_data, assoc_data, eid, pileup=False, energy_th=50, collection="SC"):
+    shared_e = assoc_data[f"tsCLUE3D_recoToSim_{collection}_sharedE"][eid] if pileup else None
+    return select_bigTs(trackster_data["raw_energy"][eid], shared_e, energy_th=energy_th).tolist()
+
+
+def get_neighborhood(trackster_data, vertices_z, eid, radius, bigT, with_cone=False):
 
     # get trackster info
     barycenter_x = trackster_data["barycenter_x"][eid]
@@ -105,7 +175,7 @@ def get_neighborhood(trackster_data, vertices_z, eid, radius, bigT):
         max(vertices_z[bigT])
     )
     barycentres = np.array((barycenter_x, barycenter_y, barycenter_z)).T
-    return get_tracksters_in_cone(x1, x2, barycentres, radius=radius)
+    return get_tracksters_in_cone(x1, x2, barycentres, radius=radius, with_cone=with_cone)
 
 
 
@@ -118,10 +188,18 @@ def get_event_pairs(
         pileup=False,
         bigT_e_th=50,
         collection="SC",
+        return_cone=False,
+        bigTs=None,
     ):
-
+    """
+    Features, labels and (little, big) indices of the pairs in the bigT cones
+    return_cone: also return the cone distance of every pair,
+        the pairs of a smaller radius r are those with cone distance < r
+    bigTs: big tracksters of the event, e.g. get_file_bigTs(...)[eid]
+    """
     dataset_X = []
     dataset_Y = []
+    dataset_C = []
     pair_index = []
 
     # get LC info
@@ -141,14 +219,15 @@ def get_event_pairs(
     # add id probabilities
     id_probs = trackster_data["id_probabilities"][eid].tolist()
 
-    bigTs = get_bigTs(
-        trackster_data,
-        assoc_data,
-        eid,
-        pileup=pileup,
-        energy_th=bigT_e_th,
-        collection=collection
-    )
+    if bigTs is None:
+        bigTs = get_bigTs(
+            trackster_data,
+            assoc_data,
+            eid,
+            pileup=pileup,
+            energy_th=bigT_e_th,
+            collection=collection
+        )
 
     trackster_features = list([
         trackster_data[k][eid] for k in FEATURE_KEYS
@@ -169,9 +248,9 @@ def get_event_pairs(
         # figure out which simtrackster it is
         bigT_simT_idx = reco2sim_idx[bigT][bigT_best_score_idx]
 
-        in_cone = get_neighborhood(trackster_data, vertices_z, eid, radius, bigT)
+        in_cone = get_neighborhood(trackster_data, vertices_z, eid, radius, bigT, with_cone=True)
 
-        for recoTxId, distance in in_cone:
+        for recoTxId, distance, cone in in_cone:
 
             if recoTxId == bigT:
                 # do not connect to itself
@@ -208,11 +287,39 @@ def get_event_pairs(
 
             dataset_X.append(features)
             dataset_Y.append(label)
+            dataset_C.append(cone)
             pair_index.append((recoTxId, bigT))
 
+    if return_cone:
+        return dataset_X, dataset_Y, pair_index, dataset_C
     return dataset_X, dataset_Y, pair_index
 
 
+def event_pairs_feature_keys(n_id_probabilities=len(ID_PROBABILITY_KEYS)):
+    """
+    Names of the feature columns of get_event_pairs, bigT first
+    """
+    keys = [f"bigT_{k}" for k in FEATURE_KEYS] + FEATURE_KEYS
+    keys += _point_keys("bigT_minP") + _point_keys("bigT_maxP")
+    keys += _point_keys("minP") + _point_keys("maxP")
+    keys += _id_probability_keys("bigT_", n_id_probabilities)
+    keys += _id_probability_keys("", n_id_probabilities)
+    keys += ["distance", "bigT_nLC", "nLC"]
+    return keys
+
+
+def event_graph_feature_keys(link_prediction=False, n_id_probabilities=len(ID_PROBABILITY_KEYS)):
+    """
+    Names of the node feature columns (x) of get_event_graph
+    """
+    keys = [] if link_prediction else ["focus", "distance"]
+    keys += ["nLC"] + FEATURE_KEYS
+    keys += _point_keys("minP") + _point_keys("maxP")
+    keys += _id_probability_keys("", n_id_probabilities)
+    keys += GRAPH_FEATURE_KEYS
+    return keys
+
+
 def get_event_graph(
         cluster_data,
         trackster_data,
@@ -223,6 +330,7 @@ def get_event_graph(
         pileup=False,
         collection="SC",
         link_prediction=False,
+        bigTs=None,
     ):
     data_list = []
 
@@ -250,14 +358,15 @@ def get_event_graph(
     reco2sim_idx = assoc_data[f"tsCLUE3D_recoToSim_{collection}"][eid]
     reco2sim_shared_e = assoc_data[f"tsCLUE3D_recoToSim_{collection}_sharedE"][eid]
 
-    bigTs = get_bigTs(
-        trackster_data,
-        assoc_data,
-        eid,
-        pileup=pileup,
-        energy_th=bigT_e_th,
-        collection=collection,
-    )
+    if bigTs is None:
+        bigTs = get_bigTs(
+            trackster_data,
+            assoc_data,
+            eid,
+            pileup=pileup,
+            energy_th=bigT_e_th,
+            collection=collection,
+        )
 
     trackster_features = list([
         trackster_data[k][eid] for k in FEATURE_KEYS
@@ -270,6 +379,7 @@ def get_event_graph(
     node_eng = []
     node_shared_e = []
     node_simT_idx = []
+    node_cone = []
     bigT_index = []
     index_map = {}
     edge_labels = []
@@ -284,6 +394,7 @@ def get_event_graph(
             node_eng = []
             node_shared_e = []
             node_simT_idx = []
+            node_cone = []
 
         # find index of the best score
         bigT_best_score_idx = np.argmin(reco2sim_score[bigT])
@@ -293,8 +404,8 @@ def get_event_graph(
         # get the best score
         bigT_best_score = reco2sim_score[bigT][bigT_best_score_idx]
 
-        in_cone = get_neighborhood(trackster_data, vertices_z, eid, radius, bigT)
-        for recoTxId, distance in in_cone:
+        in_cone = get_neighborhood(trackster_data, vertices_z, eid, radius, bigT, with_cone=True)
+        for recoTxId, distance, cone in in_cone:
 
             # find out the index of the simpartice we are looking for
             recoTx_bigT_simT_idx = np.argwhere(reco2sim_idx[recoTxId] == bigT_simT_idx)[0][0]
@@ -348,6 +459,7 @@ def get_event_graph(
             node_eng.append(raw_energy[recoTxId])
             node_shared_e.append(shared_e)
             node_simT_idx.append(bigT_simT_idx)
+            node_cone.append(cone)
 
         if not link_prediction:
             data_list.append(Data(
@@ -357,7 +469,9 @@ def get_event_graph(
                 pos=torch.tensor(node_pos, dtype=torch.float),
                 y=torch.tensor(node_labels, dtype=torch.float),
                 node_index=torch.tensor(node_index, dtype=torch.int),
-                simT=torch.tensor(node_simT_idx, dtype=torch.int)
+                simT=torch.tensor(node_simT_idx, dtype=torch.int),
+                # double: compared to the radius, must not round across it
+                cone=torch.tensor(node_cone, dtype=torch.double),
             ))
     if link_prediction:
         if not bigT_index:
@@ -377,7 +491,44 @@ def get_event_graph(
     return data_list
 
 
-class TracksterPairs(Dataset):
+def restrict_radius(data, radius):
+    """
+    Graph of a smaller cone radius: the nodes with cone distance < radius
+    Foreground-background graphs only, link prediction graphs have no cone.
+    Also usable as a transform to view a dataset at a smaller radius.
+    """
+    keep = data.cone < radius
+    if bool(keep.all()):
+        return data
+    num_nodes = data.num_nodes
+    out = data.clone()
+    for key, value in data:
+        if torch.is_tensor(value) and value.dim() > 0 and value.size(0) == num_nodes:
+            out[key] = value[keep]
+    return out
+
+
+def build_radii(radius, radii=None):
+    """
+    Sorted radii built in one pass, the selection is done at the largest
+    """
+    return sorted(set(radii or []) | {radius})
+
+
+def select_files(files, catalog=None):
+    """
+    Files with selected events and their entries ({source: entries}, None without a catalog)
+    """
+    if catalog is None:
+        return files, None
+    entries = {source: catalog.entries(source) for source in files}
+    selected = [source for source in files if len(entries[source])]
+    if files and not selected:
+        raise ValueError(f"None of the {len(files)} files has events in the catalog (catalog files: {catalog.files[:3]})")
+    return selected, entries
+
+
+class TracksterPairs(DatasetStatsMixin, Dataset):
     # output is about 250kb per file
 
     def __init__(
@@ -392,10 +543,14 @@ class TracksterPairs(Dataset):
             pileup=False,
             bigT_e_th=40,
             collection="SC",
+            catalog=None,
+            prefetch=2,
+            radii=None,
         ):
         self.name = name
         self.N_FILES = N_FILES
         self.RADIUS = radius
+        self.radii = build_radii(radius, radii)
         self.SCORE_THRESHOLD = score_threshold
         self.raw_data_path = raw_data_path
         self.root_dir = root_dir
@@ -403,6 +558,8 @@ class TracksterPairs(Dataset):
         self.pileup = pileup
         self.bigT_e_th = bigT_e_th
         self.collection = collection
+        self.catalog = catalog
+        self.prefetch = prefetch
         fn = self.processed_paths[0]
 
         if not path.exists(fn):
@@ -416,7 +573,7 @@ class TracksterPairs(Dataset):
     def raw_file_names(self):
         files = []
         for (_, _, filenames) in walk(self.raw_data_path):
-            files.extend(filenames)
+            files.extend(f for f in filenames if is_data_file(f))
             break
         full_paths = list([path.join(self.raw_data_path, f) for f in files])
 
@@ -425,49 +582,85 @@ class TracksterPairs(Dataset):
 
         return full_paths[:self.N_FILES]
 
-    @property
-    def processed_file_names(self):
+    def processed_file_name(self, radius):
         infos = [
             self.name,
             f"f{self.N_FILES or len(self.raw_file_names)}",
-            f"r{self.RADIUS}",
+            f"r{radius}",
             f"s{self.SCORE_THRESHOLD}",
             f"eth{self.bigT_e_th}"
         ]
-        return list([f"TracksterPairs{'PU' if self.pileup else ''}_{'_'.join(infos)}.pt"])
+        if self.catalog is not None:
+            infos.append(f"sel{self.catalog.selection_name}")
+        return f"TracksterPairs{'PU' if self.pileup else ''}_{'_'.join(infos)}.pt"
+
+    @property
+    def processed_file_names(self):
+        return [self.processed_file_name(self.RADIUS)]
 
     @property
     def processed_paths(self):
         return [path.join(self.root_dir, fn) for fn in self.processed_file_names]
 
     def process(self):
+        """
+        Build the datasets of all radii from the pairs of the largest one
+        """
         dataset_X = []
         dataset_Y = []
+        dataset_C = []
+        features = {radius: RunningStats() for radius in self.radii}
 
         assert len(self.raw_file_names) == self.N_FILES
 
-        for source in self.raw_file_names:
+        files, entries = select_files(self.raw_file_names, self.catalog)
+        event_data = prefetch_event_data(
+            files,
+            collection=self.collection,
+            pileup=self.pileup,
+            entries=entries,
+            depth=self.prefetch,
+        )
+        for source, (cluster_data, trackster_data, _, assoc_data) in event_data:
             print(f"Processing: {source}", file=sys.stderr)
-            cluster_data, trackster_data, _, assoc_data = get_event_data(
-                source,
+            bigTs = get_file_bigTs(
+                trackster_data,
+                assoc_data,
+                pileup=self.pileup,
+                energy_th=self.bigT_e_th,
                 collection=self.collection,
-                pileup=self.pileup
             )
             for eid in range(len(trackster_data["barycenter_x"])):
-                dX, dY, _ = get_event_pairs(
+                dX, dY, _, dC = get_event_pairs(
                     cluster_data,
                     trackster_data,
                     assoc_data,
                     eid,
-                    self.RADIUS,
+                    self.radii[-1],
                     pileup=self.pileup,
                     bigT_e_th=self.bigT_e_th,
                     collection=self.collection,
+                    return_cone=True,
+                    bigTs=bigTs[eid].tolist(),
                 )
+                for radius in self.radii:
+                    features[radius].update([x for x, c in zip(dX, dC) if c < radius])
                 dataset_X += dX
                 dataset_Y += dY
+                dataset_C += dC
+
+        cone = np.array(dataset_C)
+        for radius in self.radii:
+            keep = np.nonzero(cone < radius)[0].tolist()
+            dX = [dataset_X[i] for i in keep]
+            dY = [dataset_Y[i] for i in keep]
+            target = path.join(self.root_dir, self.processed_file_name(radius))
+            torch.save((dX, dY), target)
+            torch.save(pair_dataset_stats(dY, features[radius]), stats_file(target))
+        self._stats = None
 
-        torch.save((dataset_X, dataset_Y), self.processed_paths[0])
+    def compute_stats(self):
+        return pair_dataset_stats(self.y, RunningStats().update(self.x))
 
     def __getitem__(self, idx):
         return self.x[idx], self.y[idx]
@@ -485,8 +678,58 @@ class TracksterPairs(Dataset):
         return f"<TracksterPairs {' '.join(infos)}>"
 
 
+class SharedPairs(Dataset):
+    """
+    Read-only pair dataset backed by shared numpy arrays
+
+    The arrays are expected to live in shared memory: the Ray object store
+    (numpy arrays are mapped without a copy) or memory-mapped .npy files.
+    Parallel workers then index the same buffers instead of each loading
+    and converting the full dataset.
+    Items are copied to tensors only when accessed.
+    """
+
+    def __init__(self, x, y):
+        assert len(x) == len(y)
+        self.x = x
+        self.y = y
+
+    @classmethod
+    def from_dataset(cls, ds):
+        """
+        Arrays of an in-memory pair dataset (TracksterPairs), e.g. to ray.put them
+        """
+        return cls(ds.x.numpy(), ds.y.numpy())
+
+    def save(self, prefix):
+        """
+        Store the arrays as `<prefix>.x.npy` and `<prefix>.y.npy`
+        """
+        np.save(f"{prefix}.x.npy", np.ascontiguousarray(self.x))
+        np.save(f"{prefix}.y.npy", np.ascontiguousarray(self.y))
+
+    @classmethod
+    def load(cls, prefix):
+        """
+        Memory-map arrays stored with `save`
+        """
+        return cls(
+            np.load(f"{prefix}.x.npy", mmap_mode="r"),
+            np.load(f"{prefix}.y.npy", mmap_mode="r"),
+        )
+
+    def __getitem__(self, idx):
+        return torch.tensor(self.x[idx]), torch.tensor(self.y[idx])
+
+    def __len__(self):
+        return len(self.y)
+
+    def __repr__(self):
+        return f"<SharedPairs len={len(self)} features={self.x.shape[1]}>"
+
+
 
-class TracksterGraph(InMemoryDataset):
+class TracksterGraph(GraphStatsMixin, InMemoryDataset):
 
     def __init__(
             self,
@@ -503,6 +746,9 @@ class TracksterGraph(InMemoryDataset):
             bigT_e_th=10,
             collection="SC",
             link_prediction=False,
+            catalog=None,
+            prefetch=2,
+            radii=None,
         ):
         self.name = name
         self.pileup = pileup
@@ -510,65 +756,120 @@ class TracksterGraph(InMemoryDataset):
         self.raw_data_path = raw_data_path
         self.root_dir = root_dir
         self.RADIUS = radius
+        self.radii = build_radii(radius, radii)
         self.bigT_e_th = bigT_e_th
         self.collection = collection
         self.link_prediction = link_prediction
+        self.catalog = catalog
+        self.prefetch = prefetch
         self.SCORE_THRESHOLD = score_threshold
         super(TracksterGraph, self).__init__(root_dir, transform, pre_transform, pre_filter)
         self.data, self.slices = torch.load(self.processed_paths[0])
+        if not self.link_prediction and "mask" not in self.slices:
+            # datasets processed without the stored mask
+            add_focus_mask(self.data, self.slices)
 
     @property
     def raw_file_names(self):
         files = []
         for (_, _, filenames) in walk(self.raw_data_path):
-            files.extend(filenames)
+            files.extend(f for f in filenames if is_data_file(f))
             break
         full_paths = list([path.join(self.raw_data_path, f) for f in files])
         if self.N_FILES:
             assert len(full_paths) >= self.N_FILES
         return full_paths[:self.N_FILES]
 
-    @property
-    def processed_file_names(self):
+    def processed_file_name(self, radius):
         infos = [
             self.name,
             f"f{self.N_FILES or len(self.raw_file_names)}",
-            f"r{self.RADIUS}",
+            f"r{radius}",
             f"s{self.SCORE_THRESHOLD}",
             f"eth{self.bigT_e_th}"
         ]
         if self.link_prediction:
             infos.append("lp")
-        return list([f"TracksterGraph{'PU' if self.pileup else ''}_{'_'.join(infos)}.pt"])
+        if self.catalog is not None:
+            infos.append(f"sel{self.catalog.selection_name}")
+        return f"TracksterGraph{'PU' if self.pileup else ''}_{'_'.join(infos)}.pt"
+
+    @property
+    def processed_file_names(self):
+        return [self.processed_file_name(self.RADIUS)]
 
     @property
     def processed_paths(self):
         return [path.join(self.root_dir, fn) for fn in self.processed_file_names]
 
+    def event_graphs(self, cluster_data, trackster_data, assoc_data, eid, bigTs=None):
+        """
+        Graphs of the event for each radius: {radius: graphs}
+        """
+        def build(radius):
+            return get_event_graph(
+                cluster_data,
+                trackster_data,
+                assoc_data,
+                eid,
+                radius,
+                pileup=self.pileup,
+                bigT_e_th=self.bigT_e_th,
+                collection=self.collection,
+                link_prediction=self.link_prediction,
+                bigTs=bigTs,
+            )
+
+        if self.link_prediction:
+            return {radius: build(radius) for radius in self.radii}
+
+        event_graphs = build(self.radii[-1])
+        return {radius: [restrict_radius(graph, radius) for graph in event_graphs] for radius in self.radii}
+
     def process(self):
-        data_list = []
-        for source in self.raw_file_names:
+        """
+        Build the datasets of all radii in one pass
+
+        Foreground-background graphs are built at the largest radius and cut
+        down to the smaller ones by the stored node cone distance.
+        Link prediction graphs share the node order and labels of the first bigT
+        cone a node is found in, which depends on the radius: they are rebuilt
+        per radius, only the reading of the files is shared.
+        """
+        data_lists = {radius: [] for radius in self.radii}
+        features = {radius: RunningStats() for radius in self.radii}
+        files, entries = select_files(self.raw_file_names, self.catalog)
+        event_data = prefetch_event_data(
+            files,
+            collection=self.collection,
+            pileup=self.pileup,
+            entries=entries,
+            depth=self.prefetch,
+        )
+        for source, (cluster_data, trackster_data, _, assoc_data) in event_data:
             print(source, file=sys.stderr)
-            cluster_data, trackster_data, _, assoc_data = get_event_data(
-                source,
-                collection=self.collection,
+            bigTs = get_file_bigTs(
+                trackster_data,
+                assoc_data,
                 pileup=self.pileup,
+                energy_th=self.bigT_e_th,
+                collection=self.collection,
             )
             for eid in range(len(trackster_data["barycenter_x"])):
-                data_list += get_event_graph(
-                    cluster_data,
-                    trackster_data,
-                    assoc_data,
-                    eid,
-                    self.RADIUS,
-                    pileup=self.pileup,
-                    bigT_e_th=self.bigT_e_th,
-                    collection=self.collection,
-                    link_prediction=self.link_prediction,
-                )
-
-        data, slices = self.collate(data_list)
-        torch.save((data, slices), self.processed_paths[0])
+                graphs = self.event_graphs(cluster_data, trackster_data, assoc_data, eid, bigTs=bigTs[eid].tolist())
+                for radius, event_graphs in graphs.items():
+                    for graph in event_graphs:
+                        features[radius].update(graph.x)
+                    data_lists[radius] += event_graphs
+
+        for radius in self.radii:
+            data, slices = self.collate(data_lists[radius])
+            if not self.link_prediction:
+                add_focus_mask(data, slices)
+            target = path.join(self.root_dir, self.processed_file_name(radius))
+            torch.save((data, slices), target)
+            torch.save(graph_dataset_stats(data, slices, features=features[radius]), stats_file(target))
+        self._stats = None
 
     def __repr__(self):
         infos = [
@@ -1,20 +1,34 @@
 import pickle
+from functools import lru_cache
 from scipy.spatial.distance import cdist
 from os.path import join
 
+from .layers import LayerMap
 
+
+@lru_cache(maxsize=None)
 def get_z_map(data_root):
+    """
+    Load the z -> layer map once per data root
+    """
     z_map_path = join(data_root, "z_map.pt")
-    return pickle.load(open(z_map_path, "rb"))
+    with open(z_map_path, "rb") as f:
+        return LayerMap.from_dict(pickle.load(f))
 
 
 def apply_map(_target, _map, factor=1):
+    """
+    Map z values to layer indices (multiplied by factor)
+    _map is a LayerMap or a {int(z): layer} dictionary
+    """
     if _map is None:
         return _target
-    return [factor * _map[int(x)] for x in _target]
+    if not isinstance(_map, LayerMap):
+        _map = LayerMap.from_dict(_map)
+    return _map(_target, factor=factor)
 
 
 def euclidian_distance(X1, X2):
     # return minimum of pairwise distances
     # expensive for the full point cloud
-    return cdist(X1, X2, metric="Euclidean").min()
\ No newline at end of file
+    return cdist(X1, X2, metric="Euclidean").min()
@@ -1,5 +1,11 @@
+import sys
+import multiprocessing
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+
 import torch
 import numpy as np
+import pandas as pd
 import awkward as ak
 
 from torch_geometric.data import Data
@@ -8,12 +14,20 @@ import torch_geometric.transforms as T
 
 from .graphs import create_graph
 from .energy import get_energy_map
+from .membership import TracksterMembership, bcubed_membership
 from .data import FEATURE_KEYS
 from .dataset import get_ground_truth
-from .event import get_trackster_map, remap_arrays_by_label, remap_tracksters, get_candidate_pairs, merge_tracksters
+from .event import (
+    get_trackster_map,
+    regroup_by_label,
+    remap_tracksters,
+    get_candidate_pairs,
+    merge_tracksters,
+    scan_merge_labels,
+)
 from .features import get_graph_level_features
 
-from .datasetPU import get_event_pairs, get_event_graph
+from .datasetPU import get_event_pairs, get_event_graph, get_file_bigTs
 
 
 def f_score(precision, recall, beta=1):
@@ -108,43 +122,58 @@ def bcubed(vertices, t_vertices, i2a, i2b, e_map):
     return P / total_e
 
 
+def _hit_mask(nhits, indexes, min_hits):
+    """
+    Mask of the trackster LCs with more than min_hits hits
+    """
+    counts = ak.num(indexes, axis=1)
+    flat = ak.to_numpy(ak.flatten(indexes, axis=1)).astype(np.int64)
+    return ak.unflatten(np.asarray(nhits)[flat] > min_hits, counts)
+
+
 def evaluate(nhits, all_t_indexes, all_st_indexes, t_energy, st_energy, all_v_multi, all_sv_multi, f_min=0, beta=0.5, min_hits=1):
+    n_lc = len(nhits)
 
     # prepare RECO indexes
-    lc_over_1_hit = ak.Array([nhits[t] > min_hits for t in all_t_indexes])
-    t_indexes = all_t_indexes[lc_over_1_hit]
-    v_multi = all_v_multi[lc_over_1_hit]
-    t_vertices = ak.flatten(t_indexes)
+    lc_over_1_hit = _hit_mask(nhits, all_t_indexes, min_hits)
+    reco = TracksterMembership(
+        all_t_indexes[lc_over_1_hit],
+        all_v_multi[lc_over_1_hit],
+        t_energy[lc_over_1_hit],
+        n_lc=n_lc,
+    )
 
     # prepare SIM indexes
-    slc_over_1_hit = ak.Array([nhits[t] > min_hits for t in all_st_indexes])
-    st_indexes = all_st_indexes[slc_over_1_hit]
-    sv_multi = all_sv_multi[slc_over_1_hit]
-    st_vertices = ak.Array(set(ak.flatten(st_indexes)))
-
-    # precompute LC -> Trackster mapping
-    i2rt = get_trackster_map(t_indexes, v_multi)
-    i2st = get_trackster_map(st_indexes, sv_multi, f_min=f_min)
-
-    # precompute LC -> Energy mapping (same for all tracksters the LC is in)
-    te_map = get_energy_map(t_indexes, t_energy, v_multi)
-    ste_map = get_energy_map(st_indexes, st_energy, sv_multi)
-
-    precision = bcubed(t_vertices, t_indexes, i2rt, i2st, te_map)
-    recall = bcubed(st_vertices, st_indexes, i2st, i2rt, ste_map)
+    slc_over_1_hit = _hit_mask(nhits, all_st_indexes, min_hits)
+    sim = TracksterMembership(
+        all_st_indexes[slc_over_1_hit],
+        all_sv_multi[slc_over_1_hit],
+        st_energy[slc_over_1_hit],
+        f_min=f_min,
+        n_lc=n_lc,
+    )
+
+    n_lc = max(reco.n_lc, sim.n_lc)
+    # every reco vertex, every distinct sim LC
+    t_vertices = np.bincount(reco.t_lc, minlength=n_lc)
+    st_vertices = np.bincount(sim.t_lc, minlength=n_lc) > 0
+
+    precision = bcubed_membership(t_vertices, reco, sim)
+    recall = bcubed_membership(st_vertices, sim, reco)
 
     return precision, recall, f_score(precision, recall, beta=beta)
 
 
 def evaluate_remapped(nhits, t_indexes, st_indexes, t_energy, st_energy, v_multi, sv_multi, labels, f_min=0):
-    ri = remap_arrays_by_label(t_indexes, labels)
-    re = remap_arrays_by_label(t_energy, labels)
-    rm = remap_arrays_by_label(v_multi, labels)
+    ri, re, rm = regroup_by_label((t_indexes, t_energy, v_multi), labels)
     return evaluate(nhits, ri, st_indexes, re, st_energy, rm, sv_multi, f_min=f_min)
 
 
-def baseline_evaluation(callable_fn, cluster_data, trackster_data, simtrackster_data, max_events=None, **kwargs):
-    results = []
+def prepare_baseline_events(cluster_data, trackster_data, simtrackster_data, max_events=None):
+    """
+    Precompute the per-event evaluation inputs shared by all clustering configurations
+    """
+    events = []
     n_events = len(trackster_data["vertices_indexes"])
     max_events = min(n_events, max_events) if max_events else n_events
 
@@ -163,27 +192,146 @@ def baseline_evaluation(callable_fn, cluster_data, trackster_data, simtrackster_
         t_energy = ak.Array([clusters_e[indices] for indices in t_indexes])
         st_energy = ak.Array([clusters_e[indices] for indices in st_indexes])
 
-        labels = callable_fn(trackster_data, eid, **kwargs)
-
-        results.append((
-            *evaluate_remapped(
-                nhits,
-                t_indexes,
-                st_indexes,
-                t_energy,
-                st_energy,
-                t_multiplicity,
-                st_multiplicity,
-                labels,
-            ),
-            max(labels) + 1,
+        events.append((
+            nhits,
+            t_indexes,
+            st_indexes,
+            t_energy,
+            st_energy,
+            t_multiplicity,
+            st_multiplicity,
         ))
-        results
-    return results
+    return events
 
 
-def eval_graph_lp(trackster_data, eid, dX, model, pileup=False, decision_th=0.5):
+def _evaluate_baseline_event(callable_fn, trackster_data, event_inputs, eid, params):
+    labels = callable_fn(trackster_data, eid, **params)
+    return (
+        *evaluate_remapped(*event_inputs, labels),
+        max(labels) + 1,
+    )
+
+
+def baseline_evaluation(callable_fn, cluster_data, trackster_data, simtrackster_data, max_events=None, events=None, **kwargs):
+    """
+    Evaluate a clustering callable per event
+    Returns a list of (precision, recall, fscore, n_output_tracksters)
+
+    events: inputs from prepare_baseline_events, computed when not given
+    """
+    if events is None:
+        events = prepare_baseline_events(cluster_data, trackster_data, simtrackster_data, max_events=max_events)
+
+    return [
+        _evaluate_baseline_event(callable_fn, trackster_data, event_inputs, eid, kwargs)
+        for eid, event_inputs in enumerate(events)
+    ]
+
+
+def expand_grid(param_grid):
+    """
+    {"a": [1, 2], "b": [3]} -> [{"a": 1, "b": 3}, {"a": 2, "b": 3}]
+    A list of dictionaries is returned as is
+    """
+    if isinstance(param_grid, dict):
+        keys = list(param_grid.keys())
+        return [dict(zip(keys, values)) for values in product(*(param_grid[k] for k in keys))]
+    return list(param_grid)
+
+
+# per-process state of the sweep workers, shared by all tasks
+_SWEEP_STATE = {}
+
+
+def _init_sweep_worker(callable_fn, trackster_data, events):
+    _SWEEP_STATE["callable_fn"] = callable_fn
+    _SWEEP_STATE["trackster_data"] = trackster_data
+    _SWEEP_STATE["events"] = events
+
+
+def _sweep_task(task):
+    p_idx, eid, params = task
+    result = _evaluate_baseline_event(
+        _SWEEP_STATE["callable_fn"],
+        _SWEEP_STATE["trackster_data"],
+        _SWEEP_STATE["events"][eid],
+        eid,
+        params,
+    )
+    return p_idx, eid, result
+
+
+def baseline_sweep(
+    callable_fn,
+    param_grid,
+    cluster_data,
+    trackster_data,
+    simtrackster_data,
+    max_events=None,
+    n_workers=None,
+    chunksize=8,
+    per_event=False,
+):
+    """
+    Evaluate a clustering callable over a parameter grid
+
+    The event inputs are computed once and shared by the workers,
+    the (event x parameter) grid runs on a process pool.
+    The callable is called as callable_fn(trackster_data, eid, **params).
 
+    Returns a pandas DataFrame with one row per parameter setting:
+        parameters, precision, recall, fscore, multiplicity (output tracksters), events
+    with per_event=True, one row per (parameter setting, event) instead
+    """
+    grid = expand_grid(param_grid)
+    events = prepare_baseline_events(cluster_data, trackster_data, simtrackster_data, max_events=max_events)
+    tasks = [(p_idx, eid, params) for p_idx, params in enumerate(grid) for eid in range(len(events))]
+
+    if n_workers == 1:
+        _init_sweep_worker(callable_fn, trackster_data, events)
+        results = list(map(_sweep_task, tasks))
+    else:
+        # fork shares the inputs with the workers without pickling
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=context,
+            initializer=_init_sweep_worker,
+            initargs=(callable_fn, trackster_data, events),
+        ) as executor:
+            results = list(executor.map(_sweep_task, tasks, chunksize=chunksize))
+
+    rows = []
+    for p_idx, eid, (precision, recall, fscore, multiplicity) in results:
+        rows.append({
+            **grid[p_idx],
+            "eid": eid,
+            "precision": float(precision),
+            "recall": float(recall),
+            "fscore": float(fscore),
+            "multiplicity": int(multiplicity),
+        })
+
+    table = pd.DataFrame(rows)
+    if per_event or table.empty:
+        return table
+
+    param_keys = list(grid[0].keys())
+    metrics = ["precision", "recall", "fscore", "multiplicity"]
+    if not param_keys:
+        return table[metrics].mean().to_frame().T.assign(events=len(events))
+
+    summary = table.groupby(param_keys, sort=False)[metrics].mean()
+    summary["events"] = table.groupby(param_keys, sort=False)["eid"].count()
+    return summary.reset_index()
+
+
+def predict_graph_edges(dX, model):
+    """
+    Edge predictions of a link prediction model over the event graphs
+    Returns (pairs, preds, truths) with pairs in trackster indices
+    """
     pairs = []
     preds = []
     truths = []
@@ -196,6 +344,20 @@ def eval_graph_lp(trackster_data, eid, dX, model, pileup=False, decision_th=0.5)
         truths += sample.y.tolist()
         pairs += [(nidx[a].item(), nidx[b].item()) for a, b in sample.edge_index.T]
 
+    return pairs, preds, truths
+
+
+def predict_pairs(dX, model, scaler=None):
+    X = torch.tensor(dX, dtype=torch.float)
+    if scaler is not None:
+        X = torch.as_tensor(scaler.transform(X), dtype=torch.float)
+    return model(X).detach().cpu().reshape(-1).tolist()
+
+
+def eval_graph_lp(trackster_data, eid, dX, model, pileup=False, decision_th=0.5):
+
+    pairs, preds, truths = predict_graph_edges(dX, model)
+
     # rebuild the event
     reco = remap_tracksters(trackster_data, pairs, preds, eid, decision_th=decision_th, pileup=pileup, allow_multiple=True)
     target = remap_tracksters(trackster_data, pairs, truths, eid, decision_th=decision_th, pileup=pileup, allow_multiple=False)
@@ -308,6 +470,73 @@ def eval_graph_fb(trackster_data, eid, dX, model, pileup=False, multiparticle=Fa
     return reco, target, p_list
 
 
+def _event_samples(
+    cluster_data,
+    trackster_data,
+    assoc_data,
+    eid,
+    radius,
+    bigTs,
+    pileup=False,
+    bigT_e_th=50,
+    collection="SC",
+    graph=False,
+    link_prediction=False,
+    cache=None,
+):
+    """
+    Graphs (graph=True) or (dX, dY, pair_index) of the event, through the cache if given
+    bigTs: callable returning the big tracksters of the file (only called on a cache miss)
+    """
+    def build():
+        if graph:
+            return get_event_graph(
+                cluster_data,
+                trackster_data,
+                assoc_data,
+                eid,
+                radius,
+                pileup=pileup,
+                bigT_e_th=bigT_e_th,
+                collection=collection,
+                link_prediction=link_prediction,
+                bigTs=bigTs()[eid].tolist(),
+            )
+        return get_event_pairs(
+            cluster_data,
+            trackster_data,
+            assoc_data,
+            eid,
+            radius,
+            pileup=pileup,
+            bigT_e_th=bigT_e_th,
+            collection=collection,
+            bigTs=bigTs()[eid].tolist(),
+        )
+
+    if cache is None:
+        return build()
+
+    key = (id(trackster_data), eid, radius, bigT_e_th, pileup, collection, graph, graph and link_prediction)
+    return cache.event_samples(key, build)
+
+
+def _file_bigTs(trackster_data, assoc_data, max_events, pileup, bigT_e_th, collection):
+    bigTs = []
+
+    def get():
+        if not bigTs:
+            bigTs.append(get_file_bigTs(
+                trackster_data[:max_events],
+                assoc_data[:max_events],
+                pileup=pileup,
+                energy_th=bigT_e_th,
+                collection=collection,
+            ))
+        return bigTs[0]
+    return get
+
+
 def model_evaluation(
     cluster_data,
     trackster_data,
@@ -324,9 +553,16 @@ def model_evaluation(
     reco_eval=True,
     link_prediction=False,
     multiparticle=False,
+    scaler=None,
+    cache=None,
 ):
     """
     Evaluation must be unbalanced
+
+    scaler: feature normalisation applied before the model
+        (e.g. the FeatureScaler of the training dataset)
+    cache: GroundTruthCache reusing the event samples and truth between calls
+        on the same data (e.g. several models or decision thresholds)
     """
     model.eval()
 
@@ -339,38 +575,38 @@ def model_evaluation(
         results["reco_to_sim"] = []
         results["n_tracksters"] = []
 
+    bigTs = _file_bigTs(trackster_data, assoc_data, max_events, pileup, bigT_e_th, collection)
+
     actual_range = min([len(trackster_data["raw_energy"]), max_events])
     for eid in range(actual_range):
         print(f"Event {eid}:")
 
+        samples = _event_samples(
+            cluster_data,
+            trackster_data,
+            assoc_data,
+            eid,
+            radius,
+            bigTs,
+            pileup=pileup,
+            bigT_e_th=bigT_e_th,
+            collection=collection,
+            graph=graph,
+            link_prediction=link_prediction,
+            cache=cache,
+        )
         if graph:
-            dX = get_event_graph(
-                cluster_data,
-                trackster_data,
-                assoc_data,
-                eid,
-                radius,
-                pileup=pileup,
-                bigT_e_th=bigT_e_th,
-                collection=collection,
-                link_prediction=link_prediction,
-            )
+            dX = samples
         else:
-            dX, dY, pair_index = get_event_pairs(
-                cluster_data,
-                trackster_data,
-                assoc_data,
-                eid,
-                radius,
-                pileup=pileup,
-                bigT_e_th=bigT_e_th,
-                collection=collection
-            )
+            dX, dY, pair_index = samples
 
         if len(dX) == 0:
             print("\tNo data")
             continue
 
+        if scaler is not None and graph:
+            dX = [scaler(sample.clone()) for sample in dX]
+
         # predict edges
         if graph and link_prediction:
             reco, target, p_list = eval_graph_lp(
@@ -392,7 +628,7 @@ def model_evaluation(
                 multiparticle=multiparticle,
             )
         else:
-            preds = model(torch.tensor(dX, dtype=torch.float)).detach().cpu().reshape(-1).tolist()
+            preds = predict_pairs(dX, model, scaler=scaler)
             truth = np.array(dY)
 
             # rebuild the event
@@ -455,4 +691,130 @@ def model_evaluation(
         avg_f = np.sum([x[2] for x in values]) / actual_range
         print(f"mean {key}:\tP: {avg_p:.3f} R: {avg_r:.3f} F: {avg_f:.3f}")
 
-    return results
\ No newline at end of file
+    return results
+
+
+def model_threshold_scan(
+    cluster_data,
+    trackster_data,
+    simtrackster_data,
+    assoc_data,
+    model,
+    thresholds,
+    radius=10,
+    max_events=100,
+    bigT_e_th=50,
+    pileup=False,
+    collection="SC",
+    graph=False,
+    scaler=None,
+    per_event=False,
+    cache=None,
+):
+    """
+    model_evaluation over a list of decision thresholds in one pass
+
+    The samples are built and the model runs once per event, the merges of
+    all thresholds come from a single union-find sweep (scan_merge_labels).
+    Events where a threshold gives the same tracksters as the previous one
+    reuse its scores.
+    Supports the pairwise models and graph link prediction (graph=True).
+
+    Returns a pandas DataFrame with one row per threshold:
+        threshold, {clue3d,target,reco}_{precision,recall,fscore}, n_tracksters, events
+    averaged over the events like model_evaluation (events without data count as 0)
+    with per_event=True, one row per (threshold, event) instead
+
+    cache: GroundTruthCache reusing the event samples and truth between scans
+        on the same data (e.g. several models)
+    """
+    model.eval()
+    thresholds = sorted(thresholds, reverse=True)
+    metrics = ["precision", "recall", "fscore"]
+    p = "" if pileup else f"sts{collection}_"
+
+    rows = []
+    bigTs = _file_bigTs(trackster_data, assoc_data, max_events, pileup, bigT_e_th, collection)
+
+    actual_range = min([len(trackster_data["raw_energy"]), max_events])
+    for eid in range(actual_range):
+        print(f"Event {eid}:", file=sys.stderr)
+
+        samples = _event_samples(
+            cluster_data,
+            trackster_data,
+            assoc_data,
+            eid,
+            radius,
+            bigTs,
+            pileup=pileup,
+            bigT_e_th=bigT_e_th,
+            collection=collection,
+            graph=graph,
+            link_prediction=True,
+            cache=cache,
+        )
+        if graph:
+            dX = samples
+        else:
+            dX, dY, pair_index = samples
+
+        if len(dX) == 0:
+            print("\tNo data", file=sys.stderr)
+            continue
+
+        with torch.no_grad():
+            if graph:
+                if scaler is not None:
+                    dX = [scaler(sample.clone()) for sample in dX]
+                pair_index, preds, truth = predict_graph_edges(dX, model)
+            else:
+                preds = predict_pairs(dX, model, scaler=scaler)
+                truth = dY
+
+        n_tracksters = len(trackster_data["raw_energy"][eid])
+        reco_labels = scan_merge_labels(n_tracksters, pair_index, preds, thresholds, pileup=pileup, allow_multiple=graph)
+        target_labels = scan_merge_labels(n_tracksters, pair_index, truth, thresholds, pileup=pileup)
+
+        clusters_e = cluster_data["energy"][eid]
+        nhits = cluster_data["cluster_number_of_hits"][eid]
+
+        ci = trackster_data["vertices_indexes"][eid]
+        cm = trackster_data["vertices_multiplicity"][eid]
+        ce = ak.Array([clusters_e[indices] for indices in ci])
+
+        si = simtrackster_data[f"{p}vertices_indexes"][eid]
+        sm = simtrackster_data[f"{p}vertices_multiplicity"][eid]
+        se = ak.Array([clusters_e[indices] for indices in si])
+
+        if pileup:
+            # only the big tracksters (right side)
+            p_list = list(set(b for _, b in pair_index))
+            clue3d = evaluate(nhits, ci[p_list], si, ce[p_list], se, cm[p_list], sm)
+        else:
+            clue3d = evaluate(nhits, ci, si, ce, se, cm, sm)
+
+        # consecutive thresholds often give the same tracksters
+        scores = {}
+
+        def score(labels):
+            key = labels.tobytes()
+            if key not in scores:
+                scores[key] = evaluate_remapped(nhits, ci, si, ce, se, cm, sm, labels)
+            return scores[key]
+
+        for th in thresholds:
+            row = {"threshold": th, "eid": eid}
+            labels = reco_labels[th]
+            for name, result in (("clue3d", clue3d), ("target", score(target_labels[th])), ("reco", score(labels))):
+                row.update({f"{name}_{m}": float(v) for m, v in zip(metrics, result)})
+            row["n_tracksters"] = int(labels.max()) + 1 if len(labels) else 0
+            rows.append(row)
+
+    table = pd.DataFrame(rows)
+    if per_event or table.empty:
+        return table
+
+    summary = table.drop(columns="eid").groupby("threshold", sort=False).sum() / actual_range
+    summary["events"] = table.groupby("threshold", sort=False)["eid"].count()
+    return summary.reset_index()
@@ -46,31 +46,84 @@ def get_trackster_map(t_vertices, t_multiplicity, f_min=0):
     return i2te
 
 
-def remap_arrays_by_label(array, labels):
-    h = max(labels) + 1
-    rm = []
+def _regroup(array, labels, merge_items, n_groups=None):
+    labels = np.asarray(labels, dtype=np.int64)
+    if n_groups is None:
+        n_groups = int(labels.max()) + 1 if len(labels) else 0
+    array = array if isinstance(array, ak.Array) else ak.Array(array)
 
-    for i in range(h):
-        rm.append([])
+    # drop unassigned (-1) entries, stable sort keeps the original order within a group
+    keep = np.nonzero(labels >= 0)[0]
+    kept_labels = labels[keep]
+    order = keep[np.argsort(kept_labels, kind="stable")]
+    selected = array[order]
 
-    for l, i in zip(labels, array):
-        if l >= 0:
-            rm[l] += list(i)
+    if merge_items:
+        # concatenate the items of all entries with the same label
+        sizes = ak.to_numpy(ak.num(array, axis=1))[keep]
+        counts = np.bincount(kept_labels, weights=sizes, minlength=n_groups).astype(np.int64)
+        return ak.unflatten(ak.flatten(selected, axis=1), counts)
 
-    return ak.Array(rm)
+    counts = np.bincount(kept_labels, minlength=n_groups)
+    return ak.unflatten(selected, counts)
 
-def remap_items_by_label(array, labels):
-    h = max(labels) + 1
-    rm = []
 
-    for i in range(h):
-        rm.append([])
+def regroup_by_label(arrays, labels, merge_items=True):
+    """
+    Group jagged arrays by a label per entry
+
+    Input:
+        arrays: array, or a list/dict of arrays with one entry per label
+        labels: group label per entry, -1 drops the entry
+        merge_items:
+            True: entries are lists (tracksters x LCs), their items are concatenated
+            False: entries are items, they are collected into groups
+
+    Output:
+        arrays in the same structure with one entry per group (0..max(labels))
+    """
+    if isinstance(arrays, dict):
+        return {k: _regroup(a, labels, merge_items) for k, a in arrays.items()}
+    if isinstance(arrays, (list, tuple)):
+        return type(arrays)(_regroup(a, labels, merge_items) for a in arrays)
+    return _regroup(arrays, labels, merge_items)
+
+
+def regroup_events_by_label(arrays, labels, merge_items=True):
+    """
+    Group a batch of events at once, labels are jagged (events x entries)
+    Returns arrays with dimensions (events x groups x ...)
+    """
+    labels = ak.Array(labels)
+    n_entries = ak.to_numpy(ak.num(labels, axis=1))
+    flat_labels = ak.to_numpy(ak.flatten(labels)).astype(np.int64)
+
+    # number of groups per event and the offset of the event groups
+    event_of_entry = np.repeat(np.arange(len(n_entries)), n_entries)
+    n_groups = np.zeros(len(n_entries), dtype=np.int64)
+    np.maximum.at(n_groups, event_of_entry, flat_labels + 1)
+    offsets = np.concatenate(([0], np.cumsum(n_groups)[:-1]))
+
+    global_labels = np.where(flat_labels >= 0, flat_labels + offsets[event_of_entry], -1)
 
-    for l, i in zip(labels, array):
-        if l >= 0:
-            rm[l].append(i)
+    def _regroup_events(array):
+        flat = ak.flatten(ak.Array(array), axis=1)
+        grouped = _regroup(flat, global_labels, merge_items, n_groups=int(n_groups.sum()))
+        return ak.unflatten(grouped, n_groups)
 
-    return ak.Array(rm)
+    if isinstance(arrays, dict):
+        return {k: _regroup_events(a) for k, a in arrays.items()}
+    if isinstance(arrays, (list, tuple)):
+        return type(arrays)(_regroup_events(a) for a in arrays)
+    return _regroup_events(arrays)
+
+
+def remap_arrays_by_label(array, labels):
+    return regroup_by_label(array, labels)
+
+
+def remap_items_by_label(array, labels):
+    return regroup_by_label(array, labels, merge_items=False)
 
 
 def get_merge_map(pair_index, preds, threshold):
@@ -168,6 +221,96 @@ def remap_tracksters(trackster_data, pair_index, preds, eid, decision_th=0.5, pi
     return merge_tracksters(trackster_data, merged_tracksters, eid)
 
 
+class UnionFind:
+    """
+    Disjoint sets over 0..n-1 (union by size, path halving)
+    """
+
+    def __init__(self, n):
+        self.parent = np.arange(n)
+        self.size = np.ones(n, dtype=np.int64)
+
+    def find(self, a):
+        parent = self.parent
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return False
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size[rb]
+        return True
+
+    def labels(self, nodes=None):
+        """
+        Compact set label per element (in order of the first element of each set)
+        elements outside `nodes` are labelled -1
+        """
+        n = len(self.parent)
+        roots = np.array([self.find(a) for a in range(n)], dtype=np.int64)
+        keep = np.ones(n, dtype=bool) if nodes is None else nodes
+        _, first, inverse = np.unique(roots[keep], return_index=True, return_inverse=True)
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first, kind="stable")] = np.arange(len(first))
+        labels = np.full(n, -1, dtype=np.int64)
+        labels[keep] = rank[inverse.reshape(-1)]
+        return labels
+
+
+def merge_edges(pair_index, preds, allow_multiple=False):
+    """
+    (little, big, score) edges of the merge map, by decreasing score
+    Without allow_multiple only the best scoring big of each little is kept (see get_merge_map).
+    """
+    best = {}
+    edges = []
+    for (little, big), p in zip(pair_index, preds):
+        if allow_multiple:
+            edges.append((little, big, p))
+        elif little not in best or best[little][2] < p:
+            best[little] = (little, big, p)
+    if not allow_multiple:
+        edges = list(best.values())
+    return sorted(edges, key=lambda e: e[2], reverse=True)
+
+
+def scan_merge_labels(n_tracksters, pair_index, preds, thresholds, pileup=False, allow_multiple=False):
+    """
+    Trackster labels of remap_tracksters for every decision threshold in one sweep
+
+    The merge edges are sorted by score once and added to a union-find
+    while the threshold decreases, so each threshold costs only the new merges.
+    With pileup, only the bigs and the littles merged into them are labelled (others -1).
+
+    Returns {threshold: labels}
+    """
+    uf = UnionFind(n_tracksters)
+    if pileup:
+        nodes = np.zeros(n_tracksters, dtype=bool)
+        nodes[[b for _, b in pair_index]] = True
+    else:
+        nodes = None
+
+    edges = merge_edges(pair_index, preds, allow_multiple=allow_multiple)
+    result = {}
+    e = 0
+    for th in sorted(thresholds, reverse=True):
+        while e < len(edges) and edges[e][2] > th:
+            little, big, _ = edges[e]
+            uf.union(little, big)
+            if pileup:
+                nodes[little] = True
+            e += 1
+        result[th] = uf.labels(nodes)
+    return result
+
+
 def get_candidate_pairs_little_big(
     clouds,
     inners,
@@ -189,27 +332,122 @@ def get_candidate_pairs_little_big(
     return candidate_pairs, dst_map
 
 
+class PlanarIndex:
+    """
+    Layer clusters of an event bucketed per (trackster, layer, x cell, y cell)
+
+    The cells are max_distance wide, so all the layer clusters of a trackster
+    closer than max_distance to a point in the xy plane are found
+    in the 3x3 cells around it.
+    """
+
+    def __init__(self, vx, vy, layers, cell_size):
+        counts = np.asarray(ak.num(vx))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.x = np.asarray(ak.flatten(vx), dtype=float)
+        self.y = np.asarray(ak.flatten(vy), dtype=float)
+        self.layer = np.asarray(ak.flatten(layers), dtype=int)
+        self.cell_size = cell_size
+        self.cx = np.floor(self.x / cell_size).astype(int)
+        self.cy = np.floor(self.y / cell_size).astype(int)
+
+        tid = np.repeat(np.arange(len(counts)), counts)
+        self.buckets = {}
+        for i, key in enumerate(zip(tid.tolist(), self.layer.tolist(), self.cx.tolist(), self.cy.tolist())):
+            self.buckets.setdefault(key, []).append(i)
+
+        self.layer_min = np.full(len(counts), np.iinfo(int).max)
+        self.layer_max = np.full(len(counts), np.iinfo(int).min)
+        filled = counts > 0
+        if filled.any():
+            self.layer_min[filled] = np.minimum.reduceat(self.layer, self.offsets[:-1][filled])
+            self.layer_max[filled] = np.maximum.reduceat(self.layer, self.offsets[:-1][filled])
+
+    def size(self, t):
+        return self.offsets[t + 1] - self.offsets[t]
+
+    def layer_overlap(self, a, b):
+        """
+        Number of layers shared by the layer ranges of the tracksters
+        (zero or negative when they do not overlap)
+        """
+        return min(self.layer_max[a], self.layer_max[b]) - max(self.layer_min[a], self.layer_min[b]) + 1
+
+    def min_distance(self, a, b, overlap=1):
+        """
+        Minimum xy distance between the layer clusters of the tracksters
+        on the same layer (+- overlap layers)
+
+        Exact when below the cell size, inf when no pair of layer clusters
+        is closer than that.
+        """
+        if self.size(a) > self.size(b):
+            a, b = b, a
+
+        best = np.inf
+        for i in range(self.offsets[a], self.offsets[a + 1]):
+            layer, cx, cy = self.layer[i], self.cx[i], self.cy[i]
+            near = []
+            for dl in range(-overlap, overlap + 1):
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        near += self.buckets.get((b, layer + dl, cx + dx, cy + dy), [])
+            if near:
+                dst = np.hypot(self.x[near] - self.x[i], self.y[near] - self.y[i]).min()
+                best = min(best, dst)
+        return best
+
+
 def get_candidate_pairs_little_big_planear(
-    xy_cloud,
-    layers_range,
+    vx,
+    vy,
+    layers,
     inners,
     raw_energy,
     max_distance=10,
     energy_threshold=10,
+    overlap=1,
 ):
+    """
+    Little-big trackster candidates among the linked inners
+    overlapping in layers and close in the xy plane
+
+    vx, vy, layers: per-trackster layer cluster coordinates and layer indices of the event
+    overlap: tolerance in layers, both for the layer ranges and the xy distance
+
+    Returns (pairs, distances, overlaps):
+        pairs as (little, big), their minimum xy distance
+        on (almost) common layers and the number of common layers
+    """
+    index = PlanarIndex(vx, vy, layers, max_distance)
+    raw_energy = np.asarray(raw_energy)
+
     candidate_pairs = []
-    for i, inners in enumerate(inners):
-        for inner in inners:
-            e_pair = (raw_energy[i], raw_energy[inner])
-            l_range1 = layers_range[i]
-            l_range2 = layers_range[inner]
-            l_distance = max((l_range1[0], l_range2[0])) - min((l_range1[1], l_range2[1]))
-            if min(e_pair) < energy_threshold and max(e_pair) > energy_threshold and l_distance < 0:
-                dst = euclidian_distance(xy_cloud[i], xy_cloud[inner])
-                if dst <= max_distance:
-                    pair = (i, inner) if e_pair[0] < e_pair[1] else (inner, i)
-                    candidate_pairs.append(pair)
-    return candidate_pairs
+    distances = []
+    overlaps = []
+    seen = set()
+    for i, t_inners in enumerate(inners):
+        for inner in t_inners:
+            e_i, e_inner = raw_energy[i], raw_energy[inner]
+            if not min(e_i, e_inner) < energy_threshold < max(e_i, e_inner):
+                continue
+
+            pair = (i, inner) if e_i < e_inner else (inner, i)
+            if pair in seen:
+                continue
+            seen.add(pair)
+
+            l_overlap = index.layer_overlap(i, inner)
+            if l_overlap + 2 * overlap <= 1:
+                continue
+
+            dst = index.min_distance(i, inner, overlap=overlap)
+            if dst <= max_distance:
+                candidate_pairs.append(pair)
+                distances.append(dst)
+                overlaps.append(int(l_overlap))
+
+    return candidate_pairs, distances, overlaps
 
 
 def get_candidate_pairs_direct(coordinates, inners, max_distance=10):
@@ -230,8 +468,9 @@ def get_candidate_pairs_direct(coordinates, inners, max_distance=10):
 def get_candidate_pairs(tracksters, graph, eid, max_distance=10, z_map=None):
     vx = tracksters["vertices_x"].array()[eid]
     vy = tracksters["vertices_y"].array()[eid]
-    vz = tracksters["vertices_z"].array()[eid]
-    clouds = [np.array([vx[tid], vy[tid], apply_map(vz[tid], z_map, factor=2)]).T for tid in range(len(vx))]
+    # map the whole event to layers at once
+    vz = apply_map(tracksters["vertices_z"].array()[eid], z_map, factor=2)
+    clouds = [np.array([vx[tid], vy[tid], vz[tid]]).T for tid in range(len(vx))]
     inners = graph["linked_inners"].array()[eid]
 
     return get_candidate_pairs_direct(clouds, inners, max_distance=max_distance)
@@ -0,0 +1,127 @@
+import copy
+import json
+import warnings
+
+import torch
+
+from .data import FEATURE_KEYS
+from .performance import CompiledModel
+
+
+SCHEMA_VERSION = 1
+SCHEMA_FILE = "schema.json"
+
+
+def build_schema(
+    feature_keys=FEATURE_KEYS,
+    input_type="graph",
+    graph_features=False,
+    knn=None,
+    normalisation=None,
+    output="probability",
+    n_features=None,
+    **extra,
+):
+    """
+    Describe the inputs the exported model expects
+
+    input_type: "graph" (x, edge_index) or "pairs" (x)
+    knn: k-NN graph settings, e.g. {"k": 8, "pos_slice": [3, 6], "loop": False}
+        the runtime builds the edges when the event comes without them
+    normalisation: {"mean": [...], "std": [...]} applied to the features
+        before the model, or None
+    output: "probability" or "logit"
+    n_features: width of the model input x, checked against the feature keys
+        (e.g. event_graph_feature_keys / event_pairs_feature_keys of reco.datasetPU)
+    """
+    if normalisation is not None:
+        normalisation = {
+            "mean": torch.as_tensor(normalisation["mean"]).reshape(-1).tolist(),
+            "std": torch.as_tensor(normalisation["std"]).reshape(-1).tolist(),
+        }
+
+    schema = {
+        "version": SCHEMA_VERSION,
+        "input_type": input_type,
+        "feature_keys": list(feature_keys),
+        "graph_features": graph_features,
+        "knn": knn,
+        "normalisation": normalisation,
+        "output": output,
+    }
+    schema.update(extra)
+    if n_features is not None:
+        check_schema(schema, n_features)
+    return schema
+
+
+def check_schema(schema, n_features):
+    """
+    The feature keys and the normalisation must describe every input column
+    """
+    n_keys = len(schema["feature_keys"])
+    if n_keys != n_features:
+        raise ValueError(f"The schema names {n_keys} features, the model input has {n_features}")
+    norm = schema.get("normalisation")
+    if norm is not None:
+        for k in ("mean", "std"):
+            if len(norm[k]) != n_features:
+                raise ValueError(f"Normalisation {k} has {len(norm[k])} values, the model input has {n_features} features")
+
+
+def _freeze_torchscript(model, example_inputs):
+    try:
+        scripted = torch.jit.script(model)
+    except Exception as ex:
+        warnings.warn(f"Scripting failed, tracing the model instead: {ex}")
+        with torch.no_grad():
+            scripted = torch.jit.trace(model, example_inputs, check_trace=False)
+    return torch.jit.freeze(scripted.eval())
+
+
+def export_model(model, target_path, example_inputs, schema=None, fmt="torchscript", **schema_kwargs):
+    """
+    Export a trained model together with its feature schema
+
+    example_inputs: tuple of the model inputs, e.g. (x,) or (x, edge_index)
+    fmt:
+        torchscript: a single file, the schema is stored inside the archive
+        onnx: the model file and the schema in `<target_path>.json`
+
+    The artefact is loaded by reco.runtime.LinkingModel
+    which does not depend on the research code.
+    """
+    n_features = example_inputs[0].shape[1]
+    if schema is None:
+        schema = build_schema(n_features=n_features, **schema_kwargs)
+    else:
+        check_schema(schema, n_features)
+
+    # export a copy, the caller keeps its model on its device and in its mode
+    if isinstance(model, CompiledModel):
+        model = model.model
+    model = copy.deepcopy(model).cpu().eval()
+    example_inputs = tuple(t.cpu() for t in example_inputs)
+
+    if fmt == "torchscript":
+        frozen = _freeze_torchscript(model, example_inputs)
+        torch.jit.save(frozen, target_path, _extra_files={SCHEMA_FILE: json.dumps(schema)})
+    elif fmt == "onnx":
+        input_names = ["x", "edge_index"][:len(example_inputs)]
+        dynamic_axes = {"x": {0: "nodes"}, "scores": {0: "outputs"}}
+        if len(example_inputs) > 1:
+            dynamic_axes["edge_index"] = {1: "edges"}
+        torch.onnx.export(
+            model,
+            example_inputs,
+            target_path,
+            input_names=input_names,
+            output_names=["scores"],
+            dynamic_axes=dynamic_axes,
+        )
+        with open(f"{target_path}.json", "w") as f:
+            json.dump(schema, f)
+    else:
+        raise ValueError(f"Export format '{fmt}' not supported")
+
+    return schema
@@ -47,6 +47,15 @@ def mean_degree_centrality(G):
 def mean_clustering_coefficient(G):
     return nx.average_clustering(G)
 
+GRAPH_FEATURE_KEYS = [
+    "mean_degree",
+    "mean_edge_length",
+    "mean_edge_energy_gap",
+    "mean_degree_centrality",
+    "mean_clustering_coefficient",
+    "longest_path_from_highest_energy",
+]
+
 def get_graph_level_features(G):
     """
         Compute various graph level features out of G
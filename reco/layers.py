@@ -0,0 +1,98 @@
+import numpy as np
+import awkward as ak
+
+
+class LayerMap:
+    """
+    Vectorized z -> layer index lookup
+
+    The layer z positions are kept as a sorted numpy table,
+    whole (jagged) arrays of z values are mapped with one searchsorted call.
+
+    truncate: truncate z to an integer before the lookup (as int(z)),
+        used by the z_map.pt mapping keyed by whole centimeters
+    """
+
+    def __init__(self, z_values, layers=None, truncate=False):
+        z_values = np.asarray(z_values, dtype=np.float64)
+        if layers is None:
+            layers = np.arange(len(z_values))
+        layers = np.asarray(layers)
+
+        order = np.argsort(z_values, kind="stable")
+        self.z = z_values[order]
+        self.layers = layers[order]
+        self.truncate = truncate
+
+    @classmethod
+    def from_dict(cls, mapping, truncate=True):
+        return cls(list(mapping.keys()), list(mapping.values()), truncate=truncate)
+
+    @classmethod
+    def from_z(cls, z_values, truncate=False):
+        """
+        Number the distinct z positions in increasing order
+        """
+        z_values = np.asarray(ak.flatten(z_values, axis=None)) if isinstance(z_values, ak.Array) else z_values
+        z_values = np.asarray(z_values, dtype=np.float64)
+        if truncate:
+            z_values = np.trunc(z_values)
+        return cls(np.unique(z_values), truncate=truncate)
+
+    def lookup(self, z):
+        """
+        Map a flat array of z values to layer indices
+        Raises KeyError for z positions not in the map
+        """
+        z = np.asarray(z, dtype=np.float64)
+        if self.truncate:
+            z = np.trunc(z)
+        idx = np.searchsorted(self.z, z)
+        idx = np.minimum(idx, len(self.z) - 1)
+        found = self.z[idx] == z
+        if not np.all(found):
+            raise KeyError(f"z positions not in the layer map: {np.unique(z[~found])[:5].tolist()}")
+        return self.layers[idx]
+
+    def __call__(self, z, factor=1):
+        """
+        Map z values to (factor * layer index)
+        Accepts scalars, lists, numpy arrays and jagged awkward arrays
+        """
+        if isinstance(z, ak.Array):
+            return self._map_jagged(z, factor)
+        if np.ndim(z) == 0:
+            return factor * self.lookup([z])[0]
+        return factor * self.lookup(z)
+
+    def _map_jagged(self, z, factor):
+        if z.ndim == 1:
+            return ak.Array(factor * self.lookup(ak.to_numpy(z)))
+        counts = ak.num(z, axis=1)
+        return ak.unflatten(self._map_jagged(ak.flatten(z, axis=1), factor), counts)
+
+    # dict-like access for the notebooks
+    def __getitem__(self, z):
+        return self(z)
+
+    def __contains__(self, z):
+        z = np.trunc(z) if self.truncate else z
+        idx = np.searchsorted(self.z, z)
+        return idx < len(self.z) and self.z[idx] == z
+
+    def __len__(self):
+        return len(self.z)
+
+    def keys(self):
+        return self.z.tolist()
+
+    def values(self):
+        return self.layers.tolist()
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def __repr__(self):
+        if not len(self):
+            return "<LayerMap layers=0>"
+        return f"<LayerMap layers={len(self)} z=[{self.z[0]:.1f}, {self.z[-1]:.1f}]>"
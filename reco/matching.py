@@ -2,43 +2,45 @@ import numpy as np
 from .plotting import plot_fractions_hist
 
 
-def get_eid_splits(tracksters, simtracksters, associations, match_threshold=0.2):
-    perfect_eids = []
-    split_eids = []
-
-    for eid in range(len(tracksters["event"].array())):
-
-        # get the number of tracksters
-        num_rec_t = tracksters["NTracksters"].array()[eid]
-        num_sim_t = simtracksters["stsSC_NTracksters"].array()[eid]
-
-        # get reco <-> sim maps
-        r2s = np.array(associations["tsCLUE3D_recoToSim_SC_score"].array()[eid])
-        s2r = np.array(associations["tsCLUE3D_simToReco_SC_score"].array()[eid])
-
-        if num_rec_t == num_sim_t:  # matching number of tracksters
-            perf_match = True  # assume perfect match
+def match_category(num_rec_t, num_sim_t, r2s, s2r, match_threshold=0.2):
+    """
+    Classify the reco <-> sim trackster matching of an event
+        perfect: one-to-one match of every trackster
+        split: more reco than sim tracksters
+        overmerged: fewer reco than sim tracksters
+        mismatch: same number of tracksters, not matched one-to-one
+    """
+    if num_rec_t > num_sim_t:
+        return "split"
+    if num_rec_t < num_sim_t:
+        return "overmerged"
 
-            for ti, reco_t in enumerate(r2s):
-                sim_mask = (reco_t < match_threshold).astype(int)
-                if np.sum(sim_mask) != 1:
-                    perf_match = False
-                    # print(f"Event {eid}/{ti} reco to sim mismatch: {reco_t}")
+    # matching number of tracksters: perfect if each has exactly one match
+    for reco_t in r2s:
+        if np.sum(np.asarray(reco_t) < match_threshold) != 1:
+            return "mismatch"
+    for sim_t in s2r:
+        if np.sum(np.asarray(sim_t) < match_threshold) != 1:
+            return "mismatch"
+    return "perfect"
 
-            for ti, sim_t in enumerate(s2r):
-                reco_mask = (sim_t < match_threshold).astype(int)
-                if np.sum(reco_mask) != 1:
-                    perf_match = False
-                    # print(f"Event {eid}/{ti} sim to reco mismatch: {sim_t}")
 
-            if perf_match:
-                perfect_eids.append(eid)
+def get_eid_splits(tracksters, simtracksters, associations, match_threshold=0.2):
+    perfect_eids = []
+    split_eids = []
 
-        elif num_rec_t > num_sim_t: # split
+    # read the branches once, not per event
+    num_rec = tracksters["NTracksters"].array()
+    num_sim = simtracksters["stsSC_NTracksters"].array()
+    r2s_e = associations["tsCLUE3D_recoToSim_SC_score"].array()
+    s2r_e = associations["tsCLUE3D_simToReco_SC_score"].array()
+
+    for eid in range(len(num_rec)):
+        category = match_category(num_rec[eid], num_sim[eid], r2s_e[eid], s2r_e[eid], match_threshold=match_threshold)
+        if category == "perfect":
+            perfect_eids.append(eid)
+        elif category == "split":
             split_eids.append(eid)
-        else:                       # overmerged
-            # print(f"Event {eid} is overmerged ({num_sim_t} in {num_rec_t})")
-            pass
 
     return perfect_eids, split_eids
 
@@ -0,0 +1,155 @@
+import numpy as np
+import awkward as ak
+
+
+def _jagged(array, dtype):
+    """
+    Counts and flat content of a (tracksters x vertices) jagged array
+    """
+    array = array if isinstance(array, ak.Array) else ak.Array(array)
+    if len(array) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=dtype)
+    counts = ak.to_numpy(ak.num(array, axis=1)).astype(np.int64)
+    flat = ak.to_numpy(ak.flatten(array, axis=1)).astype(dtype)
+    return counts, flat
+
+
+def _expand(offsets, counts, keys):
+    """
+    Positions of the CSR entries of every key: (key position, entry position)
+    """
+    n = counts[keys]
+    left = np.repeat(np.arange(len(keys)), n)
+    first = np.repeat(offsets[keys] - np.cumsum(n) + n, n)
+    return left, first + np.arange(n.sum())
+
+
+class TracksterMembership:
+    """
+    Layer-cluster <-> trackster membership of an event in CSR arrays
+
+    Replaces the per-event dictionaries of get_trackster_map and get_energy_map:
+        trackster -> LC: t_offsets, t_lc, t_fraction, t_energy
+            all vertices, in the input order
+        LC -> trackster: lc_offsets, lc_trackster, lc_fraction, lc_energy
+            only the vertices with fraction (1 / multiplicity) above f_min
+
+    Built from the jagged vertices_indexes / vertices_multiplicity (and vertex
+    energies) at numpy speed, a few flat arrays instead of Python objects per vertex.
+    """
+
+    def __init__(self, t_vertices, t_multiplicity, t_energy=None, f_min=0, n_lc=0):
+        counts, lc = _jagged(t_vertices, np.int64)
+        _, multiplicity = _jagged(t_multiplicity, np.float64)
+        fraction = 1. / multiplicity
+        if t_energy is None:
+            energy = np.zeros(len(lc))
+        else:
+            energy = _jagged(t_energy, np.float64)[1] * fraction
+
+        self.n_tracksters = len(counts)
+        self.n_lc = max(n_lc, int(lc.max()) + 1 if len(lc) else 0)
+
+        self.t_offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.t_trackster = np.repeat(np.arange(self.n_tracksters), counts)
+        self.t_lc = lc
+        self.t_fraction = fraction
+        self.t_energy = energy
+
+        keep = np.nonzero(fraction > f_min)[0]
+        order = keep[np.argsort(lc[keep], kind="stable")]
+        self.lc_counts = np.bincount(lc[keep], minlength=self.n_lc)
+        self.lc_offsets = np.concatenate(([0], np.cumsum(self.lc_counts)))
+        self.lc_lc = lc[order]
+        self.lc_trackster = self.t_trackster[order]
+        self.lc_fraction = fraction[order]
+        self.lc_energy = energy[order]
+
+    def tracksters(self, lc):
+        """
+        Tracksters of the LC and its fractions in them
+        """
+        s = slice(self.lc_offsets[lc], self.lc_offsets[lc + 1])
+        return self.lc_trackster[s], self.lc_fraction[s]
+
+    def vertices(self, trackster):
+        """
+        LCs of the trackster and their energies in it
+        """
+        s = slice(self.t_offsets[trackster], self.t_offsets[trackster + 1])
+        return self.t_lc[s], self.t_energy[s]
+
+    def join(self, lc):
+        """
+        Pairs (i, k) of the LC-side entries k of every lc[i]
+        """
+        lc = np.asarray(lc, dtype=np.int64)
+        counts = np.append(self.lc_counts, 0)
+        offsets = np.append(self.lc_offsets[:-1], 0)
+        # LCs not in this membership have no entries
+        lc = np.where(lc < self.n_lc, lc, self.n_lc)
+        return _expand(offsets, counts, lc)
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in vars(self).values() if isinstance(v, np.ndarray))
+
+    def __repr__(self):
+        return f"<TracksterMembership tracksters={self.n_tracksters} lcs={self.n_lc} vertices={len(self.t_lc)}>"
+
+
+def _last_value(keys, values):
+    """
+    Value of the last occurrence of each key, per occurrence and per unique key
+    (a dictionary filled in order keeps the last value)
+    """
+    unique, inverse = np.unique(keys, return_inverse=True)
+    last = np.full(len(unique), -1, dtype=np.int64)
+    np.maximum.at(last, inverse, np.arange(len(keys)))
+    return unique, values[last][inverse], values[last]
+
+
+def bcubed_membership(vertex_counts, a, b):
+    """
+    bcubed (see evaluation.bcubed) on TracksterMembership
+    Input:
+        vertex_counts: how many times each LC enters the outer sum
+        a, b:
+            precision: reco, sim membership
+            recall: sim, reco membership
+
+    The B score of two LCs only depends on their b-side tracksters, so the
+    inner sum over the trackster LCs is collected per (a, b) trackster pair:
+        U[ta, tb] = sum_j e_ta(j) * (number of times j is in tb)
+        W[ta, tb] = sum_j e_ta(j) * (sum of the fractions of j in tb)
+    and each (LC, a trackster) then needs only the b tracksters of the LC.
+    """
+    n_lc = max(a.n_lc, b.n_lc)
+
+    # LC energies in the a tracksters, as in get_energy_map
+    e_keys, e_vertex, e_unique = _last_value(a.t_trackster * n_lc + a.t_lc, a.t_energy)
+    if len(e_unique) == 0:
+        raise ZeroDivisionError("no layer clusters to score")
+    total_e = e_unique.sum()
+    norm = np.bincount(a.t_trackster, weights=e_vertex, minlength=a.n_tracksters)
+
+    # inner sums per (a trackster, b trackster)
+    n_tb = max(b.n_tracksters, 1)
+    va, vb = b.join(a.t_lc)
+    pair_keys = a.t_trackster[va] * n_tb + b.lc_trackster[vb]
+    pairs, pair_inverse = np.unique(pair_keys, return_inverse=True)
+    U = np.bincount(pair_inverse, weights=e_vertex[va], minlength=len(pairs))
+    W = np.bincount(pair_inverse, weights=e_vertex[va] * b.lc_fraction[vb], minlength=len(pairs))
+
+    # outer sum over the (LC, a trackster) entries
+    o_lc = a.lc_lc
+    o_t = a.lc_trackster
+    oa, ob = b.join(o_lc)
+    pos = np.searchsorted(pairs, o_t[oa] * n_tb + b.lc_trackster[ob])
+    inner = np.bincount(oa, weights=b.lc_fraction[ob] * U[pos] + W[pos], minlength=len(o_lc))
+
+    e_o = e_unique[np.searchsorted(e_keys, o_t * n_lc + o_lc)]
+    weight = np.asarray(vertex_counts, dtype=np.float64)[o_lc] / a.lc_counts[o_lc]
+    P = np.sum(weight * e_o * inner / (2 * norm[o_t]))
+
+    return P / total_e
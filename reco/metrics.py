@@ -0,0 +1,169 @@
+import torch
+import numpy as np
+
+
+def score_edges(bins=1000, score_range=(0., 1.), tail_bins=100, tail_span=(1e-4, 1e4)):
+    """
+    Bin edges for the score histograms
+
+    Uniform bins cover the score range (model probabilities),
+    geometric tail bins on both sides keep the mapping monotonic
+    for unbounded scores (logits) at a coarser resolution.
+    """
+    lo, hi = score_range
+    inner = np.linspace(lo, hi, bins + 1)
+    if not tail_bins:
+        return inner
+    offsets = np.geomspace(tail_span[0], tail_span[1], tail_bins)
+    return np.concatenate((lo - offsets[::-1], inner, hi + offsets))
+
+
+class StreamingBinaryMetrics:
+    """
+    Binary classification metrics from fixed-bin score histograms
+
+    Keeps one histogram of scores per class on the device,
+    so updating per batch costs no host synchronisation
+    and the memory is O(bins) regardless of the dataset size.
+    Instances are mergeable (e.g. across workers) by adding the histograms.
+
+    Bin i holds the scores in (edges[i-1], edges[i]],
+    bin 0 and the last bin are the under/overflow, so at a threshold
+    on a bin edge the counts follow the `pred > threshold` rule exactly.
+    """
+
+    def __init__(self, truth_threshold=0.7, device="cpu", edges=None, **edge_kwargs):
+        if edges is None:
+            edges = score_edges(**edge_kwargs)
+
+        self.truth_threshold = truth_threshold
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.device = device
+
+        self._edges = torch.tensor(self.edges, device=device)
+        self.pos = torch.zeros(len(self.edges) + 1, dtype=torch.float64, device=device)
+        self.neg = torch.zeros(len(self.edges) + 1, dtype=torch.float64, device=device)
+
+    def update(self, pred, true, weight=None):
+        pred = pred.detach().reshape(-1).to(self.device, torch.float64)
+        true = true.detach().reshape(-1).to(self.device)
+
+        idx = torch.bucketize(pred, self._edges, right=False)
+        positive = (true > self.truth_threshold).type(torch.float64)
+
+        if weight is not None:
+            weight = weight.detach().reshape(-1).to(self.device, torch.float64)
+        else:
+            weight = torch.ones_like(positive)
+
+        size = len(self.pos)
+        self.pos += torch.bincount(idx, weights=weight * positive, minlength=size)
+        self.neg += torch.bincount(idx, weights=weight * (1 - positive), minlength=size)
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Cannot merge metrics with different binning")
+        self.pos += other.pos.to(self.device)
+        self.neg += other.neg.to(self.device)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def all_reduce(self, group=None):
+        """
+        Sum the histograms over all processes of a torch.distributed group
+        """
+        torch.distributed.all_reduce(self.pos, group=group)
+        torch.distributed.all_reduce(self.neg, group=group)
+        return self
+
+    def reset(self):
+        self.pos.zero_()
+        self.neg.zero_()
+
+    def _histograms(self):
+        return self.pos.cpu().numpy(), self.neg.cpu().numpy()
+
+    def _cumulative(self):
+        """
+        Positive and negative counts with score above each bin edge
+        from the highest threshold to the lowest
+        """
+        pos, neg = self._histograms()
+        tp = np.concatenate(([0.], np.cumsum(pos[::-1])))
+        fp = np.concatenate(([0.], np.cumsum(neg[::-1])))
+        return tp, fp
+
+    @property
+    def total(self):
+        pos, neg = self._histograms()
+        return pos.sum() + neg.sum()
+
+    def confusion(self, threshold):
+        """
+        Returns (tn, fp, fn, tp) for the decision threshold, positive: score > threshold
+        Exact for a threshold on a bin edge, otherwise the scores in the bin
+        containing the threshold count as negative
+        """
+        pos, neg = self._histograms()
+        k = np.searchsorted(self.edges, threshold, side="left") + 1
+        tp = pos[k:].sum()
+        fp = neg[k:].sum()
+        return neg[:k].sum(), fp, pos[:k].sum(), tp
+
+    def precision(self, threshold):
+        _, fp, _, tp = self.confusion(threshold)
+        return tp / (tp + fp) if tp + fp else 0.
+
+    def recall(self, threshold):
+        _, _, fn, tp = self.confusion(threshold)
+        return tp / (tp + fn) if tp + fn else 0.
+
+    def fbeta(self, threshold, beta=1):
+        _, fp, fn, tp = self.confusion(threshold)
+        denominator = (1 + beta**2) * tp + beta**2 * fn + fp
+        return (1 + beta**2) * tp / denominator if denominator else 0.
+
+    def balanced_accuracy(self, threshold):
+        tn, fp, fn, tp = self.confusion(threshold)
+        tpr = tp / (tp + fn) if tp + fn else 0.
+        tnr = tn / (tn + fp) if tn + fp else 0.
+        return (tpr + tnr) / 2
+
+    def roc_curve(self):
+        """
+        Returns (fpr, tpr) from the highest threshold to the lowest
+        """
+        tp, fp = self._cumulative()
+        return fp / max(fp[-1], 1), tp / max(tp[-1], 1)
+
+    def roc_auc(self):
+        """
+        Area under the ROC curve
+        Scores within the same bin are treated as ties
+        """
+        tp, fp = self._cumulative()
+        if tp[-1] == 0 or fp[-1] == 0:
+            raise ValueError("ROC AUC is not defined with a single class present")
+        fpr = fp / fp[-1]
+        tpr = tp / tp[-1]
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def pr_curve(self):
+        """
+        Returns (precision, recall, thresholds) for every bin edge
+        in the increasing order of the threshold
+        """
+        tp, fp = self._cumulative()
+        # drop the point with the threshold above the overflow bin
+        tp, fp = tp[::-1][:-1], fp[::-1][:-1]
+        predicted = tp + fp
+        precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted > 0)
+        recall = tp / max(tp[0], 1)
+        thresholds = np.concatenate(([-np.inf], self.edges))
+        return precision, recall, thresholds
+
+    def __repr__(self):
+        return f"<StreamingBinaryMetrics bins={len(self.edges) + 1} samples={int(self.total)}>"
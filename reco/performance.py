@@ -0,0 +1,153 @@
+import sys
+import time
+import warnings
+from contextlib import nullcontext
+
+import torch
+from torch_geometric.data import Data
+
+
+class CompiledModel:
+    """
+    torch.compile-d model falling back to eager execution
+
+    Compilation happens lazily on the first call, so errors are caught there.
+    Everything except the call itself (train/eval, parameters, state_dict)
+    is delegated to the eager model, keeping checkpoints interchangeable.
+    """
+
+    def __init__(self, model, **compile_kwargs):
+        self.model = model
+        self.compiled = torch.compile(model, **compile_kwargs)
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as ex:
+                warnings.warn(f"torch.compile failed, falling back to eager mode: {ex}")
+                self.compiled = None
+        return self.model(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+class PerformanceMode:
+    """
+    Opt-in performance settings for the training helpers
+
+    - autocast: bfloat16 autocast (CPU and CUDA)
+    - compile: torch.compile the model
+    - fused: fused optimizer kernels
+
+    Each feature is used only when supported by the installed torch
+    and the device, otherwise the helpers run in plain float32 eager mode.
+    """
+
+    def __init__(self, autocast=True, compile=True, fused=True, dtype=torch.bfloat16, compile_kwargs=None):
+        self.autocast_enabled = autocast
+        self.compile_enabled = compile
+        self.fused_enabled = fused
+        self.dtype = dtype
+        self.compile_kwargs = compile_kwargs or {}
+
+    def autocast(self, device):
+        """
+        Autocast context for the forward pass
+        """
+        device_type = torch.device(device).type
+        if not self.autocast_enabled or device_type not in ("cpu", "cuda"):
+            return nullcontext()
+        if device_type == "cuda" and not torch.cuda.is_bf16_supported():
+            return nullcontext()
+        return torch.autocast(device_type=device_type, dtype=self.dtype)
+
+    def prepare_model(self, model):
+        if not self.compile_enabled or not hasattr(torch, "compile"):
+            return model
+        try:
+            return CompiledModel(model, **self.compile_kwargs)
+        except Exception as ex:
+            warnings.warn(f"torch.compile not available, using eager mode: {ex}")
+            return model
+
+    def make_optimizer(self, optimizer_cls, params, **kwargs):
+        """
+        Create the optimizer, with fused kernels when available
+        """
+        params = list(params)
+        if self.fused_enabled:
+            try:
+                return optimizer_cls(params, fused=True, **kwargs)
+            except (TypeError, RuntimeError, ValueError):
+                pass
+        return optimizer_cls(params, **kwargs)
+
+    def measure_speedup(self, model, sample, device, steps=10, warmup=3, prepared=None):
+        """
+        Time a forward and backward pass on the sample in plain float32 eager mode
+        and in the performance mode, print and return the timings
+
+        sample is a graph batch (Data) or a (features, labels) pair
+        prepared: the model already returned by prepare_model, so that the
+            training reuses the compiled graph instead of compiling twice
+        """
+        eager_time = _time_steps(model, sample, device, nullcontext, steps, warmup)
+
+        fast_model = self.prepare_model(model) if prepared is None else prepared
+        fast_time = _time_steps(fast_model, sample, device, lambda: self.autocast(device), steps, warmup)
+
+        speedup = eager_time / fast_time
+        print(
+            f"Step time: eager float32 {eager_time * 1000:.2f}ms,",
+            f"performance mode {fast_time * 1000:.2f}ms, speedup {speedup:.2f}x",
+            file=sys.stderr
+        )
+        return {"eager": eager_time, "performance": fast_time, "speedup": speedup}
+
+    def __repr__(self):
+        infos = [
+            f"autocast={self.autocast_enabled}",
+            f"compile={self.compile_enabled}",
+            f"fused={self.fused_enabled}",
+            f"dtype={self.dtype}",
+        ]
+        return f"<PerformanceMode {' '.join(infos)}>"
+
+
+def autocast(perf, device):
+    """
+    Autocast context of the performance mode, or a no-op without one
+    """
+    if perf is None:
+        return nullcontext()
+    return perf.autocast(device)
+
+
+def _forward(model, sample, device):
+    if isinstance(sample, Data):
+        sample = sample.to(device)
+        return model(sample.x, sample.edge_index)
+    batch, _ = sample
+    return model(batch.to(device))
+
+
+def _synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def _time_steps(model, sample, device, context, steps, warmup):
+    model.train()
+    for step in range(warmup + steps):
+        if step == warmup:
+            _synchronize(device)
+            start = time.perf_counter()
+        model.zero_grad()
+        with context():
+            out = _forward(model, sample, device)
+        out.float().sum().backward()
+    _synchronize(device)
+    model.zero_grad()
+    return (time.perf_counter() - start) / steps
@@ -0,0 +1,437 @@
+import sys
+import time
+import queue
+import threading
+from os import path, makedirs
+
+import torch
+import numpy as np
+import awkward as ak
+
+from torch_geometric.data import Batch
+
+from .data import prefetch_event_data
+from .datasetPU import get_event_pairs, get_event_graph, get_file_bigTs
+from .event import remap_tracksters
+from .evaluation import evaluate as evaluate_event
+
+
+_END = object()
+
+
+class _Failure:
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _Inbox:
+    """
+    Input of a stage: iterates the queue until the end marker,
+    re-raising the error of an upstream stage
+    """
+
+    def __init__(self, q, stop):
+        self.q = q
+        self.stop = stop
+        # time spent waiting for the upstream stage
+        self.waited = 0.
+
+    def _get(self, block=True):
+        while True:
+            if self.stop.is_set():
+                raise _Stopped()
+            start = time.perf_counter()
+            try:
+                item = self.q.get(timeout=0.1) if block else self.q.get_nowait()
+            except queue.Empty:
+                if not block:
+                    return None
+                continue
+            finally:
+                self.waited += time.perf_counter() - start
+            if isinstance(item, _Failure):
+                raise item.error
+            return item
+
+    def __iter__(self):
+        while True:
+            item = self._get()
+            if item is _END:
+                return
+            yield item
+
+    def batches(self, max_items):
+        """
+        Lists of up to max_items: waits for the first item, then takes what is already queued
+        """
+        while True:
+            item = self._get()
+            if item is _END:
+                return
+            batch = [item]
+            while len(batch) < max_items:
+                item = self._get(block=False)
+                if item is None:
+                    break
+                if item is _END:
+                    yield batch
+                    return
+                batch.append(item)
+            yield batch
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+    raise _Stopped()
+
+
+class StageStats:
+    """
+    Events out of a stage and the time spent on them (not waiting for input)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.
+
+    def __repr__(self):
+        return f"<StageStats {self.name} items={self.items} busy={self.busy:.2f}s>"
+
+
+class Event:
+    """
+    One event travelling through the pipeline
+    """
+
+    def __init__(self, source, eid, data, bigTs):
+        self.source = source
+        self.eid = eid
+        self.data = data
+        self.bigTs = bigTs
+        self.samples = None
+        self.truth = None
+        self.pair_index = []
+        self.preds = []
+        self.tracksters = None
+        self.scores = {}
+
+    def release(self):
+        """
+        Drop the file arrays and the samples once the event is merged
+        """
+        self.data = None
+        self.samples = None
+        self.truth = None
+
+    def __repr__(self):
+        return f"<Event {path.basename(self.source)}:{self.eid} pairs={len(self.pair_index)}>"
+
+
+class ReconstructionPipeline:
+    """
+    Streaming trackster linking: read -> candidates and features -> batched inference -> merge -> evaluation
+
+    Every stage runs in its own thread, connected by bounded queues, so
+    file reading (decompression), feature building and model execution
+    overlap; at most queue_size events wait between two stages.
+    Inference collects up to batch_events events into one model call.
+
+    model: pairwise model, model(x), or link prediction graph model, model(x, edge_index) with graph=True
+        e.g. a trained model or a reco.runtime.LinkingModel
+    scaler: feature normalisation (FeatureScaler) applied before the model
+    verbose: print the files as they are read
+
+    run(files) yields the merged events in order, write(files, target_path)
+    stores the merged tracksters as one Parquet file per input file.
+    """
+
+    def __init__(
+            self,
+            model,
+            radius=10,
+            bigT_e_th=50,
+            decision_th=0.5,
+            pileup=False,
+            collection="SC",
+            graph=False,
+            scaler=None,
+            evaluate=False,
+            batch_events=16,
+            queue_size=8,
+            prefetch=2,
+            device="cpu",
+            verbose=False,
+        ):
+        self.model = model
+        self.radius = radius
+        self.bigT_e_th = bigT_e_th
+        self.decision_th = decision_th
+        self.pileup = pileup
+        self.collection = collection
+        self.graph = graph
+        self.scaler = scaler
+        self.evaluate = evaluate
+        self.batch_events = batch_events
+        self.queue_size = queue_size
+        self.prefetch = prefetch
+        self.device = torch.device(device)
+        self.verbose = verbose
+        self.stats = {}
+
+    # stages
+
+    def read(self, files, entries=None):
+        event_data = prefetch_event_data(
+            files,
+            collection=self.collection,
+            pileup=self.pileup,
+            entries=entries,
+            depth=self.prefetch,
+        )
+        for source, data in event_data:
+            if self.verbose:
+                print(f"Reconstructing: {source}", file=sys.stderr)
+            cluster_data, trackster_data, _, assoc_data = data
+            bigTs = get_file_bigTs(
+                trackster_data,
+                assoc_data,
+                pileup=self.pileup,
+                energy_th=self.bigT_e_th,
+                collection=self.collection,
+            )
+            for eid in range(len(trackster_data["raw_energy"])):
+                yield Event(source, eid, data, bigTs[eid].tolist())
+
+    def build_features(self, events):
+        for event in events:
+            cluster_data, trackster_data, _, assoc_data = event.data
+            if self.graph:
+                event.samples = get_event_graph(
+                    cluster_data,
+                    trackster_data,
+                    assoc_data,
+                    event.eid,
+                    self.radius,
+                    pileup=self.pileup,
+                    bigT_e_th=self.bigT_e_th,
+                    collection=self.collection,
+                    link_prediction=True,
+                    bigTs=event.bigTs,
+                )
+                if self.scaler is not None:
+                    event.samples = [self.scaler(sample) for sample in event.samples]
+                for sample in event.samples:
+                    nidx = sample.node_index
+                    event.pair_index += [(nidx[a].item(), nidx[b].item()) for a, b in sample.edge_index.T]
+            else:
+                dX, event.truth, event.pair_index = get_event_pairs(
+                    cluster_data,
+                    trackster_data,
+                    assoc_data,
+                    event.eid,
+                    self.radius,
+                    pileup=self.pileup,
+                    bigT_e_th=self.bigT_e_th,
+                    collection=self.collection,
+                    bigTs=event.bigTs,
+                )
+                X = torch.tensor(dX, dtype=torch.float)
+                if self.scaler is not None and len(X):
+                    X = torch.as_tensor(self.scaler.transform(X), dtype=torch.float)
+                event.samples = X
+            yield event
+
+    def _predict(self, batch):
+        if self.graph:
+            graphs = [sample for event in batch for sample in event.samples]
+            if not graphs:
+                return []
+            data = Batch.from_data_list(graphs)
+            preds = self.model(data.x.to(self.device), data.edge_index.to(self.device))
+            sizes = [sum(sample.edge_index.shape[1] for sample in event.samples) for event in batch]
+        else:
+            X = [event.samples for event in batch if len(event.samples)]
+            if not X:
+                return []
+            preds = self.model(torch.cat(X).to(self.device))
+            sizes = [len(event.samples) for event in batch]
+        preds = preds.detach().cpu().reshape(-1)
+        return torch.split(preds, sizes)
+
+    def infer(self, inbox):
+        self.model.eval()
+        with torch.no_grad():
+            for batch in inbox.batches(self.batch_events):
+                for event, preds in zip(batch, self._predict(batch)):
+                    event.preds = preds.tolist()
+                yield from batch
+
+    def merge(self, events):
+        for event in events:
+            trackster_data = event.data[1]
+            event.tracksters = remap_tracksters(
+                trackster_data,
+                event.pair_index,
+                event.preds,
+                event.eid,
+                decision_th=self.decision_th,
+                pileup=self.pileup,
+                allow_multiple=self.graph,
+            )
+            yield event
+
+    def score(self, events):
+        """
+        BCubed of the merged and the CLUE3D tracksters against the simtracksters
+        """
+        p = "" if self.pileup else f"sts{self.collection}_"
+        for event in events:
+            cluster_data, trackster_data, simtrackster_data, _ = event.data
+            eid = event.eid
+            if event.pair_index:
+                clusters_e = cluster_data["energy"][eid]
+                nhits = cluster_data["cluster_number_of_hits"][eid]
+
+                si = simtrackster_data[f"{p}vertices_indexes"][eid]
+                sm = simtrackster_data[f"{p}vertices_multiplicity"][eid]
+                se = ak.Array([clusters_e[indices] for indices in si])
+
+                ci = trackster_data["vertices_indexes"][eid]
+                cm = trackster_data["vertices_multiplicity"][eid]
+                if self.pileup:
+                    p_list = list(set(b for _, b in event.pair_index))
+                    ci, cm = ci[p_list], cm[p_list]
+                ce = ak.Array([clusters_e[indices] for indices in ci])
+
+                ri = event.tracksters["vertices_indexes"]
+                rm = event.tracksters["vertices_multiplicity"]
+                re = ak.Array([clusters_e[indices] for indices in ri])
+
+                event.scores = {
+                    "clue3d_to_sim": evaluate_event(nhits, ci, si, ce, se, cm, sm),
+                    "reco_to_sim": evaluate_event(nhits, ri, si, re, se, rm, sm),
+                }
+            yield event
+
+    # plumbing
+
+    def _timed(self, name, stage, inbox):
+        stats = self.stats[name] = StageStats(name)
+        items = stage(inbox)
+        while True:
+            start = time.perf_counter()
+            waited = inbox.waited if inbox is not None else 0.
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                waited = (inbox.waited if inbox is not None else 0.) - waited
+                stats.busy += time.perf_counter() - start - waited
+            stats.items += 1
+            yield item
+
+    def _pump(self, name, stage, inbox, outbox, stop):
+        try:
+            for item in self._timed(name, stage, inbox):
+                _put(outbox, item, stop)
+            _put(outbox, _END, stop)
+        except _Stopped:
+            pass
+        except BaseException as ex:
+            try:
+                _put(outbox, _Failure(ex), stop)
+            except _Stopped:
+                pass
+
+    def run(self, files, entries=None):
+        """
+        Merged events of the files, in order (Event objects with tracksters and scores)
+
+        entries: {source: entries} to reconstruct only selected events (see get_event_data)
+        """
+        stages = [
+            ("features", self.build_features),
+            ("inference", self.infer),
+            ("merge", self.merge),
+        ]
+        if self.evaluate:
+            stages.append(("evaluation", self.score))
+
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(stages) + 1)]
+        threads = [threading.Thread(
+            target=self._pump,
+            args=("read", lambda _: self.read(files, entries=entries), None, queues[0], stop),
+            daemon=True,
+        )]
+        for (name, stage), inbox, outbox in zip(stages, queues[:-1], queues[1:]):
+            threads.append(threading.Thread(
+                target=self._pump,
+                args=(name, stage, _Inbox(inbox, stop), outbox, stop),
+                daemon=True,
+            ))
+
+        for thread in threads:
+            thread.start()
+        try:
+            for event in _Inbox(queues[-1], stop):
+                event.release()
+                yield event
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def write(self, files, target_path, entries=None):
+        """
+        Reconstruct the files into target_path, one Parquet file of merged tracksters per input file
+        Each row is an event: its index in the file (entry) and the trackster arrays.
+        Files without events (or without selected entries) get an empty table.
+        Returns the scores when evaluating.
+        """
+        makedirs(target_path, exist_ok=True)
+        scores = []
+        written = set()
+        empty = None
+        current, rows = None, []
+
+        def target(source):
+            return path.join(target_path, path.splitext(path.basename(source))[0] + ".tracksters.parquet")
+
+        def flush():
+            nonlocal empty
+            if current is not None:
+                table = ak.Array(rows)
+                ak.to_parquet(table, target(current))
+                written.add(current)
+                if empty is None:
+                    empty = table[:0]
+
+        for event in self.run(files, entries=entries):
+            if event.source != current:
+                flush()
+                current, rows = event.source, []
+            entry = event.eid if entries is None else int(np.asarray(entries[event.source])[event.eid])
+            rows.append({"entry": entry, **{k: ak.to_list(v) for k, v in event.tracksters.items()}})
+            if event.scores:
+                scores.append({"source": event.source, "entry": entry, **event.scores})
+        flush()
+
+        if empty is None:
+            empty = ak.Array({"entry": np.zeros(0, dtype=np.int64)})
+        for source in files:
+            if source not in written:
+                ak.to_parquet(empty, target(source))
+        return scores
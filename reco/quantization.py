@@ -0,0 +1,156 @@
+import sys
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+from .metrics import StreamingBinaryMetrics
+
+
+def fold_linear_batchnorm(linear, bn):
+    """
+    Linear layer computing linear followed by bn (in eval mode)
+    """
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    bias = linear.bias.detach() if linear.bias is not None else torch.zeros_like(bn.running_mean)
+
+    folded = nn.Linear(linear.in_features, linear.out_features, bias=True)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight.detach() * scale[:, None])
+        folded.bias.copy_((bias - bn.running_mean) * scale + bn.bias.detach())
+    return folded
+
+
+def fold_batchnorm_linear(bn, linear):
+    """
+    Linear layer computing bn (in eval mode) followed by linear
+    """
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias.detach() - bn.running_mean * scale
+    bias = linear.bias.detach() if linear.bias is not None else linear.weight.new_zeros(linear.out_features)
+
+    folded = nn.Linear(linear.in_features, linear.out_features, bias=True)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight.detach() * scale[None, :])
+        folded.bias.copy_(bias + linear.weight.detach() @ shift)
+    return folded
+
+
+def fold_batchnorm(model):
+    """
+    Copy of the model with every BatchNorm1d folded into the adjacent Linear:
+    the Linear before it, or else the Linear right after it (e.g. an input BatchNorm).
+    Applies to the nn.Sequential blocks at any depth (e.g. EdgeConvNet.convnetwork),
+    the model must be trained: the running statistics are used.
+    """
+    model = copy.deepcopy(model).eval()
+    _fold(model)
+    return model
+
+
+def _foldable(layer):
+    return isinstance(layer, nn.BatchNorm1d) and layer.track_running_stats
+
+
+def _fold(module):
+    for child in module.children():
+        _fold(child)
+
+    if not isinstance(module, nn.Sequential):
+        return
+
+    layers = list(module)
+    folded = []
+    for layer in layers:
+        if _foldable(layer) and folded and isinstance(folded[-1], nn.Linear):
+            folded[-1] = fold_linear_batchnorm(folded[-1], layer)
+        else:
+            folded.append(layer)
+
+    # the remaining BatchNorms go into the Linear after them
+    i = 0
+    while i < len(folded) - 1:
+        if _foldable(folded[i]) and isinstance(folded[i + 1], nn.Linear):
+            folded[i:i + 2] = [fold_batchnorm_linear(folded[i], folded[i + 1])]
+        i += 1
+
+    if len(folded) != len(layers):
+        for key in list(module._modules):
+            del module._modules[key]
+        for i, layer in enumerate(folded):
+            module.add_module(str(i), layer)
+
+
+def quantize_model(model, fold=True, dtype=torch.qint8):
+    """
+    Dynamic int8 quantization of the nn.Linear layers for CPU inference
+    Weights are stored in int8, activations are quantized on the fly per batch,
+    so no calibration data is needed. BatchNorm is folded into Linear first.
+    """
+    model = fold_batchnorm(model) if fold else copy.deepcopy(model).eval()
+    return torch.ao.quantization.quantize_dynamic(model.cpu(), {nn.Linear}, dtype=dtype)
+
+
+@torch.no_grad()
+def quantization_check(model, test_dl, quantized=None, truth_threshold=0.7, num_threads=None):
+    """
+    Compare the quantized model to the float model on a held-out pair dataloader
+    (e.g. a split of TracksterPairs with the scaled features)
+
+    Returns the ROC AUC of both models, the AUC drift, the largest prediction
+    difference and the CPU throughput (pairs per second) of both models.
+    num_threads: torch threads for the comparison, the previous setting is restored
+    """
+    threads = torch.get_num_threads()
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    try:
+        return _quantization_check(model, test_dl, quantized, truth_threshold)
+    finally:
+        torch.set_num_threads(threads)
+
+
+def _quantization_check(model, test_dl, quantized, truth_threshold):
+    model = copy.deepcopy(model).cpu().eval()
+    if quantized is None:
+        quantized = quantize_model(model)
+
+    metrics = {
+        "float": StreamingBinaryMetrics(truth_threshold=truth_threshold),
+        "int8": StreamingBinaryMetrics(truth_threshold=truth_threshold),
+    }
+    timing = {"float": 0., "int8": 0.}
+    max_diff = 0.
+    rows = 0
+
+    for b, l in test_dl:
+        b = b.float()
+        preds = {}
+        for name, m in (("float", model), ("int8", quantized)):
+            start = time.perf_counter()
+            preds[name] = m(b).reshape(-1)
+            timing[name] += time.perf_counter() - start
+            metrics[name].update(preds[name], l)
+        max_diff = max(max_diff, (preds["float"] - preds["int8"]).abs().max().item())
+        rows += len(b)
+
+    result = {
+        "auc_float": metrics["float"].roc_auc(),
+        "auc_int8": metrics["int8"].roc_auc(),
+        "max_pred_diff": max_diff,
+        "pairs": rows,
+        "pairs_per_second_float": rows / timing["float"],
+        "pairs_per_second_int8": rows / timing["int8"],
+    }
+    result["auc_drift"] = result["auc_int8"] - result["auc_float"]
+    result["speedup"] = timing["float"] / timing["int8"]
+
+    print(
+        f"ROC AUC: float {result['auc_float']:.5f}, int8 {result['auc_int8']:.5f}",
+        f"(drift {result['auc_drift']:+.5f}), max prediction difference {max_diff:.4f};",
+        f"throughput: float {result['pairs_per_second_float']:.0f}/s,",
+        f"int8 {result['pairs_per_second_int8']:.0f}/s, speedup {result['speedup']:.2f}x",
+        file=sys.stderr
+    )
+    return result
@@ -0,0 +1,121 @@
+import json
+
+import torch
+
+
+SCHEMA_FILE = "schema.json"
+
+
+def knn_graph(pos, k, loop=False):
+    """
+    k-NN graph compatible with torch_cluster.knn_graph (source_to_target flow):
+    edge_index[1] is the center node, edge_index[0] its neighbours
+    """
+    n = len(pos)
+    if n == 0:
+        return torch.empty((2, 0), dtype=torch.long)
+
+    dist = torch.cdist(pos, pos)
+    if not loop:
+        dist.fill_diagonal_(float("inf"))
+
+    k = min(k, n if loop else n - 1)
+    if k <= 0:
+        return torch.empty((2, 0), dtype=torch.long)
+
+    neighbours = dist.topk(k, largest=False).indices
+    centers = torch.arange(n, device=pos.device).repeat_interleave(k)
+    return torch.stack((neighbours.reshape(-1), centers))
+
+
+class LinkingModel:
+    """
+    Exported model with its feature schema (see reco.export)
+
+    Only depends on torch (and onnxruntime for ONNX artefacts),
+    so it can run in a reconstruction job without the research code.
+
+    Callable like the original model: model(x) or model(x, edge_index),
+    so it can be passed to reco.evaluation.model_evaluation.
+    """
+
+    def __init__(self, path, device="cpu", num_threads=None):
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        self.path = path
+        self.device = torch.device(device)
+
+        if path.endswith(".onnx"):
+            import onnxruntime
+            with open(f"{path}.json") as f:
+                self.schema = json.load(f)
+            self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+            self.module = None
+        else:
+            extra_files = {SCHEMA_FILE: ""}
+            self.module = torch.jit.load(path, map_location=self.device, _extra_files=extra_files)
+            self.module.eval()
+            self.schema = json.loads(extra_files[SCHEMA_FILE])
+            self.session = None
+
+        norm = self.schema.get("normalisation")
+        if norm:
+            self.mean = torch.tensor(norm["mean"], dtype=torch.float, device=self.device)
+            self.std = torch.tensor(norm["std"], dtype=torch.float, device=self.device)
+        else:
+            self.mean = self.std = None
+
+    @property
+    def feature_keys(self):
+        return self.schema["feature_keys"]
+
+    @property
+    def is_graph(self):
+        return self.schema["input_type"] == "graph"
+
+    def eval(self):
+        return self
+
+    def normalise(self, x):
+        x = torch.as_tensor(x, dtype=torch.float).to(self.device)
+        if self.mean is None:
+            return x
+        return (x - self.mean) / self.std
+
+    def build_edges(self, x):
+        knn = self.schema.get("knn")
+        if not knn:
+            raise ValueError("The model needs edges and the schema has no k-NN settings")
+        a, b = knn.get("pos_slice", (0, 3))
+        return knn_graph(x[:, a:b], knn["k"], loop=knn.get("loop", False)).to(self.device)
+
+    @torch.no_grad()
+    def __call__(self, x, edge_index=None):
+        # k-NN uses the raw positions, the model the normalised features
+        if self.is_graph and edge_index is None:
+            edge_index = self.build_edges(torch.as_tensor(x, dtype=torch.float).to(self.device))
+
+        inputs = [self.normalise(x)]
+        if self.is_graph:
+            inputs.append(torch.as_tensor(edge_index, dtype=torch.long).to(self.device))
+
+        if self.session is not None:
+            names = [i.name for i in self.session.get_inputs()]
+            feed = {n: t.cpu().numpy() for n, t in zip(names, inputs)}
+            return torch.from_numpy(self.session.run(None, feed)[0])
+
+        return self.module(*inputs)
+
+    def score_event(self, sample):
+        """
+        Score a prepared event sample (Data-like object or dict with x / edge_index)
+        """
+        if isinstance(sample, dict):
+            x, edge_index = sample["x"], sample.get("edge_index")
+        else:
+            x, edge_index = sample.x, getattr(sample, "edge_index", None)
+        return self(x, edge_index).reshape(-1)
+
+    def __repr__(self):
+        return f"<LinkingModel {self.path} input={self.schema['input_type']} features={len(self.feature_keys)}>"
@@ -0,0 +1,88 @@
+import numpy as np
+import torch
+
+from torch.utils.data import Sampler, Subset
+
+
+def graph_sizes(dataset, key="x"):
+    """
+    Number of nodes (key="x") or edges (key="edge_index") of each graph
+
+    Read from the collated slices of an InMemoryDataset (also through
+    random_split subsets), so no graph is materialised.
+    Other datasets fall back to iterating the graphs.
+    """
+    if isinstance(dataset, Subset):
+        return graph_sizes(dataset.dataset, key=key)[np.asarray(dataset.indices)]
+
+    slices = getattr(dataset, "slices", None)
+    if slices is not None and key in slices:
+        sizes = np.diff(slices[key].numpy())
+        return sizes[np.asarray(dataset.indices())]
+
+    if key == "x":
+        return np.array([data.num_nodes for data in dataset])
+    return np.array([data[key].shape[-1] for data in dataset])
+
+
+class NodeBudgetBatchSampler(Sampler):
+    """
+    Batches of graphs filled up to a node budget instead of a fixed graph count
+
+    Each epoch, the graphs are shuffled, split into buckets of `bucket_size`,
+    sorted by size within a bucket and packed greedily until the next graph
+    would exceed max_nodes. The batch order is shuffled again, so the batches
+    differ between epochs while graphs of similar size end up together.
+    Graphs larger than the budget get a batch of their own.
+
+    sizes: cost per graph, e.g. graph_sizes(dataset)
+    """
+
+    def __init__(self, sizes, max_nodes, shuffle=True, bucket_size=1024, generator=None):
+        self.sizes = np.asarray(sizes)
+        self.max_nodes = max_nodes
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.generator = generator
+        self._batches = None
+
+    def _permutation(self, n):
+        if not self.shuffle:
+            return np.arange(n)
+        return torch.randperm(n, generator=self.generator).numpy()
+
+    def _plan(self):
+        order = self._permutation(len(self.sizes))
+
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.sizes[bucket], kind="stable")]
+
+            batch, nodes = [], 0
+            for idx in bucket.tolist():
+                size = self.sizes[idx]
+                if batch and nodes + size > self.max_nodes:
+                    batches.append(batch)
+                    batch, nodes = [], 0
+                batch.append(idx)
+                nodes += size
+            if batch:
+                batches.append(batch)
+
+        return [batches[i] for i in self._permutation(len(batches))]
+
+    def __iter__(self):
+        if self._batches is None:
+            self._batches = self._plan()
+        batches, self._batches = self._batches, None
+        return iter(batches)
+
+    def __len__(self):
+        # the number of batches depends on the shuffling, plan the next epoch
+        if self._batches is None:
+            self._batches = self._plan()
+        return len(self._batches)
+
+    def __repr__(self):
+        return f"<NodeBudgetBatchSampler graphs={len(self.sizes)} max_nodes={self.max_nodes}>"
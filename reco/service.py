@@ -0,0 +1,487 @@
+import os
+import sys
+import json
+import time
+import queue
+import struct
+import shutil
+import secrets
+import tempfile
+import threading
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import torch
+import numpy as np
+
+
+# the only array types on the wire: features and edge indices
+WIRE_DTYPES = (np.dtype("<f4"), np.dtype("<i8"))
+
+
+def pack_message(header, arrays=()):
+    """
+    Message bytes: header length, JSON header, raw array buffers
+    No pickle on the wire, a message can only carry numbers and arrays.
+    """
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays=[(a.dtype.str, list(a.shape)) for a in arrays])
+    head = json.dumps(header).encode()
+    return b"".join([struct.pack("<I", len(head)), head] + [a.tobytes() for a in arrays])
+
+
+def unpack_message(buf):
+    """
+    Header and arrays of a message from pack_message, ValueError when malformed
+    """
+    try:
+        (n,) = struct.unpack_from("<I", buf)
+        header = json.loads(bytes(buf[4:4 + n]))
+        specs = header.pop("arrays")
+
+        offset = 4 + n
+        arrays = []
+        for dtype, shape in specs:
+            dtype = np.dtype(dtype)
+            if dtype not in WIRE_DTYPES or any(not isinstance(d, int) or d < 0 for d in shape):
+                raise ValueError(f"Unsupported array: {dtype} {shape}")
+            size = int(np.prod(shape)) * dtype.itemsize
+            if offset + size > len(buf):
+                raise ValueError("Truncated message")
+            arrays.append(np.frombuffer(buf, dtype=dtype, count=size // dtype.itemsize, offset=offset).reshape(shape))
+            offset += size
+        if offset != len(buf):
+            raise ValueError("Trailing bytes in message")
+    except ValueError as ex:
+        raise ValueError(f"Malformed message: {ex}") from None
+    except (struct.error, KeyError, TypeError, AttributeError) as ex:
+        raise ValueError(f"Malformed message: {type(ex).__name__}: {ex}") from None
+    return header, arrays
+
+
+def write_key(key_file, authkey):
+    """
+    Store the service key readable by the owner only (0600)
+    """
+    tmp = f"{key_file}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(authkey.hex())
+    os.replace(tmp, key_file)
+
+
+def read_key(key_file):
+    with open(key_file) as f:
+        return bytes.fromhex(f.read().strip())
+
+
+def _send(conn, lock, header, arrays=()):
+    with lock:
+        try:
+            conn.send_bytes(pack_message(header, arrays))
+        except (OSError, EOFError):
+            # the client went away, nothing to answer to
+            pass
+
+
+class _Request:
+
+    def __init__(self, conn, lock, rid, x, edge_index):
+        self.conn = conn
+        self.lock = lock
+        self.rid = rid
+        self.x = x
+        self.edge_index = edge_index
+        self.arrived = time.perf_counter()
+
+    @property
+    def key(self):
+        # only requests of the same kind and width share a batch
+        return (self.edge_index is None, self.x.shape[1:])
+
+    def reply(self, header, arrays=()):
+        _send(self.conn, self.lock, dict(header, rid=self.rid), arrays)
+
+
+class ServiceStats:
+    """
+    Counters of the inference service
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+        self.busy = 0.
+        self.latency = 0.
+        self.max_queue_depth = 0
+
+    def as_dict(self, queue_depth=0):
+        uptime = time.perf_counter() - self.started
+        return {
+            "uptime": uptime,
+            "requests": self.requests,
+            "rows": self.rows,
+            "batches": self.batches,
+            "errors": self.errors,
+            "mean_batch_requests": self.requests / self.batches if self.batches else 0.,
+            "mean_batch_rows": self.rows / self.batches if self.batches else 0.,
+            "mean_latency": self.latency / self.requests if self.requests else 0.,
+            "rows_per_second": self.rows / uptime if uptime else 0.,
+            "model_rows_per_second": self.rows / self.busy if self.busy else 0.,
+            "queue_depth": queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+class InferenceService:
+    """
+    Local scoring service: keeps one copy of the linking model warm
+    and serves the jobs of its owner on the node through a Unix socket
+
+    Concurrent requests are merged into dynamic batches: the oldest waiting
+    request opens a batch of requests of its kind (in arrival order), which
+    is run when it holds max_batch_rows rows or once max_latency seconds
+    have passed since that request arrived.
+    Requests are checked when they arrive, a malformed one is answered
+    with an error and never reaches a batch.
+    Pair requests are concatenated, graph requests are joined into one
+    disconnected graph (edge indices shifted) and the outputs split back.
+
+    Clients authenticate with a random key of the service, written to
+    key_file (default `<socket>.key`, mode 0600) for the clients of the
+    same user. The socket is created with mode 0600 as well and the
+    messages are raw arrays with a JSON header (no pickle).
+
+    model: anything callable as model(x) or model(x, edge_index)
+        e.g. a trained model or a reco.runtime.LinkingModel
+    address: Unix socket path, a new private directory when None,
+        or (host, port) if really needed (the key then only protects it)
+    n_features: expected width of x, by default from the schema of a LinkingModel
+    graph_output: "edges" for link prediction, "nodes" for node classification
+
+        service = InferenceService(LinkingModel("model.pt"), "/run/user/1000/linking.sock").start()
+        model = ServiceClient("/run/user/1000/linking.sock")
+        model_evaluation(..., model, ...)
+    """
+
+    def __init__(
+            self,
+            model,
+            address=None,
+            max_batch_rows=65536,
+            max_latency=0.005,
+            graph_output="edges",
+            device="cpu",
+            key_file=None,
+            n_features=None,
+        ):
+        if graph_output not in ("edges", "nodes"):
+            raise ValueError(f"Unknown graph_output: {graph_output}")
+
+        self.model = model
+        self.max_batch_rows = max_batch_rows
+        self.max_latency = max_latency
+        self.graph_output = graph_output
+        self.device = torch.device(device)
+        self.stats = ServiceStats()
+        if n_features is None and hasattr(model, "feature_keys"):
+            n_features = len(model.feature_keys)
+        self.n_features = n_features
+
+        self.private_dir = None
+        if address is None:
+            self.private_dir = tempfile.mkdtemp(prefix="reco-linking-")
+            address = os.path.join(self.private_dir, "service.sock")
+
+        self.authkey = secrets.token_bytes(32)
+        self.listener = Listener(address, backlog=64, authkey=self.authkey)
+        if isinstance(address, str):
+            os.chmod(address, 0o600)
+            if key_file is None:
+                key_file = f"{address}.key"
+        self.key_file = key_file
+        if key_file is not None:
+            write_key(key_file, self.authkey)
+
+        self.requests = queue.Queue()
+        # requests taken from the queue, per kind (see _Request.key), in arrival order
+        self.pending = {}
+        self.n_pending = 0
+        self.closed = threading.Event()
+        self.threads = []
+        self.connections = []
+
+        if hasattr(self.model, "to"):
+            self.model.to(self.device)
+        self.model.eval()
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def start(self):
+        """
+        Serve in background threads
+        """
+        for target in (self._accept, self._batcher):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        print(f"Serving on {self.address}", file=sys.stderr)
+        return self
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while not self.closed.is_set():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        # wake up the accepting thread
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except (OSError, EOFError, AuthenticationError):
+            pass
+        self.listener.close()
+        for conn in list(self.connections):
+            conn.close()
+        for thread in self.threads:
+            thread.join(timeout=1)
+        if self.key_file is not None and os.path.exists(self.key_file):
+            os.remove(self.key_file)
+        if self.private_dir is not None:
+            shutil.rmtree(self.private_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    # connections
+
+    def _accept(self):
+        while not self.closed.is_set():
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # closed listener or a failed handshake
+                continue
+            if self.closed.is_set():
+                conn.close()
+                return
+            self.connections.append(conn)
+            threading.Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def _receive(self, conn):
+        lock = threading.Lock()
+        try:
+            while not self.closed.is_set():
+                buf = conn.recv_bytes()
+                try:
+                    header, arrays = unpack_message(buf)
+                    kind, rid = header.get("kind"), header.get("rid")
+                except ValueError as ex:
+                    _send(conn, lock, {"status": "error", "rid": None, "message": str(ex)})
+                    continue
+
+                if kind == "predict" and len(arrays) not in (1, 2):
+                    self.stats.errors += 1
+                    message = f"Malformed message: predict takes x and an optional edge_index, got {len(arrays)} arrays"
+                    _send(conn, lock, {"status": "error", "rid": rid, "message": message})
+                elif kind == "predict":
+                    x = arrays[0]
+                    edge_index = arrays[1] if len(arrays) == 2 else None
+                    error = self._check(x, edge_index)
+                    if error:
+                        self.stats.errors += 1
+                        _send(conn, lock, {"status": "error", "rid": rid, "message": error})
+                        continue
+                    if edge_index is None and getattr(self.model, "is_graph", False):
+                        # exported graph models build their k-NN edges per event, not per batch
+                        edge_index = self.model.build_edges(torch.as_tensor(x, dtype=torch.float)).cpu().numpy()
+                    self.requests.put(_Request(conn, lock, rid, x, edge_index))
+                    self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.queue_depth)
+                elif kind == "stats":
+                    stats = self.stats.as_dict(self.queue_depth)
+                    _send(conn, lock, {"status": "ok", "rid": rid, "stats": stats})
+                else:
+                    _send(conn, lock, {"status": "error", "rid": rid, "message": f"Unknown request: {kind}"})
+        except (OSError, EOFError):
+            pass
+        finally:
+            if conn in self.connections:
+                self.connections.remove(conn)
+            conn.close()
+
+    def _check(self, x, edge_index):
+        """
+        Error message for a request the model cannot run, None if it is fine
+        """
+        if x.ndim != 2:
+            return f"x must be (rows, features), got shape {list(x.shape)}"
+        if self.n_features is not None and x.shape[1] != self.n_features:
+            return f"x has {x.shape[1]} features, the model expects {self.n_features}"
+        if edge_index is not None:
+            if edge_index.ndim != 2 or edge_index.shape[0] != 2:
+                return f"edge_index must be (2, edges), got shape {list(edge_index.shape)}"
+            if edge_index.size and (edge_index.min() < 0 or edge_index.max() >= len(x)):
+                return f"edge_index out of range for {len(x)} nodes"
+        return None
+
+    @property
+    def queue_depth(self):
+        return self.requests.qsize() + self.n_pending
+
+    # batching
+
+    def _drain(self, timeout=0):
+        """
+        Move the queued requests to their pending lists, waiting up to timeout for one
+        Returns False if none came
+        """
+        try:
+            request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+        except queue.Empty:
+            return False
+        while True:
+            self.pending.setdefault(request.key, deque()).append(request)
+            self.n_pending += 1
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                return True
+
+    def _collect(self):
+        """
+        Next batch: requests of the kind of the oldest pending request, in arrival order
+        """
+        key = min(self.pending, key=lambda k: self.pending[k][0].arrived)
+        waiting = self.pending[key]
+        deadline = waiting[0].arrived + self.max_latency
+        while sum(len(r.x) for r in waiting) < self.max_batch_rows:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0 or self.closed.is_set():
+                break
+            self._drain(timeout)
+
+        batch, rows = [], 0
+        while waiting and (not batch or rows + len(waiting[0].x) <= self.max_batch_rows):
+            request = waiting.popleft()
+            batch.append(request)
+            rows += len(request.x)
+        if not waiting:
+            del self.pending[key]
+        self.n_pending -= len(batch)
+        return batch
+
+    def _batcher(self):
+        with torch.no_grad():
+            while not self.closed.is_set():
+                if not self._drain(0.1 if not self.pending else 0) and not self.pending:
+                    continue
+                batch = self._collect()
+                start = time.perf_counter()
+                try:
+                    outputs = self._predict(batch)
+                except Exception as ex:
+                    self.stats.errors += len(batch)
+                    for request in batch:
+                        request.reply({"status": "error", "message": repr(ex)})
+                    continue
+                done = time.perf_counter()
+
+                self.stats.batches += 1
+                self.stats.busy += done - start
+                for request, output in zip(batch, outputs):
+                    self.stats.requests += 1
+                    self.stats.rows += len(request.x)
+                    self.stats.latency += done - request.arrived
+                    request.reply({"status": "ok"}, [output])
+
+    def _predict(self, batch):
+        x = torch.as_tensor(np.concatenate([r.x for r in batch]), dtype=torch.float).to(self.device)
+        if batch[0].edge_index is None:
+            preds = self.model(x)
+            sizes = [len(r.x) for r in batch]
+        else:
+            offsets = np.cumsum([0] + [len(r.x) for r in batch[:-1]])
+            edge_index = np.concatenate([r.edge_index + o for r, o in zip(batch, offsets)], axis=1)
+            preds = self.model(x, torch.as_tensor(edge_index, dtype=torch.long).to(self.device))
+            if self.graph_output == "edges":
+                sizes = [r.edge_index.shape[1] for r in batch]
+            else:
+                sizes = [len(r.x) for r in batch]
+        preds = torch.as_tensor(preds).detach().cpu().float()
+        return [p.numpy() for p in torch.split(preds, sizes)]
+
+
+class ServiceClient:
+    """
+    Model-like handle to an InferenceService: client(x) or client(x, edge_index)
+    returns the predictions as a CPU tensor, so it can replace the model
+    in model_evaluation and the other evaluation helpers.
+    Calls from several threads are serialised on the connection.
+
+    The key is read from key_file (default `<socket>.key`, written by the service)
+    unless given as authkey.
+    """
+
+    def __init__(self, address, authkey=None, key_file=None):
+        if authkey is None:
+            if key_file is None and isinstance(address, str):
+                key_file = f"{address}.key"
+            if key_file is None:
+                raise ValueError("The service key is needed: pass authkey or key_file")
+            authkey = read_key(key_file)
+        self.address = address
+        self.conn = Client(address, authkey=authkey)
+        self.lock = threading.Lock()
+        self.rid = 0
+
+    def _request(self, kind, arrays=()):
+        with self.lock:
+            self.rid += 1
+            self.conn.send_bytes(pack_message({"kind": kind, "rid": self.rid}, arrays))
+            header, result = unpack_message(self.conn.recv_bytes())
+        if header["status"] != "ok":
+            raise RuntimeError(f"Inference service: {header['message']}")
+        return header, result
+
+    def __call__(self, x, edge_index=None):
+        arrays = [torch.as_tensor(x, dtype=torch.float).detach().cpu().numpy()]
+        if edge_index is not None:
+            arrays.append(torch.as_tensor(edge_index, dtype=torch.long).detach().cpu().numpy())
+        _, (preds,) = self._request("predict", arrays)
+        # the buffer of the message is read-only
+        return torch.from_numpy(preds.copy())
+
+    def eval(self):
+        return self
+
+    def stats(self):
+        header, _ = self._request("stats")
+        return header["stats"]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f"<ServiceClient {self.address}>"
@@ -0,0 +1,126 @@
+import sys
+import json
+from os import walk, path, makedirs, replace
+
+import numpy as np
+import uproot
+import awkward as ak
+import pyarrow.parquet as pq
+
+from .data import ARRAYS, FEATURE_KEYS, CLUSTER_KEYS, SKIM_EXTENSION, SKIM_METADATA_KEY, skim_column
+
+
+SKIM_VERSION = 1
+
+SIM_KEYS = [
+    "raw_energy",
+    "vertices_indexes",
+    "vertices_energy",
+    "vertices_multiplicity",
+    "vertices_x",
+    "vertices_y",
+    "vertices_z",
+    "barycenter_z",
+    "NTracksters",
+]
+
+
+def skim_branches(collection="SC"):
+    """
+    Branches kept by the skim, per ticlNtuplizer tree
+    Branches missing in an ntuple are skipped.
+    """
+    return {
+        "tracksters": ARRAYS + FEATURE_KEYS + ["id_probabilities", "NTracksters", "event"],
+        "clusters": CLUSTER_KEYS + [
+            "position_eta",
+            "position_phi",
+            "cluster_local_density",
+            "cluster_layer_id",
+            "cluster_radius",
+        ],
+        # pileup samples come without the collection prefix
+        f"simtracksters{collection}": SIM_KEYS + [f"sts{collection}_{k}" for k in SIM_KEYS],
+        "associations": [
+            f"tsCLUE3D_{direction}_{collection}{suffix}"
+            for direction in ("recoToSim", "simToReco")
+            for suffix in ("", "_sharedE", "_score")
+        ],
+        "graph": ["linked_inners"],
+    }
+
+
+def skim_file(source, target, collection="SC", step_size=100):
+    """
+    Convert one ntuple to a Parquet file with the branches used by the reco package
+
+    Every `step_size` events form a row group, so event ranges can be read
+    without decoding the whole file. The branches and the event index
+    (first event of each row group) are stored in the file metadata.
+    An ntuple without events gives a file with the schema and no rows.
+    """
+    trees = {}
+    for tree, branches in skim_branches(collection).items():
+        ttree = uproot.open({source: f"ticlNtuplizer/{tree}"})
+        keys = set(ttree.keys())
+        trees[tree] = (ttree, [b for b in branches if b in keys])
+
+    n_events = {ttree.num_entries for ttree, _ in trees.values()}
+    if len(n_events) != 1:
+        raise ValueError(f"Trees of {source} differ in the number of events: {n_events}")
+    n_events = n_events.pop()
+
+    metadata = {
+        "version": SKIM_VERSION,
+        "source": source,
+        "collection": collection,
+        "events": n_events,
+        "row_group_starts": list(range(0, n_events, step_size)),
+        "branches": {tree: branches for tree, (_, branches) in trees.items()},
+    }
+
+    writer = None
+    try:
+        # an empty ntuple still writes one (empty) table for the schema
+        for start in metadata["row_group_starts"] or [0]:
+            stop = min(start + step_size, n_events)
+            columns = {"entry": np.arange(start, stop)}
+            for tree, (ttree, branches) in trees.items():
+                arrays = ttree.arrays(branches, entry_start=start, entry_stop=stop)
+                for b in branches:
+                    columns[skim_column(tree, b)] = arrays[b]
+
+            table = ak.to_arrow_table(ak.zip(columns, depth_limit=1), extensionarray=False)
+            if writer is None:
+                schema = table.schema.with_metadata({SKIM_METADATA_KEY: json.dumps(metadata)})
+                writer = pq.ParquetWriter(target, schema, compression="zstd")
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return metadata
+
+
+def skim_directory(raw_data_path, target_path, collection="SC", step_size=100, N_FILES=None):
+    """
+    Skim every ntuple of the directory into `target_path`, keeping the file names
+    Already skimmed files are skipped, so the job can be restarted.
+    """
+    files = []
+    for (_, _, filenames) in walk(raw_data_path):
+        files.extend(filenames)
+        break
+    files = sorted(f for f in files if f.endswith(".root"))[:N_FILES]
+
+    makedirs(target_path, exist_ok=True)
+    skimmed = []
+    for fn in files:
+        target = path.join(target_path, path.splitext(fn)[0] + SKIM_EXTENSION)
+        if not path.exists(target):
+            print(f"Skimming: {fn}", file=sys.stderr)
+            # write to a temporary name, a killed job leaves no partial file behind
+            skim_file(path.join(raw_data_path, fn), f"{target}.tmp", collection=collection, step_size=step_size)
+            replace(f"{target}.tmp", target)
+        skimmed.append(target)
+    return skimmed
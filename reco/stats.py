@@ -0,0 +1,241 @@
+from os import path
+
+import numpy as np
+import torch
+
+
+LABEL_THRESHOLDS = (0.5, 0.7, 0.8)
+
+
+class RunningStats:
+    """
+    Streaming per-feature count, mean, variance, min and max
+
+    Batches are merged with the parallel Welford update (Chan et al.),
+    so the statistics are exact and need a single pass over the data.
+    """
+
+    def __init__(self, n_features=None):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        if n_features is not None:
+            self._init(n_features)
+
+    def _init(self, n_features):
+        self.mean = torch.zeros(n_features, dtype=torch.float64)
+        self.m2 = torch.zeros(n_features, dtype=torch.float64)
+        self.min = torch.full((n_features,), float("inf"), dtype=torch.float64)
+        self.max = torch.full((n_features,), float("-inf"), dtype=torch.float64)
+
+    def update(self, x):
+        """
+        Add a batch of samples (rows) to the statistics
+        """
+        x = torch.as_tensor(np.asarray(x) if not torch.is_tensor(x) else x, dtype=torch.float64)
+        if x.numel() == 0:
+            return self
+        x = x.reshape(len(x), -1)
+        if self.mean is None:
+            self._init(x.shape[1])
+
+        n = len(x)
+        mean = x.mean(dim=0)
+        m2 = ((x - mean) ** 2).sum(dim=0)
+        self._merge(n, mean, m2, x.min(dim=0).values, x.max(dim=0).values)
+        return self
+
+    def _merge(self, n, mean, m2, x_min, x_max):
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * n / total)
+        self.min = torch.minimum(self.min, x_min)
+        self.max = torch.maximum(self.max, x_max)
+        self.count = total
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.mean is None:
+            self._init(len(other.mean))
+        self._merge(other.count, other.mean, other.m2, other.min, other.max)
+        return self
+
+    @property
+    def var(self):
+        if self.m2 is None:
+            return None
+        return self.m2 / max(self.count - 1, 1)
+
+    @property
+    def std(self):
+        if self.m2 is None:
+            return None
+        return self.var.sqrt()
+
+    def state_dict(self):
+        return {k: getattr(self, k) for k in ("count", "mean", "m2", "min", "max")}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        stats = cls()
+        for k, v in state.items():
+            setattr(stats, k, v)
+        return stats
+
+    def __repr__(self):
+        return f"<RunningStats count={self.count} features={0 if self.mean is None else len(self.mean)}>"
+
+
+class FeatureScaler:
+    """
+    Normalise the features with the dataset statistics: (x - mean) / std
+
+    Used as a dataset transform (normalises data.x of a graph), or through
+    `transform` on a feature matrix like the scaler of model_evaluation.
+    The same statistics go into the export schema (see `normalisation`),
+    so no normalisation layer is needed in the model.
+    """
+
+    def __init__(self, mean, std, eps=1e-6):
+        self.mean = torch.as_tensor(mean, dtype=torch.float)
+        self.std = torch.as_tensor(std, dtype=torch.float).clamp_min(eps)
+        # multiply by the inverse, one fused op per element
+        self.inv_std = 1. / self.std
+
+    @classmethod
+    def from_stats(cls, stats, eps=1e-6):
+        if isinstance(stats, dict):
+            stats = RunningStats.from_state_dict(stats)
+        if stats.mean is None or stats.count == 0:
+            raise ValueError("No feature statistics: the dataset has no samples (check the radius and bigT_e_th)")
+        return cls(stats.mean, stats.std, eps=eps)
+
+    def transform(self, X):
+        X = torch.as_tensor(X, dtype=torch.float)
+        return torch.addcmul(-self.mean * self.inv_std, X, self.inv_std)
+
+    def __call__(self, data):
+        data.x = self.transform(data.x)
+        return data
+
+    @property
+    def normalisation(self):
+        return {"mean": self.mean, "std": self.std}
+
+    def __repr__(self):
+        return f"<FeatureScaler features={len(self.mean)}>"
+
+
+def add_focus_mask(data, slices):
+    """
+    Store the mask of the non-focus nodes (focus feature in x[:, 0])
+    on the collated dataset tensors, in place
+    """
+    data.mask = data.x[:, 0] == 0
+    slices["mask"] = slices["x"].clone()
+
+
+def label_stats(y, thresholds=LABEL_THRESHOLDS, bins=20):
+    y = torch.as_tensor(y, dtype=torch.float).reshape(-1)
+    return {
+        "labels": len(y),
+        "label_bins": torch.linspace(0, 1, bins + 1),
+        "label_hist": torch.histc(y, bins=bins, min=0, max=1).long(),
+        "positive_fraction": {th: float((y > th).double().mean()) if len(y) else 0. for th in thresholds},
+    }
+
+
+def feature_stats(features):
+    """
+    Stored form of the RunningStats, mean and std are None without samples
+    """
+    return {
+        "features": features.state_dict(),
+        "feature_mean": features.mean.float() if features.mean is not None else None,
+        "feature_std": features.std.float() if features.std is not None else None,
+    }
+
+
+def graph_dataset_stats(data, slices, features=None, thresholds=LABEL_THRESHOLDS, bins=20):
+    """
+    Label and feature statistics of a collated graph dataset
+
+    Labels are counted under the node mask when the dataset has one.
+    features: RunningStats accumulated while building the dataset,
+        computed from the collated features when missing
+    """
+    y = data.y
+    mask = getattr(data, "mask", None)
+    if mask is not None:
+        y = y[mask]
+
+    if features is None:
+        features = RunningStats().update(data.x)
+
+    stats = {
+        "graphs": len(slices["x"]) - 1,
+        "nodes": len(data.x),
+    }
+    stats.update(feature_stats(features))
+    stats.update(label_stats(y, thresholds=thresholds, bins=bins))
+    return stats
+
+
+def pair_dataset_stats(y, features, thresholds=LABEL_THRESHOLDS, bins=20):
+    """
+    Label and feature statistics of a pair dataset
+    """
+    stats = feature_stats(features)
+    stats.update(label_stats(y, thresholds=thresholds, bins=bins))
+    return stats
+
+
+def stats_file(processed_path):
+    """
+    Statistics file stored next to a processed dataset file
+    """
+    return path.splitext(processed_path)[0] + ".stats.pt"
+
+
+class DatasetStatsMixin:
+    """
+    Dataset-level statistics stored next to the processed file
+
+    Computed while the dataset is built (or on first access for datasets
+    processed before), so e.g. the class balance or the feature scaler
+    need no extra pass over the data.
+    """
+
+    @property
+    def stats_path(self):
+        return stats_file(self.processed_paths[0])
+
+    def compute_stats(self):
+        raise NotImplementedError
+
+    def save_stats(self, stats):
+        torch.save(stats, self.stats_path)
+        self._stats = stats
+        return stats
+
+    @property
+    def stats(self):
+        if getattr(self, "_stats", None) is None:
+            if path.exists(self.stats_path):
+                self._stats = torch.load(self.stats_path)
+            if getattr(self, "_stats", None) is None or "features" not in self._stats:
+                self.save_stats(self.compute_stats())
+        return self._stats
+
+    def feature_scaler(self, eps=1e-6):
+        return FeatureScaler.from_stats(self.stats["features"], eps=eps)
+
+
+class GraphStatsMixin(DatasetStatsMixin):
+
+    def compute_stats(self):
+        return graph_dataset_stats(self.data, self.slices)
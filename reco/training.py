@@ -1,3 +1,8 @@
+import os
+import re
+import sys
+import random
+
 import torch
 import numpy as np
 
@@ -8,15 +13,110 @@ from torch_geometric.loader import DataLoader
 
 from torch_geometric.data import Data
 
-from sklearn.metrics import confusion_matrix, precision_score, recall_score, fbeta_score, balanced_accuracy_score, roc_auc_score
+from .metrics import StreamingBinaryMetrics
+from .performance import autocast
 
 
-def train_edge_pred(model, device, optimizer, loss_func, train_dl):
-    train_loss = 0.0
-    model.train()
+class EdgePredAccumulator:
+    """
+    Running loss and prediction/label buffers kept on the device
+
+    Nothing is copied to the host until `sync` is called, which happens
+    once per epoch (in `result`) or every `sync_every` steps.
+    Buffers are preallocated and grow by doubling.
+    """
 
-    train_true_seg = []
-    train_pred_seg = []
+    def __init__(self, device, capacity=2**16, sync_every=None, keep_predictions=True):
+        self.device = device
+        self.capacity = capacity
+        self.sync_every = sync_every
+        self.keep_predictions = keep_predictions
+
+        self.steps = 0
+        self.size = 0
+        self.loss = torch.zeros((), dtype=torch.float64, device=device)
+        self.true = None
+        self.pred = None
+
+        # host side results
+        self.host_loss = 0.0
+        self.host_true = []
+        self.host_pred = []
+
+    def _reserve(self, y_true, y_pred, n):
+        if self.true is None:
+            size = max(self.capacity, n)
+            self.true = torch.empty(size, dtype=y_true.dtype, device=self.device)
+            self.pred = torch.empty(size, dtype=y_pred.dtype, device=self.device)
+            return
+
+        required = self.size + n
+        if required <= len(self.true):
+            return
+
+        size = len(self.true)
+        while size < required:
+            size *= 2
+
+        true = torch.empty(size, dtype=self.true.dtype, device=self.device)
+        pred = torch.empty(size, dtype=self.pred.dtype, device=self.device)
+        true[:self.size] = self.true[:self.size]
+        pred[:self.size] = self.pred[:self.size]
+        self.true, self.pred = true, pred
+
+    def update(self, loss, batch_size, y_true, y_pred):
+        y_true = y_true.detach().reshape(-1)
+        y_pred = y_pred.detach().reshape(-1)
+        n = y_true.numel()
+
+        self.loss += loss.detach() * batch_size
+
+        if self.keep_predictions:
+            self._reserve(y_true, y_pred, n)
+            self.true[self.size:self.size + n] = y_true
+            self.pred[self.size:self.size + n] = y_pred
+            self.size += n
+
+        self.steps += 1
+        if self.sync_every and self.steps % self.sync_every == 0:
+            self.sync()
+
+    def sync(self):
+        """
+        Move the accumulated values to the host and reset the device buffers
+        """
+        self.host_loss += self.loss.item()
+        self.loss.zero_()
+
+        if self.size:
+            self.host_true.append(self.true[:self.size].cpu().numpy())
+            self.host_pred.append(self.pred[:self.size].cpu().numpy())
+            self.size = 0
+
+    def result(self):
+        """
+        Returns (loss, true, pred) in the same format as train_edge_pred
+        Without kept predictions, true and pred are None
+        """
+        self.sync()
+        if not self.keep_predictions:
+            return self.host_loss, None, None
+        if not self.host_true:
+            return self.host_loss, np.array([]), np.array([])
+        return self.host_loss, np.concatenate(self.host_true), np.concatenate(self.host_pred)
+
+
+def train_edge_pred(model, device, optimizer, loss_func, train_dl, sync_every=None, metrics=None, perf=None):
+    """
+    Train the edge prediction model for one epoch
+    Returns (loss, true, pred)
+
+    When `metrics` (StreamingBinaryMetrics) is given, it is updated per batch
+    instead of keeping the predictions; true and pred are then None.
+    `perf` (PerformanceMode) enables the mixed-precision forward pass.
+    """
+    model.train()
+    acc = EdgePredAccumulator(device, sync_every=sync_every, keep_predictions=metrics is None)
 
     for data in train_dl:
 
@@ -25,7 +125,9 @@ def train_edge_pred(model, device, optimizer, loss_func, train_dl):
 
         optimizer.zero_grad()
 
-        seg_pred = model(data.x, data.edge_index)
+        with autocast(perf, device):
+            seg_pred = model(data.x, data.edge_index)
+        seg_pred = seg_pred.float()
         y_true = data.y
 
         if data.mask is not None:
@@ -38,33 +140,26 @@ def train_edge_pred(model, device, optimizer, loss_func, train_dl):
         loss.backward()
         optimizer.step()
 
-        train_loss += loss.item() * batch_size
+        acc.update(loss, batch_size, y_true, seg_pred)
+        if metrics is not None:
+            metrics.update(seg_pred, y_true)
 
-        seg_np = y_true.cpu().numpy()
-        pred_np = seg_pred.detach().cpu().numpy()
-
-        train_true_seg.append(seg_np.reshape(-1))
-        train_pred_seg.append(pred_np.reshape(-1))
-
-    train_true_cls = np.concatenate(train_true_seg)
-    train_pred_cls = np.concatenate(train_pred_seg)
-
-    return train_loss, train_true_cls, train_pred_cls
+    return acc.result()
 
 
 @torch.no_grad()
-def test_edge_pred(model, device, loss_func, test_dl, obj_cond=False):
-    test_loss = 0.0
+def test_edge_pred(model, device, loss_func, test_dl, obj_cond=False, sync_every=None, metrics=None, perf=None):
     model.eval()
+    acc = EdgePredAccumulator(device, sync_every=sync_every, keep_predictions=metrics is None)
 
-    test_true_seg = []
-    test_pred_seg = []
     for data in test_dl:
 
         batch_size = len(data)
         data = data.to(device)
 
-        seg_pred = model(data.x, data.edge_index)
+        with autocast(perf, device):
+            seg_pred = model(data.x, data.edge_index)
+        seg_pred = seg_pred.float()
 
         y_true = data.y
         if data.mask is not None:
@@ -72,17 +167,255 @@ def test_edge_pred(model, device, loss_func, test_dl, obj_cond=False):
             y_true = y_true[data.mask]
 
         loss = loss_func(seg_pred.view(-1, 1), y_true.view(-1, 1).type(torch.float))
-        test_loss += loss.item() * batch_size
+        acc.update(loss, batch_size, y_true, seg_pred)
+        if metrics is not None:
+            metrics.update(seg_pred, y_true)
+
+    return acc.result()
+
+
+
+class EarlyStopping:
+    """
+    Stop when the monitored metric (higher is better) has not improved
+    by more than min_delta for `patience` consecutive evaluations
+    """
 
-        seg_np = y_true.cpu().numpy()
-        pred_np = seg_pred.detach().cpu().numpy()
-        test_true_seg.append(seg_np.reshape(-1))
-        test_pred_seg.append(pred_np.reshape(-1))
+    def __init__(self, patience=5, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.best_epoch = None
+        self.bad_evals = 0
+
+    def step(self, value, epoch):
+        """
+        Record an evaluation, returns True if it is the best so far
+        """
+        if self.best is None or value > self.best + self.min_delta:
+            self.best = value
+            self.best_epoch = epoch
+            self.bad_evals = 0
+            return True
+        self.bad_evals += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.patience is not None and self.bad_evals >= self.patience
+
+    def state_dict(self):
+        return dict(self.__dict__)
+
+    def load_state_dict(self, state):
+        self.__dict__.update(state)
+
+
+def _rng_state():
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _atomic_save(obj, path):
+    """
+    torch.save next to the target and rename, a job killed
+    while saving never leaves a truncated file behind
+    """
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint(path, epoch, model, optimizer, scheduler=None, early_stopping=None, **extra):
+    """
+    Save the training state: model, optimizer, scheduler, early stopping and RNG states
+    The file is written next to the target and renamed (see _atomic_save).
+    """
+    state = {
+        "epoch": epoch,
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict() if scheduler is not None else None,
+        "early_stopping": early_stopping.state_dict() if early_stopping is not None else None,
+        "rng": _rng_state(),
+    }
+    state.update(extra)
+    _atomic_save(state, path)
 
-    test_true_cls = np.concatenate(test_true_seg)
-    test_pred_cls = np.concatenate(test_pred_seg)
 
-    return test_loss, test_true_cls, test_pred_cls
+def _torch_load(path, device):
+    try:
+        return torch.load(path, map_location=device, weights_only=False)
+    except TypeError:
+        # torch versions without the weights_only argument
+        return torch.load(path, map_location=device)
+
+
+def load_checkpoint(path, model, optimizer=None, scheduler=None, early_stopping=None, device="cpu"):
+    """
+    Restore the training state saved by save_checkpoint
+    Returns the checkpoint dict (the last finished epoch is in checkpoint["epoch"])
+    """
+    state = _torch_load(path, device)
+    model.load_state_dict(state["model"])
+    if optimizer is not None:
+        optimizer.load_state_dict(state["optimizer"])
+    if scheduler is not None and state["scheduler"] is not None:
+        scheduler.load_state_dict(state["scheduler"])
+    if early_stopping is not None and state["early_stopping"] is not None:
+        early_stopping.load_state_dict(state["early_stopping"])
+    _set_rng_state(state["rng"])
+    return state
+
+
+def list_checkpoints(checkpoint_dir):
+    """
+    Checkpoints in the directory, sorted by epoch
+    """
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    found = []
+    for fn in os.listdir(checkpoint_dir):
+        m = re.fullmatch(r"checkpoint\.(\d+)\.pt", fn)
+        if m:
+            found.append((int(m.group(1)), os.path.join(checkpoint_dir, fn)))
+    return [fn for _, fn in sorted(found)]
+
+
+def latest_checkpoint(checkpoint_dir):
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+def fit_edge_pred(
+        model,
+        device,
+        optimizer,
+        loss_func,
+        train_dl,
+        test_dl,
+        epochs,
+        scheduler=None,
+        checkpoint_dir=None,
+        checkpoint_every=10,
+        keep_checkpoints=2,
+        eval_every=10,
+        patience=None,
+        min_delta=0.0,
+        truth_threshold=0.8,
+        restore_best=True,
+        perf=None,
+    ):
+    """
+    Training driver for the edge prediction models
+
+    - evaluates the test AUC every `eval_every` epochs
+    - stops early when the AUC has not improved for `patience` evaluations
+    - with a checkpoint_dir, saves the training state every `checkpoint_every` epochs
+      (keeping the last `keep_checkpoints`) and the best model in best.pt;
+      a rerun resumes from the newest checkpoint in the directory
+
+    Returns the list of evaluations (dicts with epoch, losses and AUCs)
+    """
+    if keep_checkpoints < 1:
+        raise ValueError(f"keep_checkpoints must be at least 1 to resume, got {keep_checkpoints}")
+
+    stopper = EarlyStopping(patience=patience, min_delta=min_delta)
+    history = []
+    start_epoch = 0
+
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        last = latest_checkpoint(checkpoint_dir)
+        if last is not None:
+            state = load_checkpoint(last, model, optimizer, scheduler, stopper, device=device)
+            history = state.get("history", [])
+            start_epoch = state["epoch"] + 1
+            print(f"Resuming from {last} at epoch {start_epoch}", file=sys.stderr)
+
+    best_path = os.path.join(checkpoint_dir, "best.pt") if checkpoint_dir is not None else None
+    best_state = None
+
+    train_metrics = StreamingBinaryMetrics(truth_threshold=truth_threshold, device=device)
+    test_metrics = StreamingBinaryMetrics(truth_threshold=truth_threshold, device=device)
+
+    for epoch in range(start_epoch, epochs):
+        if stopper.should_stop:
+            break
+
+        train_metrics.reset()
+        train_loss, _, _ = train_edge_pred(
+            model,
+            device,
+            optimizer,
+            loss_func,
+            train_dl,
+            metrics=train_metrics,
+            perf=perf,
+        )
+        if scheduler is not None:
+            scheduler.step()
+
+        last_epoch = epoch == epochs - 1
+        if epoch % eval_every == 0 or last_epoch:
+            test_metrics.reset()
+            test_loss, _, _ = test_edge_pred(model, device, loss_func, test_dl, metrics=test_metrics, perf=perf)
+            train_auc = train_metrics.roc_auc()
+            test_auc = test_metrics.roc_auc()
+            history.append({
+                "epoch": epoch,
+                "train_loss": train_loss,
+                "train_auc": train_auc,
+                "test_loss": test_loss,
+                "test_auc": test_auc,
+            })
+            print(
+                f"Epoch {epoch}",
+                f"\ttrain loss:{train_loss:.3f}\ttrain auc: {train_auc:.3f}",
+                f"\t test loss:{test_loss:.3f} \t test auc: {test_auc:.3f}",
+                file=sys.stderr
+            )
+
+            if stopper.step(test_auc, epoch):
+                best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+                if best_path is not None:
+                    _atomic_save(best_state, best_path)
+
+            if stopper.should_stop:
+                print(
+                    f"Early stopping at epoch {epoch},",
+                    f"best test auc {stopper.best:.3f} at epoch {stopper.best_epoch}",
+                    file=sys.stderr
+                )
+
+        if checkpoint_dir is not None and (epoch % checkpoint_every == 0 or last_epoch or stopper.should_stop):
+            path = os.path.join(checkpoint_dir, f"checkpoint.{epoch:04d}.pt")
+            save_checkpoint(path, epoch, model, optimizer, scheduler, stopper, history=history)
+            checkpoints = list_checkpoints(checkpoint_dir)
+            for old in checkpoints[:len(checkpoints) - keep_checkpoints]:
+                os.remove(old)
+
+    if restore_best and stopper.best is not None:
+        if best_state is None and best_path is not None and os.path.exists(best_path):
+            best_state = _torch_load(best_path, device)
+        if best_state is not None:
+            model.load_state_dict(best_state)
+
+    return history
 
 
 
@@ -103,38 +436,52 @@ def split_geo_train_test(ds, batch_size=64, test_set_fraction=0.1):
     return train_dl, test_dl
 
 
-@torch.no_grad()
-def roc_auc(model, device, test_dl, truth_threshold=0.7):
+def _predict_batch(model, device, data, perf=None):
+    """
+    Run the model on a batch from a graph or a pair dataloader
+    Returns (predictions, labels)
+    """
+    with autocast(perf, device):
+        model_pred, l = _forward_batch(model, device, data)
+    return model_pred.float(), l
 
-    y_pred = []
-    y_true = []
 
-    model.eval()
+def _forward_batch(model, device, data):
+    if isinstance(data, Data):
+        # graph dataset
+        l = data.y.reshape(-1)
 
-    for data in test_dl:
+        data = data.to(device)
+        ei = data.edge_index
+        if ei is not None:
+            model_pred = model(data.x, ei, data.batch)
+        else:
+            model_pred = model(data.x, data.batch)[:,0]
+    else:
+        b, l = data
+        model_pred = model(b.to(device))
+        l = l.reshape(-1)
 
-        if isinstance(data, Data):
-            # graph dataset
-            l = data.y.reshape(-1)
+    return model_pred.reshape(-1), l
 
-            data = data.to(device)
-            ei = data.edge_index
-            if ei is not None:
-                model_pred = model(data.x, ei, data.batch)
-            else:
-                model_pred = model(data.x, data.batch)[:,0]
-        else:
-            b, l = data
-            model_pred = model(b.to(device))
-            l = l.reshape(-1)
 
-        y_pred += model_pred.detach().cpu().reshape(-1).tolist()
-        y_true += (l > truth_threshold).type(torch.int).tolist()
+@torch.no_grad()
+def streaming_metrics(model, device, test_dl, truth_threshold=0.7, perf=None, **kwargs):
+    """
+    Collect the score histograms of the model over the dataloader
+    """
+    model.eval()
+    metrics = StreamingBinaryMetrics(truth_threshold=truth_threshold, device=device, **kwargs)
+    for data in test_dl:
+        model_pred, l = _predict_batch(model, device, data, perf=perf)
+        metrics.update(model_pred, l)
+    return metrics
 
-    return roc_auc_score(y_true, y_pred)
+
+def roc_auc(model, device, test_dl, truth_threshold=0.7, perf=None):
+    return streaming_metrics(model, device, test_dl, truth_threshold=truth_threshold, perf=perf).roc_auc()
 
 
-@torch.no_grad()
 def precision_recall_curve(model, device, test_dl, beta=0.5, truth_threshold=0.7, step=1, focus_metric="fbeta"):
     """
     Plot the precision/recall curve depending on the decision threshold
@@ -143,47 +490,18 @@ def precision_recall_curve(model, device, test_dl, beta=0.5, truth_threshold=0.7
     - model (0-1 whether we want to cluster this trackster or not)
     - simtrackster, what we consider a relevant trackster (based on the score - usually 0.8)
     """
-    model.eval()
     th_values = [i / 100. for i in range(1, 100, step)]
 
+    # a single pass over the data, all thresholds are read from the histograms
+    metrics = streaming_metrics(model, device, test_dl, truth_threshold=truth_threshold)
+
     result = {
-        "precision": [],
-        "recall": [],
-        "fbeta": [],
-        "b_acc": [],
+        "precision": [metrics.precision(th) for th in th_values],
+        "recall": [metrics.recall(th) for th in th_values],
+        "fbeta": [metrics.fbeta(th, beta=beta) for th in th_values],
+        "b_acc": [metrics.balanced_accuracy(th) for th in th_values],
     }
-    cm = []
-
-    for th in th_values:
-        pred = []
-        lab = []
-        for data in test_dl:
-
-            if isinstance(data, Data):
-                # graph dataset
-                l = data.y.reshape(-1)
-
-                data = data.to(device)
-                ei = data.edge_index
-                if ei is not None:
-                    model_pred = model(data.x, ei, data.batch)
-                else:
-                    model_pred = model(data.x, data.batch)[:,0]
-            else:
-                b, l = data
-                model_pred = model(b.to(device))
-                l = l.reshape(-1)
-
-            model_pred = model_pred.detach().cpu().reshape(-1)
-
-            pred += (model_pred > th).type(torch.int).tolist()
-            lab += (l > truth_threshold).type(torch.int).tolist()
-
-        result["precision"].append(precision_score(lab, pred, zero_division=0))
-        result["recall"].append(recall_score(lab, pred))
-        result["fbeta"].append(fbeta_score(lab, pred, beta=beta))
-        result["b_acc"].append(balanced_accuracy_score(lab, pred))
-        cm.append(confusion_matrix(lab, pred).ravel())
+    cm = [metrics.confusion(th) for th in th_values]
 
     plt.figure()
     for k, v in result.items():
@@ -197,30 +515,82 @@ def precision_recall_curve(model, device, test_dl, beta=0.5, truth_threshold=0.7
     decision_th = th_values[bi]
 
     tn, fp, fn, tp = cm[bi]
-    print(f"TP: {tp}, TN: {tn}, FP: {fp}, FN: {fn}")
+    print(f"TP: {tp:.0f}, TN: {tn:.0f}, FP: {fp:.0f}, FN: {fn:.0f}")
     print(f"TH: {decision_th}", " ".join([f"{k}: {v[bi]:.3f}" for k, v in result.items()]))
 
 
-def train_mlp(model, device, opt, loader, loss_obj):
-    epoch_loss = 0
-    for batch, labels in loader:
-        # reset optimizer and enable training mode
-        opt.zero_grad()
-        model.train()
+def _cycle(loader):
+    # restart the loader (and its shuffling) when it runs out
+    while True:
+        empty = True
+        for item in loader:
+            empty = False
+            yield item
+        if empty:
+            return
+
+
+def train_mlp(model, device, opt, loader, loss_obj, perf=None, accumulation_steps=1, steps_per_epoch=None):
+    """
+    Train the pair model for one epoch
+    Returns the summed batch loss as a float
+
+    accumulation_steps: number of batches whose gradients are accumulated
+        before each optimizer step
+    steps_per_epoch: number of optimizer steps in the epoch,
+        by default one pass over the loader (restarted if it runs out)
+
+    The loss is accumulated detached on the device, so the batch graphs
+    are released after each backward pass and the host syncs once per epoch.
+    """
+    model.train()
+    opt.zero_grad()
+
+    if steps_per_epoch is None:
+        batches = iter(loader)
+        max_batches = None
+    else:
+        batches = _cycle(loader)
+        max_batches = steps_per_epoch * accumulation_steps
+
+    epoch_loss = torch.zeros((), dtype=torch.float64, device=device)
+    pending = 0
+
+    for i, (batch, labels) in enumerate(batches):
+        if max_batches is not None and i >= max_batches:
+            break
 
         # move data to the device
         batch = batch.to(device)
         labels = labels.to(device)
 
         # get the prediction tensor
-        z = model(batch).reshape(-1)
+        with autocast(perf, device):
+            z = model(batch).reshape(-1)
+        z = z.float()
 
         # compute the loss
         loss = loss_obj(z, labels)
-        epoch_loss += loss
-
-        # back-propagate and update the weight
-        loss.backward()
+        epoch_loss += loss.detach()
+
+        # back-propagate, the gradients are averaged over the accumulated batches
+        (loss / accumulation_steps).backward()
+        pending += 1
+
+        if pending == accumulation_steps:
+            opt.step()
+            opt.zero_grad()
+            pending = 0
+
+    # update with the leftover batches, averaged over their actual number
+    if pending:
+        if pending != accumulation_steps:
+            scale = accumulation_steps / pending
+            for group in opt.param_groups:
+                for p in group["params"]:
+                    if p.grad is not None:
+                        p.grad.mul_(scale)
         opt.step()
+        opt.zero_grad()
 
-    return float(epoch_loss)
\ No newline at end of file
+    return epoch_loss.item()